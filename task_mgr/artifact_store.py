@@ -0,0 +1,243 @@
+# artifact_store.py - 按 SHA-256 内容寻址的任务包/结果存储
+#
+# blobs/ab/cd/abcd... 存实际内容，相同内容只存一份；
+# artifacts 表把对外的文件名（{task_id}_task.zip、{task_id}_result.zip）映射到 digest。
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from task_store import SQLiteStore
+
+CHUNK_SIZE = 1024 * 1024
+ARTIFACT_SUFFIXES = ("_task.zip", "_result.zip")
+
+ARTIFACT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    name         TEXT PRIMARY KEY,
+    digest       TEXT NOT NULL,
+    size         INTEGER NOT NULL,
+    created_at   REAL NOT NULL,
+    last_access  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_artifacts_digest ON artifacts(digest);
+"""
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+            size += len(chunk)
+    return h.hexdigest(), size
+
+
+class HashingSpool:
+    """写入时顺带计算 SHA-256 和大小的临时文件，位于存储的 tmp 目录下。
+
+    可以直接作为 Werkzeug 上传文件的落盘容器；被 ArtifactStore.adopt() 收走之前关闭会自动删除。
+    """
+
+    def __init__(self, tmp_dir):
+        fd, self.path = tempfile.mkstemp(dir=tmp_dir, suffix=".part")
+        self._f = os.fdopen(fd, "w+b")
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.adopted = False
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._f.write(data)
+
+    @property
+    def digest(self):
+        return self._hash.hexdigest()
+
+    def close(self):
+        if not self._f.closed:
+            self._f.close()
+        if not self.adopted:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        # read/readline/seek/tell/flush 等直接交给底层文件
+        return getattr(self._f, name)
+
+
+class ArtifactStore(SQLiteStore):
+    SCHEMA = ARTIFACT_SCHEMA
+
+    def __init__(self, root, db_path):
+        self.root = Path(root)
+        self.blob_dir = self.root / "blobs"
+        self.tmp_dir = self.root / "tmp"   # 和 blobs 在同一个文件系统上，落盘后 os.replace 即可
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        super().__init__(db_path)
+
+    def blob_path(self, digest):
+        return self.blob_dir / digest[:2] / digest[2:4] / digest
+
+    # ---------- 写入 ----------
+    # 引用的增删和 blob 的落盘/删除放在同一个 BEGIN IMMEDIATE 事务里：多个 gunicorn worker 之间
+    # 不会出现“计数为 0 删掉 blob 的同时，另一边刚看到 blob 存在并登记了新引用”的情况。
+    def put_file(self, name, src_path, digest=None, size=None):
+        """把 src_path 收进存储（会移走源文件），登记为 name，返回 (digest, size)。
+
+        已有相同内容的 blob 时直接丢弃源文件，只增加一条引用。
+        """
+        if digest is None or size is None:
+            digest, size = sha256_file(src_path)
+        blob = self.blob_path(digest)
+        staged = self._stage(src_path, blob)
+
+        now = time.time()
+        conn = self._conn()
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if blob.exists():
+                    os.unlink(staged)
+                else:
+                    os.replace(staged, blob)
+                staged = None
+                old = conn.execute("SELECT digest FROM artifacts WHERE name = ?", (name,)).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO artifacts (name, digest, size, created_at, last_access)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (name, digest, size, now, now),
+                )
+                if old and old["digest"] != digest:
+                    self._drop_blob_if_unreferenced(conn, old["digest"])
+        finally:
+            if staged is not None:
+                Path(staged).unlink(missing_ok=True)
+        return digest, size
+
+    def _stage(self, src_path, blob):
+        """把源文件挪到 blob 所在目录下的临时文件，之后只需一次 os.replace，blob 路径上永远是完整内容。"""
+        os.makedirs(blob.parent, exist_ok=True)
+        fd, staged = tempfile.mkstemp(dir=blob.parent, suffix=".part")
+        os.close(fd)
+        try:
+            os.replace(src_path, staged)
+        except OSError:
+            # 跨文件系统时退化为拷贝；拷到一半失败只会留下 .part，不会污染 blob
+            try:
+                shutil.copyfile(src_path, staged)
+            except BaseException:
+                os.unlink(staged)
+                raise
+            os.unlink(src_path)
+        return staged
+
+    def link(self, names, digest, size):
+        """给已有的 blob 再登记若干个名字（批量提交时多个任务共用同一个任务包）。
+
+        blob 已被删掉时抛 FileNotFoundError，不会登记出指向不存在内容的引用。
+        """
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if not self.blob_path(digest).exists():
+                raise FileNotFoundError(f"blob {digest} no longer exists")
+            conn.executemany(
+                "INSERT OR REPLACE INTO artifacts (name, digest, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                [(name, digest, size, now, now) for name in names],
+            )
+
+    def open_spool(self):
+        return HashingSpool(self.tmp_dir)
+
+    def adopt(self, name, spool):
+        """把已经写完的 HashingSpool 直接登记为 name，不再重新读一遍算哈希。"""
+        spool.flush()
+        spool.adopted = True
+        spool.close()
+        return self.put_file(name, spool.path, digest=spool.digest, size=spool.size)
+
+    def put_stream(self, name, stream):
+        """分块读取 stream 写入存储，内存占用与文件大小无关。"""
+        spool = self.open_spool()
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                spool.write(chunk)
+        except BaseException:
+            spool.close()
+            raise
+        return self.adopt(name, spool)
+
+    def delete(self, name):
+        """删除一条引用；blob 没有其他引用时一起删掉。返回是否存在过。"""
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT digest FROM artifacts WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return False
+            conn.execute("DELETE FROM artifacts WHERE name = ?", (name,))
+            self._drop_blob_if_unreferenced(conn, row["digest"])
+        return True
+
+    def _drop_blob_if_unreferenced(self, conn, digest):
+        """必须在持有写锁的事务里调用。"""
+        refs = conn.execute("SELECT COUNT(*) FROM artifacts WHERE digest = ?", (digest,)).fetchone()[0]
+        if refs == 0:
+            self.blob_path(digest).unlink(missing_ok=True)
+
+    def touch(self, name):
+        with self._conn() as conn:
+            conn.execute("UPDATE artifacts SET last_access = ? WHERE name = ?", (time.time(), name))
+
+    # ---------- 读取 ----------
+    def lookup(self, name):
+        """返回 {name, digest, size, path, ...}；不存在或 blob 丢失时返回 None。"""
+        row = self._conn().execute("SELECT * FROM artifacts WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        artifact = dict(row)
+        artifact["path"] = self.blob_path(artifact["digest"])
+        if not artifact["path"].exists():
+            return None
+        return artifact
+
+    def exists(self, name):
+        return self.lookup(name) is not None
+
+    def iter_lru(self):
+        """按最后访问时间从旧到新遍历所有引用。"""
+        return iter(self._conn().execute("SELECT * FROM artifacts ORDER BY last_access, name").fetchall())
+
+    def usage(self):
+        """返回 (blob 总字节数, blob 个数, 引用个数)；同一份内容只算一次。"""
+        conn = self._conn()
+        blob_bytes, blob_count = conn.execute(
+            "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM (SELECT DISTINCT digest, size FROM artifacts)"
+        ).fetchone()
+        ref_count = conn.execute("SELECT COUNT(*) FROM artifacts").fetchone()[0]
+        return blob_bytes, blob_count, ref_count
+
+    # ---------- 旧数据迁移 ----------
+    def import_legacy_files(self, task_dir):
+        """把 TASK_DIR 下平铺的 *_task.zip / *_result.zip 收进存储，返回导入个数。"""
+        count = 0
+        for f in Path(task_dir).iterdir():
+            if not f.is_file() or not f.name.endswith(ARTIFACT_SUFFIXES):
+                continue
+            try:
+                self.put_file(f.name, f)
+                count += 1
+            except FileNotFoundError:
+                # 另一个 gunicorn worker 同时在导入同一个文件
+                continue
+        return count
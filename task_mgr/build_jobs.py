@@ -0,0 +1,143 @@
+# build_jobs.py - 任务包异步构建：有界线程池直接调用 build_task 里的函数，不再每次起一个解释器
+
+import logging
+import os
+import shutil
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from task_store import SQLiteStore, owner_gone, process_owner
+
+logger = logging.getLogger(__name__)
+
+BUILD_JOB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS build_jobs (
+    job_id       TEXT PRIMARY KEY,
+    mode         TEXT NOT NULL,
+    name         TEXT NOT NULL,
+    status       TEXT NOT NULL,
+    progress     INTEGER NOT NULL DEFAULT 0,
+    message      TEXT,
+    output_name  TEXT,
+    owner        TEXT,
+    created_at   REAL NOT NULL,
+    updated_at   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_build_jobs_created ON build_jobs(created_at);
+"""
+
+
+INTERRUPTED_MESSAGE = "interrupted"
+
+
+class BuildJobs(SQLiteStore):
+    """构建任务登记在 SQLite 里，任何一个 gunicorn worker 都能查询进度；
+    实际执行在接收请求的那个进程的线程池里。
+
+    线程池不会跨进程存活：master 重启或 gunicorn 回收 worker 后，那个进程里排队/运行中的构建
+    就永远不会结束了。每个构建记下所属进程（owner），进程已经不在的按 interrupted 判失败。"""
+
+    SCHEMA = BUILD_JOB_SCHEMA
+
+    def __init__(self, db_path, build_dir, max_workers=2):
+        self.build_dir = Path(build_dir)
+        os.makedirs(self.build_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="build")
+        self._owner = process_owner()
+        super().__init__(db_path)
+        failed = self.fail_interrupted()
+        if failed:
+            logger.info(f"Marked {failed} interrupted build jobs as failed")
+
+    def job_dir(self, job_id):
+        return self.build_dir / job_id
+
+    def create(self, mode, name):
+        """登记一个构建任务并建好它的工作目录；调用方先把上传文件存进去，再 submit。"""
+        job_id = uuid.uuid4().hex[:16]
+        os.makedirs(self.job_dir(job_id), exist_ok=True)
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO build_jobs (job_id, mode, name, status, progress, owner, created_at, updated_at)"
+                " VALUES (?, ?, ?, 'queued', 0, ?, ?, ?)",
+                (job_id, mode, name, self._owner, now, now),
+            )
+        return job_id
+
+    def submit(self, job_id, output_name, fn, *args):
+        """在线程池里执行 fn(job_dir, output_path, progress, *args)。
+
+        progress(percent, message) 由构建函数在各阶段调用；成功后 output_path 即可下载。
+        """
+        self._executor.submit(self._run, job_id, output_name, fn, args)
+
+    def _run(self, job_id, output_name, fn, args):
+        job_dir = self.job_dir(job_id)
+        output_path = job_dir / output_name
+
+        def progress(percent, message=None):
+            self._update(job_id, status="running", progress=percent, message=message)
+
+        try:
+            progress(5, "Build started")
+            fn(job_dir, output_path, progress, *args)
+            if not output_path.exists():
+                raise FileNotFoundError("Built zip not found")
+            self._update(job_id, status="done", progress=100, message="Build finished", output_name=output_name)
+        except Exception as e:
+            logger.error(f"Build job {job_id} failed:\n{traceback.format_exc()}")
+            self._update(job_id, status="failed", message=str(e))
+        finally:
+            # 只保留产物，其余中间文件（上传的 zip、解压目录）清掉
+            for entry in job_dir.iterdir():
+                if entry.name == output_name:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry, ignore_errors=True)
+                else:
+                    entry.unlink(missing_ok=True)
+
+    def _update(self, job_id, status, progress=None, message=None, output_name=None):
+        with self._conn() as conn:
+            conn.execute(
+                "UPDATE build_jobs SET status = ?, progress = COALESCE(?, progress), message = COALESCE(?, message),"
+                " output_name = COALESCE(?, output_name), updated_at = ? WHERE job_id = ?",
+                (status, progress, message, output_name, time.time(), job_id),
+            )
+
+    def _fail_if_orphaned(self, job):
+        """所属进程已经不在的排队/运行中构建标成 interrupted 失败，返回是否由本次调用完成。"""
+        if job["status"] not in ("queued", "running") or not owner_gone(job["owner"]):
+            return False
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE build_jobs SET status = 'failed', message = ?, updated_at = ?"
+                " WHERE job_id = ? AND status = ? AND owner IS ?",
+                (INTERRUPTED_MESSAGE, time.time(), job["job_id"], job["status"], job["owner"]),
+            )
+        return cur.rowcount == 1
+
+    def fail_interrupted(self):
+        """启动时调用：所属进程已经退出的排队/运行中构建判为失败，返回条数。"""
+        rows = self._conn().execute("SELECT * FROM build_jobs WHERE status IN ('queued', 'running')").fetchall()
+        return sum(self._fail_if_orphaned(dict(row)) for row in rows)
+
+    def get(self, job_id):
+        row = self._conn().execute("SELECT * FROM build_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        # 进程是在本进程启动之后才被回收的，启动时的检查看不到，查询时再补一次
+        if self._fail_if_orphaned(job):
+            job = dict(self._conn().execute("SELECT * FROM build_jobs WHERE job_id = ?", (job_id,)).fetchone())
+        return job
+
+    def output_path(self, job):
+        if job["status"] != "done" or not job["output_name"]:
+            return None
+        path = self.job_dir(job["job_id"]) / job["output_name"]
+        return path if path.exists() else None
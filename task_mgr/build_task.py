@@ -1,11 +1,16 @@
 import argparse
+import hashlib
 import os
+import random
+import secrets
 import shutil
 import tempfile
 import zipfile
 import json
 import textwrap
+from pathlib import Path
 from example_tasks import sha256, aes_enc, aes_dec
+from zip_copy import copy_member
 
 EXAMPLE_REQUIREMENTS = {
     "sha256": [],
@@ -13,12 +18,27 @@ EXAMPLE_REQUIREMENTS = {
     "aes_dec": ["pycryptodome"]
 }
 
+EXAMPLE_MODULES = {
+    "sha256": sha256,
+    "aes_enc": aes_enc,
+    "aes_dec": aes_dec,
+}
+
+# 示例任务模板缓存：代码、requirements、Dockerfile、task_config.json 都是固定的，
+# 按 (示例名, 生成器版本, 选项) 预先打成骨架 zip，每次构建只追加这次的 input 数据
+TEMPLATE_CACHE_DIR = os.environ.get("PI_TASK_TEMPLATE_CACHE",
+                                    str(Path.home() / ".cache" / "pi_task" / "templates"))
+
+# BASE_IMAGE / PIP_INDEX_URL / PIP_TRUSTED_HOST 由 worker（或 master 集中构建）通过 --build-arg 传入，
+# pip 会直接读取同名环境变量。PyPI 缓存的地址只在 client.py 的 DEFAULT_PYPI_MIRROR 和
+# task_mgr_flask.py 的 PYPI_INDEX_URL 里配置，这里不写默认值；没传时 pip 用它自己的默认源。
+# python:*-slim 镜像自带 python3 和 pip，不再 apt-get，离线环境也能构建。
 DOCKERFILE_TEMPLATE = """\
-FROM dockerproxy.net/library/python:3.11-slim-bookworm
+ARG BASE_IMAGE=dockerproxy.net/library/python:3.11-slim-bookworm
+FROM ${BASE_IMAGE}
 
-RUN apt-get update \\
-    && apt-get install -y --no-install-recommends python3 python3-pip \\
-    && rm -rf /var/lib/apt/lists/*
+ARG PIP_INDEX_URL
+ARG PIP_TRUSTED_HOST
 
 WORKDIR /task
 COPY . /task
@@ -37,35 +57,88 @@ def write_dockerfile(task_dir):
         f.write(DOCKERFILE_TEMPLATE)
 
 def make_task_zip(task_dir, output_path):
-    shutil.make_archive(output_path.replace(".zip", ""), "zip", root_dir=task_dir)
+    # 不用 shutil.make_archive：部分 Python 版本里它会 os.chdir，master 上多线程并发构建时不安全
+    with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for root, dirs, files in os.walk(task_dir):
+            dirs.sort()
+            rel_root = os.path.relpath(root, task_dir)
+            if rel_root != ".":
+                zf.write(root, rel_root)  # 目录项，保证空的 input/ output/ 也在包里
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                zf.write(path, os.path.relpath(path, task_dir))
 
 def print_usage():
     print("""
 Usage:
   示例任务模式:
-    python build_task.py -e TASK_NAME [-d DEP_ZIP] -o OUTPUT_ZIP
+    python build_task.py -e TASK_NAME [-d DEP_ZIP] -o OUTPUT_ZIP [--seed N] [--no-cache]
 
   自定义任务模式:
-    python build_task.py -i CODE_DIR [-d INPUT_DIR] -o OUTPUT_ZIP [--no-docker]
+    python build_task.py -i CODE_DIR [-d INPUT_DIR] [--dataset NAME=SHA256 ...] -o OUTPUT_ZIP [--no-docker]
+
+  数据集打包模式:
+    python build_task.py --make-dataset DATA_DIR -o DATASET_ZIP
 
 Options:
   -e, --example      示例任务名 (sha256, aes_enc, aes_dec)
   -d, --deps / --input-data  示例任务依赖zip包或自定义任务的输入目录
-  -i, --input-code   自定义任务的代码目录（必须包含 main.py）
+  -i, --input-code   自定义任务的代码目录（必须包含 main.py），可选 reduce.py（map-reduce 提交时用来汇总各分片结果）
   -o, --output       输出任务包 zip 路径
   --no-docker        不使用 Docker 运行任务（默认使用 Docker）
+  --dataset NAME=SHA256  引用 master 上登记过的数据集，运行时出现在 input/NAME/ 下（可重复）
+  --make-dataset DIR 把数据目录打成数据集 zip（内容相同则 sha256 相同），再上传到 /pi_task/datasets 登记
+  --seed N           示例任务用固定种子生成输入数据，便于基准测试复现
+  --no-cache         不使用示例任务模板缓存（默认缓存在 ~/.cache/pi_task/templates）
 
 Examples:
   示例任务：
     python build_task.py -e sha256 -o sha256_task.zip
     python build_task.py -e aes_enc -o aes_enc_task.zip
     python build_task.py -e aes_dec -d aes_enc_task.zip -o aes_dec_task.zip
+    python build_task.py -e sha256 --seed 42 -o sha256_bench_task.zip
 
   自定义任务：
     python build_task.py -i ./mytask -d ./mytask/input -o mytask.zip --no-docker
+
+  共享数据集：
+    python build_task.py --make-dataset ./images -o images.zip
+    curl -F dataset=@images.zip http://192.168.12.201:5000/pi_task/datasets
+    python build_task.py -i ./mytask --dataset images=<sha256> -o mytask.zip
 """)
 
-def build_custom_task(code_dir, input_dir, output_path, use_docker):
+def make_dataset_zip(data_dir, output_path):
+    """把 data_dir 打成数据集 zip，返回 sha256。
+
+    成员按路径排序、时间戳和权限位固定，同样的数据每次打出来的 zip 字节相同，登记到 master 时只存一份。
+    """
+    if not os.path.isdir(data_dir):
+        raise ValueError(f"Invalid dataset directory: {data_dir}")
+
+    def build(tmp_path):
+        with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            for root, dirs, files in os.walk(data_dir):
+                dirs.sort()
+                for filename in sorted(files):
+                    path = os.path.join(root, filename)
+                    info = zipfile.ZipInfo(os.path.relpath(path, data_dir).replace(os.sep, "/"),
+                                           date_time=(1980, 1, 1, 0, 0, 0))
+                    info.external_attr = 0o644 << 16
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    info.file_size = os.path.getsize(path)   # 让 zipfile 按大小决定要不要用 zip64
+                    with open(path, "rb") as src, zf.open(info, "w") as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+    _write_atomically(os.path.abspath(output_path), build)
+
+    h = hashlib.sha256()
+    with open(output_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    print(f"[✓] Dataset created: {output_path} (sha256={h.hexdigest()})")
+    return h.hexdigest()
+
+def build_custom_task(code_dir, input_dir, output_path, use_docker, datasets=None):
+    """datasets: {挂载名: sha256}，引用 master 上登记过的数据集，写进 task_config.json 而不是拷进任务包。"""
     if not os.path.isdir(code_dir):
         raise ValueError(f"Invalid task code directory: {code_dir}")
 
@@ -103,8 +176,10 @@ def build_custom_task(code_dir, input_dir, output_path, use_docker):
         # 写 task_config.json
         config = {
             "use_docker": use_docker,
-            "requires_input": bool(input_dir)
+            "requires_input": bool(input_dir or datasets)
         }
+        if datasets:
+            config["datasets"] = dict(datasets)
         with open(os.path.join(task_dir, "task_config.json"), "w") as f:
             json.dump(config, f, indent=2)
 
@@ -112,6 +187,115 @@ def build_custom_task(code_dir, input_dir, output_path, use_docker):
         make_task_zip(task_dir, output_path)
         print(f"[✓] Custom task package created: {output_path}")
 
+def _template_key(example, use_docker):
+    spec = {
+        "example": example,
+        "version": EXAMPLE_MODULES[example].VERSION,
+        "requirements": EXAMPLE_REQUIREMENTS[example],
+        "dockerfile": DOCKERFILE_TEMPLATE,
+        "use_docker": use_docker,
+    }
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+def _write_atomically(path, build):
+    """build(tmp_path) 写到同目录的临时文件后再 rename，并发构建时不会读到半个文件。"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        build(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def _build_template(example, use_docker, zip_path):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        task_dir = os.path.join(temp_dir, "example_task")
+        os.makedirs(os.path.join(task_dir, "input"), exist_ok=True)
+        os.makedirs(os.path.join(task_dir, "output"), exist_ok=True)
+
+        EXAMPLE_MODULES[example].write_code(task_dir)
+        write_requirements(task_dir, EXAMPLE_REQUIREMENTS[example])
+        write_dockerfile(task_dir)
+
+        config = {
+            "use_docker": use_docker,
+            "requires_input": True
+        }
+        with open(os.path.join(task_dir, "task_config.json"), "w") as f:
+            json.dump(config, f, indent=2)
+
+        make_task_zip(task_dir, zip_path)
+
+def get_example_template(example, use_docker=True):
+    """返回示例任务骨架 zip 的路径（不含 input 数据），没有缓存时先生成。"""
+    key = _template_key(example, use_docker)
+    template_path = os.path.join(TEMPLATE_CACHE_DIR, f"{example}-{key}.zip")
+    if not os.path.exists(template_path):
+        _write_atomically(template_path, lambda tmp_path: _build_template(example, use_docker, tmp_path))
+    return template_path
+
+def _make_example_inputs(example, dep_zip, seed):
+    if example == "aes_dec":
+        return aes_dec.make_inputs(dep_zip)
+    randbytes = random.Random(seed).randbytes if seed is not None else secrets.token_bytes
+    return EXAMPLE_MODULES[example].make_inputs(randbytes)
+
+def _append_inputs(zip_path, inputs):
+    # 随机数据压不动，直接 STORED，省掉 deflate 的 CPU
+    with zipfile.ZipFile(zip_path, "a", zipfile.ZIP_STORED) as zf:
+        for name, data in sorted(inputs.items()):
+            zf.writestr(f"input/{name}", data)
+
+def update_task_config(zip_path, **updates):
+    """改写任务包里的 task_config.json，其余成员按原顺序把压缩数据原样拷过去（不解压、不重新压缩）。"""
+    def build(tmp_path):
+        with zipfile.ZipFile(zip_path) as zin, zipfile.ZipFile(tmp_path, "w") as zout:
+            for info in zin.infolist():
+                if info.filename == "task_config.json":
+                    config = json.loads(zin.read(info))
+                    config.update(updates)
+                    zout.writestr(info, json.dumps(config, indent=2))
+                else:
+                    copy_member(zin, info, zout)
+    _write_atomically(zip_path, build)
+
+def build_example_task(example, output_path, dep_zip=None, use_docker=True, seed=None, use_cache=True):
+    """构建示例任务包。
+
+    seed:      给定时用固定种子生成输入数据，同一个种子每次得到完全相同的任务包（基准测试可复现）。
+    use_cache: 为 False 时跳过模板缓存，从头生成（调试生成器时用）。
+    """
+    if example not in EXAMPLE_REQUIREMENTS:
+        raise ValueError(f"Unsupported example task '{example}'")
+    if example == "aes_dec" and not dep_zip:
+        raise ValueError("aes_dec requires a dependency zip (output of aes_enc)")
+
+    if not use_cache:
+        _build_template(example, use_docker, output_path)
+        _append_inputs(output_path, _make_example_inputs(example, dep_zip, seed))
+        print(f"[✓] Example task package created: {output_path}")
+        return
+
+    template_path = get_example_template(example, use_docker)
+
+    if seed is not None and example != "aes_dec":
+        # 固定种子的完整任务包也缓存下来，之后同样的构建只剩一次文件拷贝
+        dataset_path = template_path.replace(".zip", f"-seed{seed}.zip")
+        if not os.path.exists(dataset_path):
+            def build(tmp_path):
+                shutil.copyfile(template_path, tmp_path)
+                _append_inputs(tmp_path, _make_example_inputs(example, dep_zip, seed))
+            _write_atomically(dataset_path, build)
+        shutil.copyfile(dataset_path, output_path)
+    else:
+        shutil.copyfile(template_path, output_path)
+        _append_inputs(output_path, _make_example_inputs(example, dep_zip, seed))
+
+    print(f"[✓] Example task package created: {output_path}")
+
 def main():
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument("-e", "--example", help="Example task name (sha256, aes_enc, aes_dec)")
@@ -119,8 +303,17 @@ def main():
     parser.add_argument("-i", "--input-code", help="Custom task code directory (must include main.py)")
     parser.add_argument("-o", "--output", required=True, help="Output zip file path")
     parser.add_argument("--no-docker", action="store_true", help="Do not use Docker to run this task")
+    parser.add_argument("--seed", type=int, help="Fixed random seed for example task input data (reproducible benchmarks)")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the example task template cache")
+    parser.add_argument("--dataset", action="append", default=[], metavar="NAME=SHA256",
+                        help="Reference a dataset registered on the master, mounted at input/NAME (repeatable)")
+    parser.add_argument("--make-dataset", metavar="DATA_DIR", help="Pack DATA_DIR into a dataset zip")
     args = parser.parse_args()
 
+    if args.make_dataset:
+        make_dataset_zip(args.make_dataset, args.output)
+        return
+
     if not args.example and not args.input_code:
         print("Error: Must specify either -e for example task or -i for custom task.\n")
         print_usage()
@@ -137,34 +330,19 @@ def main():
             print_usage()
             return
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            task_dir = os.path.join(temp_dir, "example_task")
-            os.makedirs(os.path.join(task_dir, "input"), exist_ok=True)
-            os.makedirs(os.path.join(task_dir, "output"), exist_ok=True)
-
-            # 生成任务代码和数据
-            if args.example == "sha256":
-                sha256.generate(task_dir)
-            elif args.example == "aes_enc":
-                aes_enc.generate(task_dir)
-            elif args.example == "aes_dec":
-                aes_dec.generate(task_dir, args.deps)
-
-            write_requirements(task_dir, EXAMPLE_REQUIREMENTS[args.example])
-            write_dockerfile(task_dir)
-
-            config = {
-                "use_docker": not args.no_docker,
-                "requires_input": True
-            }
-            with open(os.path.join(task_dir, "task_config.json"), "w") as f:
-                json.dump(config, f, indent=2)
-
-            make_task_zip(task_dir, args.output)
-            print(f"[✓] Example task package created: {args.output}")
+        build_example_task(args.example, args.output, args.deps, not args.no_docker,
+                           seed=args.seed, use_cache=not args.no_cache)
 
     elif args.input_code:
-        build_custom_task(args.input_code, args.deps, args.output, not args.no_docker)
+        datasets = {}
+        for ref in args.dataset:
+            name, sep, digest = ref.partition("=")
+            if not sep or not name or len(digest) != 64:
+                print(f"Error: --dataset expects NAME=SHA256, got '{ref}'\n")
+                print_usage()
+                return
+            datasets[name] = digest.lower()
+        build_custom_task(args.input_code, args.deps, args.output, not args.no_docker, datasets)
 
 if __name__ == "__main__":
     main()
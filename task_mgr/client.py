@@ -1,22 +1,42 @@
 # client.py - Redis 优先级队列 + 原有高级执行逻辑（融合版）
 
 import os
+import sys
 import time
+import signal
+import argparse
+import multiprocessing
+import queue
+import threading
 import zipfile
 import subprocess
 import requests
 import shutil
 from pathlib import Path
+from urllib.parse import urlparse
 import logging
 import json
 import shutil as sh
+import socket
+import fcntl
+import hashlib
+import tempfile
+import contextlib
+import collections
+import re
 import redis  # Redis 客户端
+from queue_reaper import HEARTBEAT_PREFIX, PROCESSING_PREFIX, attempt_text, fail_attempt
+from tracing import format_traceparent, make_span, new_span_id, new_trace_id, parse_traceparent
 
 # ===================== 基本配置 =====================
 TASK_ZIP_DIR = "/home/pi/tasks"
 WORK_BASE_DIR = "/home/pi/task_manager/work"
 RESULT_DIR = "/home/pi/task_manager/results"
 LOG_FILE_PATH = "/home/pi/task_manager/client.log"
+DOCKER_STATE_DIR = "/home/pi/task_manager/docker"   # 镜像缓存的状态文件和锁
+VENV_CACHE_DIR = "/home/pi/task_manager/venvs"      # 本地执行用的 virtualenv 缓存
+DOWNLOAD_CACHE_DIR = "/home/pi/task_manager/downloads"   # 按 sha256 缓存下载过的任务包/依赖结果
+DATASET_CACHE_DIR = "/home/pi/task_manager/datasets"     # 解压好的共享数据集，按 sha256 分目录
 
 SERVER_URL = "http://192.168.12.201:5000"  # 管理端地址（master）
 API_BASE = "/pi_task"                      # 后端统一前缀
@@ -26,6 +46,12 @@ REDIS_HOST = "192.168.12.201"   # master 的 IP（跑 Redis 的那台）
 REDIS_PORT = 6379
 TASK_QUEUE_HIGH = "pi_task_high"      # 高优先级队列名，要和 master 保持一致
 TASK_QUEUE_NORMAL = "pi_task_normal"  # 普通优先级队列名
+TASK_DEAD_LETTER = "pi_task_dead"     # 死信队列
+
+# 可靠队列：取到的任务先挪进本槽位的处理中列表（键名见 queue_reaper），完成后再删；
+# 心跳过期后由 master 回收重新入队
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TTL = 60
 
 # 镜像源候选（会按顺序尝试）
 BASE_IMAGE_CANDIDATES = [
@@ -33,17 +59,64 @@ BASE_IMAGE_CANDIDATES = [
     "dockerproxy.net/library/python:3.11-slim-bookworm",  # 代理备选
 ]
 
-# 可选 PyPI 源（传空字符串则用官方）
-DEFAULT_PYPI_MIRROR = "https://pypi.tuna.tsinghua.edu.cn/simple"
-# 若你希望默认走官方，把上面改成 "" 即可
+# 执行槽位：默认每个 CPU 核一个，再按内存收紧（每个槽位至少 SLOT_MEMORY_MB）
+SLOT_MEMORY_MB = 512
+RESERVED_MEMORY_MB = 256   # 留给系统和 worker 主进程
+
+# 环境镜像缓存：按 Dockerfile + requirements.txt + 基础镜像 ID 的哈希打 tag，相同环境的任务直接复用
+ENV_IMAGE_REPO = "pi_task_env"
+ENV_IMAGE_LABEL = "pi_task_env=1"
+ENV_IMAGE_BUDGET_BYTES = 4 * 1024 ** 3   # 环境镜像总大小上限，超出按最近使用时间淘汰
+BASE_IMAGE_TTL = 24 * 3600               # 基础镜像最多每天 pull 一次
+
+# 本地执行：按 requirements 内容哈希缓存 virtualenv，最多保留 VENV_CACHE_MAX 个（LRU）
+VENV_CACHE_MAX = 8
+VENV_READY_MARKER = ".pi_task_ready"
+
+# 预热容器池：每个槽位为最近用过的镜像各留一个常驻容器，任务用 docker exec 注入，省掉 docker run 的创建/启动开销
+CONTAINER_POOL_ENABLED = True
+CONTAINER_POOL_LABEL = "pi_task_pool"
+CONTAINER_POOL_MAX_TASKS = 20    # 一个容器最多跑这么多任务就换新的，避免残留状态累积
+CONTAINER_POOL_MAX_IMAGES = 2    # 每个槽位最多为几个镜像保留常驻容器
+
+# 下载：流式写盘，断线后用 Range 续传；带 digest 的文件校验 sha256 后进本地缓存，重复投递的任务不再下载
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_CACHE_BYTES = 2 * 1024 ** 3    # 下载缓存总大小上限，超出按最近使用时间淘汰
+
+# 共享数据集：下载校验后解压成只读目录，任务的 input/<名字> 是指向它的符号链接；
+# 容器里把缓存目录以相同路径只读挂载，链接在容器内外都能用。正在被任务使用的数据集不会被淘汰
+DATASET_CACHE_BYTES = 32 * 1024 ** 3    # 解压后的总大小上限，超出按最近使用时间淘汰
+
+# 任务输出：逐行转发到 master（/task_log），本地只留每个流的最后几行写进 client.log 和失败消息
+TASK_LOG_BUFFER_LINES = 2000    # 等待发送的行数上限，master 跟不上时丢最旧的
+TASK_LOG_BATCH_LINES = 500
+TASK_LOG_FLUSH_SEC = 1.0
+TASK_LOG_LINE_MAX = 4096        # 超长的行按这个长度切开
+OUTPUT_TAIL_LINES = 200
+TASK_RUN_TIMEOUT = 24 * 3600   # 任务进程最长运行时间（秒），超时杀掉并按失败处理
+WAIT_POLL_MAX_SEC = 0.5        # 等任务退出时轮询间隔的上限
+
+# 资源统计：容器任务读 cgroup v2（没有时退回 docker stats），本地任务用 wait4 的 rusage
+CGROUP_ROOT = "/sys/fs/cgroup"
+RESOURCE_SAMPLE_SEC = 1.0
+
+# PyPI 源：默认走 master 上的局域网缓存（缺的包由 master 从上游镜像拉一次）；
+# 改成空字符串则不指定：本地 venv 用 pip 自己的配置，Docker 构建用 Dockerfile 里的默认值
+DEFAULT_PYPI_MIRROR = f"{SERVER_URL}{API_BASE}/pypi/simple/"
+PIP_TRUSTED_HOST = urlparse(SERVER_URL).hostname if SERVER_URL.startswith("http://") else ""
 
 os.makedirs(TASK_ZIP_DIR, exist_ok=True)
 os.makedirs(WORK_BASE_DIR, exist_ok=True)
 os.makedirs(RESULT_DIR, exist_ok=True)
+os.makedirs(DOCKER_STATE_DIR, exist_ok=True)
+os.makedirs(os.path.join(VENV_CACHE_DIR, "locks"), exist_ok=True)
+os.makedirs(DOWNLOAD_CACHE_DIR, exist_ok=True)
+os.makedirs(DATASET_CACHE_DIR, exist_ok=True)
 
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s %(levelname)s: %(message)s",
+    format="%(asctime)s %(levelname)s [%(processName)s]: %(message)s",
     handlers=[logging.FileHandler(LOG_FILE_PATH), logging.StreamHandler()]
 )
 logger = logging.getLogger("client")
@@ -55,10 +128,46 @@ def log(msg):
 rds = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
 
 
+# ===================== HTTP 会话 =====================
+_http = threading.local()
+
+def http_session():
+    """每个线程一个长连接 Session（连接池复用到 master 的 TCP 连接）；fork 出来的槽位进程重新建。"""
+    session = getattr(_http, "session", None)
+    if session is None or _http.pid != os.getpid():
+        session = requests.Session()
+        _http.session, _http.pid = session, os.getpid()
+    return session
+
+
 # ===================== 上报工具函数 =====================
-def report(task_id, phase=None, msg=None, progress=None, status=None):
-    """向后端上报任务阶段/状态。status 可省略，后端会按 phase 推导。"""
-    payload = {}
+# report() 只把状态放进内存队列，由后台线程批量 POST 到 /report_status_batch，任务执行从不等 master。
+# 同一任务同一阶段的连续更新合并成一条（只保留最新的进度/消息）；队列满时丢最旧的。
+REPORT_QUEUE_SIZE = 1000
+REPORT_BATCH_SIZE = 50
+REPORT_LINGER_SEC = 0.2      # 取到第一条后再等这么久，把紧跟着的更新攒进同一批
+REPORT_RETRIES = 3
+
+_reporter = {"pid": None, "queue": None}
+_reporter_lock = threading.Lock()
+
+def _report_queue():
+    """每个进程一个上报队列和线程（fork 出来的槽位进程里线程不会被继承，第一次上报时再启动）。"""
+    if _reporter["pid"] != os.getpid():
+        with _reporter_lock:
+            if _reporter["pid"] != os.getpid():
+                q = queue.Queue(maxsize=REPORT_QUEUE_SIZE)
+                threading.Thread(target=_report_loop, args=(q,), name="reporter", daemon=True).start()
+                _reporter["queue"], _reporter["pid"] = q, os.getpid()
+    return _reporter["queue"]
+
+
+def report(task_id, phase=None, msg=None, progress=None, status=None, metrics=None):
+    """向后端上报任务阶段/状态（异步，不阻塞）。status 可省略，后端会按 phase 推导。
+
+    metrics: 任务结束时附带的阶段耗时和资源用量（见 collect_metrics）。
+    """
+    payload = {"task_id": task_id}
     if phase is not None:
         payload["phase"] = phase
     if msg is not None:
@@ -67,15 +176,428 @@ def report(task_id, phase=None, msg=None, progress=None, status=None):
         payload["progress"] = progress
     if status is not None:
         payload["status"] = status
+    if metrics is not None:
+        payload["metrics"] = metrics
+    q = _report_queue()
+    while True:
+        try:
+            q.put_nowait(payload)
+            return
+        except queue.Full:
+            try:
+                dropped = q.get_nowait()
+                q.task_done()
+                log(f"Report queue full, dropped update for {dropped['task_id']} ({dropped.get('phase')})")
+            except queue.Empty:
+                pass
+
+
+def _coalesce(updates):
+    """相邻的同任务同阶段更新合并，后来的字段覆盖前面的。"""
+    merged = []
+    for update in updates:
+        last = merged[-1] if merged else None
+        if last and last["task_id"] == update["task_id"] and last.get("phase") == update.get("phase"):
+            last.update(update)
+        else:
+            merged.append(dict(update))
+    return merged
+
+
+def _post_reports(updates):
+    session = http_session()
+    resp = session.post(f"{SERVER_URL}{API_BASE}/report_status_batch", json={"updates": updates}, timeout=10)
+    if resp.status_code == 404 and not resp.headers.get("Content-Type", "").startswith("application/json"):
+        # 旧版 master 没有批量接口，逐条发
+        for update in updates:
+            payload = {k: v for k, v in update.items() if k != "task_id"}
+            session.post(f"{SERVER_URL}{API_BASE}/report_status/{update['task_id']}",
+                         json=payload, timeout=10).raise_for_status()
+        return
+    resp.raise_for_status()
+    for result in resp.json().get("results", []):
+        if result.get("code") != 200:
+            log(f"Report status for {result.get('task_id')} rejected: {result.get('error')}")
+
+
+def _report_loop(q):
+    while True:
+        batch = [q.get()]
+        deadline = time.monotonic() + REPORT_LINGER_SEC
+        while len(batch) < REPORT_BATCH_SIZE:
+            try:
+                batch.append(q.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        updates = _coalesce(batch)
+        for attempt in range(1, REPORT_RETRIES + 1):
+            try:
+                _post_reports(updates)
+                log(f"Reported {len(updates)} status update(s): "
+                    + ", ".join(f"{u['task_id']}:{u.get('phase')}" for u in updates))
+                break
+            except Exception as e:
+                log(f"Report status failed (attempt {attempt}/{REPORT_RETRIES}): {e}")
+                if attempt < REPORT_RETRIES:
+                    time.sleep(attempt)
+        for _ in batch:
+            q.task_done()
+
+
+def flush_reports(timeout=10):
+    """等上报队列发完（进程退出前调用），最多等 timeout 秒。"""
+    q = _reporter["queue"]
+    if q is None or _reporter["pid"] != os.getpid():
+        return
+    deadline = time.monotonic() + timeout
+    while q.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+
+# ===================== 任务输出转发 =====================
+class _LogShipper:
+    """一个任务的输出发送线程：读线程 add() 进有界缓冲，每 TASK_LOG_FLUSH_SEC 秒或攒够一批 POST 一次。"""
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.buffer = collections.deque(maxlen=TASK_LOG_BUFFER_LINES)
+        self.dropped = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name=f"log-{task_id}", daemon=True)
+        self.thread.start()
+
+    def add(self, stream, line):
+        with self.lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append({"stream": stream, "line": line})
+            full = len(self.buffer) >= TASK_LOG_BATCH_LINES
+        if full:
+            self.wake.set()
+
+    def _take(self):
+        with self.lock:
+            lines = [self.buffer.popleft() for _ in range(min(len(self.buffer), TASK_LOG_BATCH_LINES))]
+            dropped, self.dropped = self.dropped, 0
+        return lines, dropped
+
+    def _send(self):
+        while True:
+            lines, dropped = self._take()
+            if not lines and not dropped:
+                return
+            try:
+                http_session().post(f"{SERVER_URL}{API_BASE}/task_log/{self.task_id}",
+                                    json={"lines": lines, "dropped": dropped}, timeout=10).raise_for_status()
+            except Exception as e:
+                # 不重试：这一批丢掉，输出尾部仍会写进 client.log
+                log(f"Failed to ship output of task {self.task_id}: {e}")
+                return
+
+    def _loop(self):
+        while True:
+            self.wake.wait(TASK_LOG_FLUSH_SEC)
+            self.wake.clear()
+            closing = self.closed
+            self._send()
+            if closing:
+                return
+
+    def close(self, timeout=15):
+        self.closed = True
+        self.wake.set()
+        self.thread.join(timeout)
+
+
+def _pump_output(pipe, stream, shipper, tail):
+    for line in iter(lambda: pipe.readline(TASK_LOG_LINE_MAX), ""):
+        line = line.rstrip("\n")
+        tail.append(line)
+        shipper.add(stream, line)
+    pipe.close()
+
+
+def run_streaming(task_id, cmd, timeout=None, **kwargs):
+    """代替 subprocess.run(capture_output=True)：输出逐行转发到 master，内存里只留每个流的最后 OUTPUT_TAIL_LINES 行。
+
+    返回 CompletedProcess，stdout/stderr 是这几行尾部。超过 timeout 秒时杀掉进程，
+    和 subprocess.run 一样抛 TimeoutExpired。
+    """
+    shipper = _LogShipper(task_id)
+    tails = {"stdout": collections.deque(maxlen=OUTPUT_TAIL_LINES),
+             "stderr": collections.deque(maxlen=OUTPUT_TAIL_LINES)}
     try:
-        r = requests.post(
-            f"{SERVER_URL}{API_BASE}/report_status/{task_id}",
-            json=payload,
-            timeout=5,
-        )
-        log(f"Report status ({phase}): {r.status_code}")
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, errors="replace", **kwargs)
+    except Exception:
+        shipper.close()
+        raise
+    readers = [threading.Thread(target=_pump_output, args=(pipe, name, shipper, tails[name]), daemon=True)
+               for pipe, name in ((proc.stdout, "stdout"), (proc.stderr, "stderr"))]
+    for t in readers:
+        t.start()
+    # 用 wait4 代替 proc.wait()，顺便拿到子进程（含它回收的子孙进程）的资源用量；
+    # WNOHANG 轮询才能在超时时停下来（间隔从 5ms 逐步放宽，短任务不会白等）
+    deadline = None if timeout is None else time.monotonic() + timeout
+    interval, timed_out = 0.005, False
+    while True:
+        pid, wait_status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        if deadline is not None and time.monotonic() >= deadline:
+            os.kill(proc.pid, signal.SIGKILL)   # 不用 proc.kill()：它会先 poll()，可能抢先回收掉进程
+            _, wait_status, rusage = os.wait4(proc.pid, 0)
+            timed_out = True
+            break
+        time.sleep(interval)
+        interval = min(interval * 2, WAIT_POLL_MAX_SEC)
+    proc.returncode = os.waitstatus_to_exitcode(wait_status)
+    for t in readers:
+        # 超时被杀时，留在后台的子孙进程可能还拿着管道，不能一直等
+        t.join(5 if timed_out else None)
+    shipper.close()
+    stdout, stderr = "\n".join(tails["stdout"]), "\n".join(tails["stderr"])
+    if timed_out:
+        raise subprocess.TimeoutExpired(cmd, timeout, output=stdout, stderr=stderr)
+    result = subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+    result.rusage = rusage
+    return result
+
+
+def _unbuffered_env():
+    """任务里的 python 输出到管道时默认整块缓冲，关掉才能逐行看到。"""
+    return dict(os.environ, PYTHONUNBUFFERED="1")
+
+
+# ===================== 阶段计时和资源统计 =====================
+# 每个任务一份：{"phases": {"download": 秒, "unpack": ..., "image": ..., "run": ..., "package": ..., "upload": ...},
+#               "cpu_user_sec", "cpu_sys_sec", "max_rss_bytes", "read_bytes", "write_bytes", "resource_source"}
+# 下载在预取线程、上传在上传线程，所以按 task_id 存在进程内的字典里，结束时随 cleanup 上报一起发给 master。
+_task_metrics = {}
+_task_metrics_lock = threading.Lock()
+
+def add_metrics(task_id, phases=None, **resources):
+    with _task_metrics_lock:
+        metrics = _task_metrics.setdefault(task_id, {"phases": {}})
+        for name, sec in (phases or {}).items():
+            metrics["phases"][name] = round(metrics["phases"].get(name, 0) + sec, 3)
+        metrics.update({k: v for k, v in resources.items() if v is not None})
+
+@contextlib.contextmanager
+def timed_phase(task_id, phase):
+    """记录一段代码的墙钟耗时，同一阶段多次进入（比如 exec 失败后 docker run 重跑）时累加；同时记一个同名 span。"""
+    t0 = time.monotonic()
+    try:
+        with trace_span(task_id, phase):
+            yield
+    finally:
+        add_metrics(task_id, phases={phase: time.monotonic() - t0})
+
+def collect_metrics(task_id):
+    """取走任务的统计，补上节点名和总耗时。"""
+    with _task_metrics_lock:
+        metrics = _task_metrics.pop(task_id, None)
+    if metrics is None:
+        return None
+    metrics["node"] = socket.gethostname()
+    metrics["total_sec"] = round(sum(metrics["phases"].values()), 3)
+    return metrics
+
+def _rusage_metrics(ru):
+    return {"cpu_user_sec": round(ru.ru_utime, 3), "cpu_sys_sec": round(ru.ru_stime, 3),
+            "max_rss_bytes": ru.ru_maxrss * 1024,                  # Linux 上 ru_maxrss 单位是 KB
+            "read_bytes": ru.ru_inblock * 512, "write_bytes": ru.ru_oublock * 512,
+            "resource_source": "rusage"}
+
+def _container_cgroup(container_id):
+    """容器的 cgroup v2 目录：systemd 驱动在 system.slice 下，cgroupfs 驱动在 docker/ 下。"""
+    for path in (os.path.join(CGROUP_ROOT, "system.slice", f"docker-{container_id}.scope"),
+                 os.path.join(CGROUP_ROOT, "docker", container_id)):
+        if os.path.exists(os.path.join(path, "cpu.stat")):
+            return path
+    return None
+
+def _read_cgroup(path):
+    """累计 CPU 时间、匿名内存（近似 RSS）和块设备读写字节数。"""
+    stats = {"read_bytes": 0, "write_bytes": 0}
+    with open(os.path.join(path, "cpu.stat")) as f:
+        for line in f:
+            key, value = line.split()
+            if key == "user_usec":
+                stats["cpu_user_sec"] = int(value) / 1e6
+            elif key == "system_usec":
+                stats["cpu_sys_sec"] = int(value) / 1e6
+    with open(os.path.join(path, "memory.stat")) as f:
+        for line in f:
+            key, value = line.split()
+            if key == "anon":
+                stats["rss_bytes"] = int(value)
+                break
+    try:
+        with open(os.path.join(path, "io.stat")) as f:
+            for line in f:
+                for field in line.split()[1:]:
+                    key, _, value = field.partition("=")
+                    if key == "rbytes":
+                        stats["read_bytes"] += int(value)
+                    elif key == "wbytes":
+                        stats["write_bytes"] += int(value)
+    except FileNotFoundError:
+        pass   # 没开 io 控制器
+    return stats
+
+_SIZE_UNITS = {"b": 1, "kb": 1000, "mb": 1000 ** 2, "gb": 1000 ** 3, "tb": 1000 ** 4,
+               "kib": 1024, "mib": 1024 ** 2, "gib": 1024 ** 3, "tib": 1024 ** 4}
+
+def _parse_size(text):
+    """docker stats 里的 "12.5MiB" / "1.2MB" / "0B"。"""
+    text = text.strip().lower()
+    number = text.rstrip("abcdefghijklmnopqrstuvwxyz")
+    return int(float(number) * _SIZE_UNITS.get(text[len(number):].strip(), 1)) if number else 0
+
+def _docker_stats(docker_cmd, container_id):
+    """没有 cgroup v2 时的退路：docker stats 只有内存和块 I/O 是累计/瞬时值，CPU 时间拿不到。"""
+    res = subprocess.run([docker_cmd, "stats", "--no-stream", "--format", "{{json .}}", container_id],
+                         capture_output=True, text=True, timeout=15)
+    if res.returncode != 0 or not res.stdout.strip():
+        return None
+    row = json.loads(res.stdout.strip().splitlines()[0])
+    read, _, write = row.get("BlockIO", "0B / 0B").partition("/")
+    return {"rss_bytes": _parse_size(row.get("MemUsage", "0B").split("/")[0]),
+            "read_bytes": _parse_size(read), "write_bytes": _parse_size(write or "0B")}
+
+class _ContainerSampler:
+    """任务运行期间每秒采一次容器的资源用量：CPU 和 I/O 取首尾差值，内存取采样到的峰值。
+
+    常驻容器（docker exec）以开始时的读数为起点；docker run 新建的容器以 0 为起点，
+    容器 ID 从 --cidfile 里读，--rm 容器退出后 cgroup 就没了，所以终点是最后一次采样。
+    """
+
+    def __init__(self, docker_cmd, container_id=None, cidfile=None):
+        self.docker_cmd = docker_cmd
+        self.container_id = container_id
+        self.cidfile = cidfile
+        self.baseline = None if container_id else {}
+        self.last = None
+        self.peak_rss = 0
+        self.source = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name="resource-sampler", daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        if self.container_id is None and self.cidfile and os.path.exists(self.cidfile):
+            with open(self.cidfile) as f:
+                self.container_id = f.read().strip() or None
+        if not self.container_id:
+            return None
+        try:
+            path = _container_cgroup(self.container_id)
+            if path:
+                self.source = "cgroup"
+                return _read_cgroup(path)
+            self.source = "docker_stats"
+            return _docker_stats(self.docker_cmd, self.container_id)
+        except (OSError, ValueError, subprocess.SubprocessError):
+            return None
+
+    def _record(self, stats):
+        if stats is None:
+            return
+        if self.baseline is None:
+            self.baseline = stats
+        self.last = stats
+        self.peak_rss = max(self.peak_rss, stats.get("rss_bytes", 0))
+
+    def _loop(self):
+        while True:
+            self._record(self._sample())
+            if self.stopping.wait(RESOURCE_SAMPLE_SEC):
+                return
+
+    def stop(self):
+        """停止采样，返回资源用量 dict（采不到时为空）。"""
+        self.stopping.set()
+        self.thread.join()
+        self._record(self._sample())
+        if self.last is None:
+            return {}
+        metrics = {"max_rss_bytes": self.peak_rss or None, "resource_source": self.source}
+        for key in ("cpu_user_sec", "cpu_sys_sec", "read_bytes", "write_bytes"):
+            if key in self.last:
+                metrics[key] = round(self.last[key] - self.baseline.get(key, 0), 3)
+        return metrics
+
+
+# ===================== 链路追踪 =====================
+# master 在任务消息里放了 traceparent（父 span 是 master 上的 submit）。worker 取到任务时开一个 worker.task span，
+# 从入队到被取走记成 queue_wait，每个 timed_phase 记成 worker.task 的子 span；下载/上传请求带上当前 span 的
+# traceparent 和 baggage: task.id=...。任务结束后把 span 一次性 POST 到 master 的 /traces/<task_id>。
+# span 用 master 的 tracing.make_span 生成（OTLP/JSON 命名）。
+TRACE_SERVICE = "pi-task-worker"
+_traces = {}                       # task_id -> {"trace_id", "root_id", "parent_id", "start", "spans"}
+_traces_lock = threading.Lock()
+_trace_local = threading.local()   # 当前线程所在的 (task_id, trace_id, span_id)
+
+def start_trace(task_msg):
+    """取到任务时调用。消息里没有 traceparent（旧版 master）时新开一个 trace。"""
+    task_id = task_msg["task_id"]
+    trace_id, parent_id = parse_traceparent(task_msg.get("traceparent")) or (new_trace_id(), None)
+    now = time.time()
+    spans = []
+    if parent_id and task_msg.get("enqueued_at"):
+        spans.append(make_span("queue_wait", trace_id, parent_id, task_msg["enqueued_at"], now,
+                               kind="SPAN_KIND_CONSUMER", service=TRACE_SERVICE,
+                               attributes={"task.id": task_id, "messaging.attempt": task_msg.get("attempts", 0) + 1}))
+    with _traces_lock:
+        _traces[task_id] = {"trace_id": trace_id, "root_id": new_span_id(), "parent_id": parent_id,
+                            "start": now, "spans": spans}
+
+@contextlib.contextmanager
+def trace_span(task_id, name):
+    with _traces_lock:
+        trace = _traces.get(task_id)
+    if trace is None:
+        yield
+        return
+    span_id, start, ok = new_span_id(), time.time(), False
+    previous = getattr(_trace_local, "current", None)
+    _trace_local.current = (task_id, trace["trace_id"], span_id)
+    try:
+        yield
+        ok = True
+    finally:
+        _trace_local.current = previous
+        span = make_span(name, trace["trace_id"], trace["root_id"], start, time.time(), ok=ok, span_id=span_id,
+                         attributes={"task.id": task_id}, service=TRACE_SERVICE)
+        with _traces_lock:
+            trace["spans"].append(span)
+
+def trace_headers():
+    """当前 span 的 traceparent / baggage 请求头，不在任何 span 里时为空。"""
+    current = getattr(_trace_local, "current", None)
+    if current is None:
+        return {}
+    task_id, trace_id, span_id = current
+    return {"traceparent": format_traceparent(trace_id, span_id), "baggage": f"task.id={task_id}"}
+
+def finish_trace(task_id, ok=True):
+    """结束 worker.task span，把这个任务的 span 发给 master；失败只记日志。"""
+    with _traces_lock:
+        trace = _traces.pop(task_id, None)
+    if trace is None:
+        return
+    root = make_span("worker.task", trace["trace_id"], trace["parent_id"], trace["start"], time.time(),
+                     ok=ok, span_id=trace["root_id"], service=TRACE_SERVICE,
+                     attributes={"task.id": task_id, "process.pid": os.getpid(),
+                                 "worker.process": multiprocessing.current_process().name})
+    try:
+        http_session().post(f"{SERVER_URL}{API_BASE}/traces/{task_id}",
+                            json={"spans": trace["spans"] + [root]}, timeout=10).raise_for_status()
     except Exception as e:
-        log(f"Report status failed: {e}")
+        log(f"Failed to send trace of task {task_id}: {e}")
 
 
 # ===================== 任务配置 =====================
@@ -92,11 +614,12 @@ def load_task_config(task_dir):
 # ===================== 结果上传 =====================
 def upload_result(task_id, result_zip_path):
     try:
+        # 请求体直接就是 zip 文件内容，requests 会边读边发，master 端也是边收边落盘
         with open(result_zip_path, "rb") as f:
-            files = {"file": f}
-            resp = requests.post(
+            resp = http_session().post(
                 f"{SERVER_URL}{API_BASE}/upload_result/{task_id}_result.zip",
-                files=files,
+                data=f,
+                headers={"Content-Type": "application/zip", **trace_headers()},
                 timeout=60,
             )
         log(f"Upload response: {resp.status_code} - {resp.text}")
@@ -106,25 +629,148 @@ def upload_result(task_id, result_zip_path):
         return False
 
 
+# ===================== 本地执行的 virtualenv 缓存 =====================
+def _normalize_requirements(text):
+    """去掉注释和空行、排序去重；只差顺序/注释的 requirements 共用同一个环境。"""
+    lines = {line.split("#", 1)[0].strip() for line in text.splitlines()}
+    lines.discard("")
+    return "".join(f"{line}\n" for line in sorted(lines))
+
+def _venv_key(requirements):
+    h = hashlib.sha256(f"{sys.version}\0{requirements}".encode())
+    return h.hexdigest()[:16]
+
+@contextlib.contextmanager
+def _venv_lock(key, exclusive=True, blocking=True):
+    """环境级别的锁：构建/删除拿排他锁，运行任务拿共享锁。非阻塞模式下拿不到锁时 yield False。"""
+    with open(os.path.join(VENV_CACHE_DIR, "locks", f"{key}.lock"), "a") as f:
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(f, flags if blocking else flags | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def ensure_venv(requirements):
+    """返回 (venv 目录, 是否新建)。同一份 requirements 只建一次，多个槽位同时需要时只有一个去建。"""
+    key = _venv_key(requirements)
+    venv_dir = os.path.join(VENV_CACHE_DIR, key)
+    marker = os.path.join(venv_dir, VENV_READY_MARKER)
+    with _venv_lock(key):
+        if os.path.exists(marker):
+            os.utime(marker)   # LRU 按 marker 的 mtime
+            return venv_dir, False
+
+        shutil.rmtree(venv_dir, ignore_errors=True)   # 上次没建完的残留
+        log(f"Creating virtualenv {venv_dir}")
+        subprocess.run([sys.executable, "-m", "venv", venv_dir], check=True, capture_output=True, text=True)
+        req_path = os.path.join(venv_dir, "requirements.txt")
+        with open(req_path, "w") as f:
+            f.write(requirements)
+        cmd = [os.path.join(venv_dir, "bin", "python"), "-m", "pip", "install", "--disable-pip-version-check",
+               "-r", req_path]
+        if DEFAULT_PYPI_MIRROR:
+            cmd += ["-i", DEFAULT_PYPI_MIRROR]
+        if PIP_TRUSTED_HOST:
+            cmd += ["--trusted-host", PIP_TRUSTED_HOST]
+        pip = subprocess.run(cmd, capture_output=True, text=True)
+        if pip.returncode == 0:
+            with open(marker, "w") as f:
+                f.write(time.strftime("%Y-%m-%d %H:%M:%S"))
+        else:
+            # 和 Dockerfile 里的 "|| true" 一样不直接判失败，但不标记完成，下一个任务会重建
+            tail = (pip.stderr or "").strip().splitlines()[-20:]
+            log("PIP INSTALL STDERR (tail):\n" + "\n".join(tail))
+    _gc_venvs(keep=key)
+    return venv_dir, True
+
+@contextlib.contextmanager
+def acquire_venv(requirements, attempts=3):
+    """准备好环境并在持有共享锁期间 yield (venv 目录, 是否新建)。
+
+    ensure_venv 释放排他锁之后、任务拿到共享锁之前，其他槽位的 LRU 清理可能正好把环境删掉；
+    所以先拿共享锁再确认环境还在，不在就重新构建。
+    """
+    key = _venv_key(requirements)
+    venv_dir = os.path.join(VENV_CACHE_DIR, key)
+    created = built = False
+    for _ in range(attempts):
+        with _venv_lock(key, exclusive=False):
+            marker = os.path.join(venv_dir, VENV_READY_MARKER)
+            if os.path.exists(marker):
+                os.utime(marker)   # LRU 按 marker 的 mtime
+            # pip 失败时不会有 marker，但刚建过的环境照样拿来跑（和 ensure_venv 的约定一致）
+            if os.path.exists(marker) or \
+                    (built and os.path.exists(os.path.join(venv_dir, "bin", "python"))):
+                yield venv_dir, created
+                return
+        _, built = ensure_venv(requirements)
+        created = created or built
+    raise RuntimeError(f"Virtualenv {venv_dir} was removed before it could be used")
+
+def _gc_venvs(keep):
+    """超过 VENV_CACHE_MAX 个时删掉最久没用的；正在被任务使用（持有共享锁）的跳过。"""
+    entries = []
+    for key in os.listdir(VENV_CACHE_DIR):
+        path = os.path.join(VENV_CACHE_DIR, key)
+        if key == "locks" or key == keep or not os.path.isdir(path):
+            continue
+        marker = os.path.join(path, VENV_READY_MARKER)
+        entries.append((os.path.getmtime(marker if os.path.exists(marker) else path), key, path))
+    excess = len(entries) + 1 - VENV_CACHE_MAX
+    for _, key, path in sorted(entries):
+        if excess <= 0:
+            break
+        with _venv_lock(key, blocking=False) as locked:
+            if not locked:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            log(f"Removed cached virtualenv {path}")
+            excess -= 1
+
+def prewarm_venv(spec):
+    """预先建好某类任务的环境：spec 是 requirements 文件路径，或逗号分隔的包名列表。"""
+    if os.path.exists(spec):
+        with open(spec) as f:
+            requirements = _normalize_requirements(f.read())
+    else:
+        requirements = _normalize_requirements(spec.replace(",", "\n"))
+    if not requirements:
+        return
+    venv_dir, created = ensure_venv(requirements)
+    log(f"Pre-warmed virtualenv {venv_dir} ({'created' if created else 'already cached'})")
+
+
 # ===================== 本地执行（非容器） =====================
 def run_native_task(task_id, task_dir):
     report(task_id, phase="container_started", msg="Starting native run", progress=45, status="running")
     try:
-        req_file = os.path.join(task_dir, "requirements.txt")
-        if os.path.exists(req_file):
-            report(task_id, phase="running", msg="Installing requirements (native)", progress=50)
-            subprocess.run(["pip3", "install", "-r", req_file], check=False)
-
-        main_file = os.path.join(task_dir, "main.py")
-        report(task_id, phase="running", msg="Executing main.py (native)", progress=60)
-        result = subprocess.run(
-            ["python3", main_file],
-            cwd=task_dir,
-            capture_output=True,
-            text=True
-        )
-        log(f"NATIVE STDOUT:\n{result.stdout}")
-        log(f"NATIVE STDERR:\n{result.stderr}")
+        with contextlib.ExitStack() as stack:
+            python_bin = "python3"
+            req_file = os.path.join(task_dir, "requirements.txt")
+            if os.path.exists(req_file):
+                with open(req_file) as f:
+                    requirements = _normalize_requirements(f.read())
+                if requirements:
+                    report(task_id, phase="running", msg="Preparing virtualenv (native)", progress=50)
+                    # 从拿到环境到任务结束一直持有共享锁，避免环境被其他槽位的 LRU 清理删掉
+                    with timed_phase(task_id, "venv"):
+                        venv_dir, created = stack.enter_context(acquire_venv(requirements))
+                    log(f"Task {task_id}: virtualenv {'created' if created else 'cache hit'}: {venv_dir}")
+                    python_bin = os.path.join(venv_dir, "bin", "python")
+
+            main_file = os.path.join(task_dir, "main.py")
+            report(task_id, phase="running", msg="Executing main.py (native)", progress=60)
+            with timed_phase(task_id, "run"):
+                result = run_streaming(task_id, [python_bin, main_file], timeout=TASK_RUN_TIMEOUT,
+                                       cwd=task_dir, env=_unbuffered_env())
+        add_metrics(task_id, **_rusage_metrics(result.rusage))
+        log(f"NATIVE STDOUT (tail):\n{result.stdout}")
+        log(f"NATIVE STDERR (tail):\n{result.stderr}")
 
         if result.returncode != 0:
             report(task_id, phase="completed_failed", msg=f"Native run exitcode={result.returncode}", status="failed")
@@ -179,64 +825,373 @@ def _select_base_image(docker_cmd):
             return base
     return None
 
-def run_docker_task(task_id, task_dir):
+# ---------- 镜像缓存 ----------
+@contextlib.contextmanager
+def _file_lock(name, lock_dir=DOCKER_STATE_DIR):
+    """跨槽位进程的互斥锁（flock），同一个镜像只让一个槽位去 pull/build。"""
+    with open(os.path.join(lock_dir, f"{name}.lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _update_docker_state(fn=None):
+    """读出 state.json，调用 fn(state) 修改后写回，返回 state；fn 为空时只读。"""
+    path = os.path.join(DOCKER_STATE_DIR, "state.json")
+    with _file_lock("state"):
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        state.setdefault("base", {})
+        state.setdefault("env_images", {})
+        if fn is not None:
+            fn(state)
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp, path)
+        return state
+
+def _image_id(docker_cmd, image):
+    res = subprocess.run([docker_cmd, "image", "inspect", "-f", "{{.Id}}", image],
+                         capture_output=True, text=True)
+    return res.stdout.strip() if res.returncode == 0 else None
+
+def _ensure_base_image(docker_cmd):
+    """返回 (基础镜像, 镜像 ID)。TTL 内直接用本地已有的；过期才重新 pull，全部失败时退回本地已有的候选。"""
+    with _file_lock("base"):
+        base = _update_docker_state()["base"]
+        if base.get("image") and time.time() - base.get("pulled_at", 0) < BASE_IMAGE_TTL:
+            image_id = _image_id(docker_cmd, base["image"])
+            if image_id:
+                return base["image"], image_id
+
+        base_image = _select_base_image(docker_cmd)
+        if base_image:
+            _update_docker_state(lambda st: st.update(base={"image": base_image, "pulled_at": time.time()}))
+        else:
+            base_image = next((c for c in BASE_IMAGE_CANDIDATES if _image_id(docker_cmd, c)), None)
+            if base_image is None:
+                return None, None
+            log(f"Base image pull failed, using local copy of {base_image}")
+        return base_image, _image_id(docker_cmd, base_image)
+
+def _env_hash(task_dir, base_image_id):
+    h = hashlib.sha256(base_image_id.encode())
+    for name in ("Dockerfile", "requirements.txt"):
+        path = os.path.join(task_dir, name)
+        h.update(b"\0" + name.encode() + b"\0")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()[:16]
+
+def _docker_build(docker_cmd, context_dir, tag, base_image, labels=()):
+    # 通过 --build-arg 把 BASE_IMAGE 和 PIP_INDEX_URL 传进 Dockerfile；基础镜像由 _ensure_base_image 管，不再 --pull
+    cmd = [docker_cmd, "build", "--build-arg", f"BASE_IMAGE={base_image}", "-t", tag]
+    if DEFAULT_PYPI_MIRROR:
+        cmd += ["--build-arg", f"PIP_INDEX_URL={DEFAULT_PYPI_MIRROR}",
+                "--build-arg", f"PIP_TRUSTED_HOST={PIP_TRUSTED_HOST}"]
+    for label in labels:
+        cmd += ["--label", label]
+    build = subprocess.run(cmd + ["."], cwd=context_dir, capture_output=True, text=True, env=_docker_env())
+    if build.returncode != 0:
+        tail = (build.stderr or "").strip().splitlines()[-30:]
+        log("DOCKER BUILD STDERR (tail):\n" + "\n".join(tail))
+    return build.returncode == 0
+
+def _touch_env_image(tag):
+    def touch(state):
+        state["env_images"][tag] = time.time()
+    _update_docker_state(touch)
+
+def _gc_env_images(docker_cmd, keep):
+    """环境镜像总大小超过 ENV_IMAGE_BUDGET_BYTES 时，按最近使用时间从旧到新删除（keep 除外）。
+
+    按各镜像的 Size 相加，共享的基础层会被重复计算，实际占用只会更小。
+    """
+    ls = subprocess.run([docker_cmd, "image", "ls", "--filter", f"label={ENV_IMAGE_LABEL}",
+                         "--format", "{{.Repository}}:{{.Tag}}"], capture_output=True, text=True)
+    if ls.returncode != 0:
+        return
+    sizes = {}
+    for tag in ls.stdout.split():
+        res = subprocess.run([docker_cmd, "image", "inspect", "-f", "{{.Size}}", tag], capture_output=True, text=True)
+        if res.returncode == 0:
+            sizes[tag] = int(res.stdout.strip() or 0)
+    total = sum(sizes.values())
+    if total <= ENV_IMAGE_BUDGET_BYTES:
+        return
+
+    last_used = _update_docker_state()["env_images"]
+    removed = []
+    for tag in sorted(sizes, key=lambda t: last_used.get(t, 0)):
+        if total <= ENV_IMAGE_BUDGET_BYTES:
+            break
+        if tag == keep:
+            continue
+        # 正在被其他槽位的容器使用时 rmi 会失败，跳过即可
+        if subprocess.run([docker_cmd, "rmi", tag], capture_output=True, text=True).returncode == 0:
+            total -= sizes[tag]
+            removed.append(tag)
+    if removed:
+        log(f"Removed {len(removed)} cached environment images: {', '.join(removed)}")
+        def forget(state):
+            for t in removed:
+                state["env_images"].pop(t, None)
+        _update_docker_state(forget)
+
+def _ensure_env_image(docker_cmd, task_id, task_dir, base_image, base_image_id):
+    """返回 (镜像 tag, 是否为本任务临时构建)，构建失败返回 (None, False)。
+
+    构建上下文只放 Dockerfile 和 requirements.txt——任务目录运行时会挂载到 /task，
+    这样代码不同、环境相同的任务得到同一个镜像。Dockerfile 依赖其他文件导致构建失败时，
+    退回到用完整任务目录构建一个一次性镜像。
+    """
+    tag = f"{ENV_IMAGE_REPO}:{_env_hash(task_dir, base_image_id)}"
+    with _file_lock(f"env-{tag.split(':')[1]}"):
+        if _image_id(docker_cmd, tag):
+            log(f"Environment image cache hit: {tag}")
+            _touch_env_image(tag)
+            return tag, False
+
+        report(task_id, phase="image_build", msg=f"Building environment image {tag} from {base_image}", progress=20)
+        with tempfile.TemporaryDirectory(dir=DOCKER_STATE_DIR) as ctx:
+            for name in ("Dockerfile", "requirements.txt"):
+                src = os.path.join(task_dir, name)
+                if os.path.exists(src):
+                    shutil.copy(src, ctx)
+            ok = _docker_build(docker_cmd, ctx, tag, base_image, labels=(ENV_IMAGE_LABEL,))
+        if ok:
+            _touch_env_image(tag)
+            _gc_env_images(docker_cmd, keep=tag)
+            return tag, False
+
+    log("Environment-only build failed, retrying with the full task directory as context")
+    tag = f"task_image_{task_id}"
+    if _docker_build(docker_cmd, task_dir, tag, base_image):
+        return tag, True
+    return None, False
+
+def _pull_registry_image(docker_cmd, task_id, image):
+    """拉取 master 集中构建的镜像（按 digest 引用，本地已有就不再拉）。"""
+    if _image_id(docker_cmd, image):
+        log(f"Registry image already present: {image}")
+        return True
+    report(task_id, phase="image_build", msg=f"Pulling prebuilt image {image}", progress=20, status="running")
+    with _file_lock("pull-" + hashlib.sha256(image.encode()).hexdigest()[:16]):
+        return bool(_image_id(docker_cmd, image)) or _docker_pull_with_retry(docker_cmd, image)
+
+# ---------- 预热容器池 ----------
+_pool = {}                # (镜像, 挂载目录) -> {"id", "cmd", "tasks", "last_used"}；只属于当前槽位进程
+_pool_lock = threading.Lock()
+_pool_owner = "default"   # 容器标签值，槽位重启时据此清理上一次留下的容器
+
+def _image_argv(docker_cmd, image):
+    """docker run 不带命令时镜像实际执行的 argv：Entrypoint + Cmd（和 docker 的拼法一样）。
+
+    常驻容器的入口点被换成了 sh，docker exec 要照这个 argv 执行，结果才和冷启动一致。
+    """
+    res = subprocess.run([docker_cmd, "image", "inspect", "-f", "{{json .Config}}", image],
+                         capture_output=True, text=True)
+    try:
+        config = (json.loads(res.stdout) if res.returncode == 0 else None) or {}
+    except ValueError:
+        config = {}
+    argv = (config.get("Entrypoint") or []) + (config.get("Cmd") or [])
+    return argv or ["python3", "main.py"]
+
+def _start_pool_container(docker_cmd, image, mount_dir):
+    """起一个常驻容器：挂载槽位工作目录（容器内外路径相同），主进程只是 sleep。"""
+    res = subprocess.run(
+        [docker_cmd, "run", "-d", "--label", f"{CONTAINER_POOL_LABEL}={_pool_owner}",
+         "-v", f"{mount_dir}:{mount_dir}", "-v", f"{DATASET_CACHE_DIR}:{DATASET_CACHE_DIR}:ro",
+         "--entrypoint", "sh", image,
+         "-c", "rm -rf /task; while :; do sleep 3600; done"],
+        capture_output=True, text=True, env=_docker_env()
+    )
+    if res.returncode != 0:
+        log(f"Failed to start pool container for {image}: {res.stderr.strip()[-300:]}")
+        return None
+    return {"id": res.stdout.strip(), "cmd": _image_argv(docker_cmd, image), "tasks": 0, "last_used": time.time()}
+
+def _container_running(docker_cmd, container_id):
+    res = subprocess.run([docker_cmd, "inspect", "-f", "{{.State.Running}}", container_id],
+                         capture_output=True, text=True)
+    return res.returncode == 0 and res.stdout.strip() == "true"
+
+def _remove_containers(docker_cmd, container_ids):
+    if container_ids:
+        subprocess.run([docker_cmd, "rm", "-f", *container_ids], capture_output=True, text=True)
+
+def _warm_pool_container(docker_cmd, image, mount_dir):
+    """后台补一个新容器，下一个同镜像的任务就能直接命中。"""
+    def warm():
+        container = _start_pool_container(docker_cmd, image, mount_dir)
+        if container is None:
+            return
+        with _pool_lock:
+            if (image, mount_dir) not in _pool:
+                _pool[(image, mount_dir)] = container
+                container = None
+        if container:
+            _remove_containers(docker_cmd, [container["id"]])
+    threading.Thread(target=warm, name="pool-warm", daemon=True).start()
+
+def _return_pool_container(docker_cmd, image, mount_dir, container, healthy):
+    container["tasks"] += 1
+    container["last_used"] = time.time()
+    if not healthy or container["tasks"] >= CONTAINER_POOL_MAX_TASKS:
+        _remove_containers(docker_cmd, [container["id"]])
+        _warm_pool_container(docker_cmd, image, mount_dir)
+        return
+    with _pool_lock:
+        _pool[(image, mount_dir)] = container
+        evicted = sorted(_pool, key=lambda k: _pool[k]["last_used"])[:-CONTAINER_POOL_MAX_IMAGES]
+        evicted_ids = [_pool.pop(k)["id"] for k in evicted]
+    _remove_containers(docker_cmd, evicted_ids)
+
+def reset_container_pool(owner):
+    """槽位启动时调用：记下自己的标签，删掉上一次（崩溃/断电）遗留的常驻容器。"""
+    global _pool_owner
+    _pool_owner = owner
     docker_cmd = _resolve_docker_path()
     if not docker_cmd:
-        msg = "Docker command not found in PATH"
-        log(msg)
-        report(task_id, phase="completed_failed", msg=msg, status="failed")
-        return False
+        return
+    ps = subprocess.run([docker_cmd, "ps", "-aq", "--filter", f"label={CONTAINER_POOL_LABEL}={owner}"],
+                        capture_output=True, text=True)
+    _remove_containers(docker_cmd, ps.stdout.split())
 
-    # 选基础镜像：先官方，失败再代理；都失败就直接判定失败
-    base_image = _select_base_image(docker_cmd)
+def shutdown_container_pool():
+    docker_cmd = _resolve_docker_path()
+    with _pool_lock:
+        ids = [c["id"] for c in _pool.values()]
+        _pool.clear()
+    if docker_cmd:
+        _remove_containers(docker_cmd, ids)
+
+def _run_in_container(docker_cmd, task_id, task_dir, docker_image, poolable=True):
+    """执行任务容器，返回 CompletedProcess。优先用常驻容器 docker exec，不行再 docker run --rm。"""
+    report(task_id, phase="container_started", msg="Starting container", progress=50)
+    t0 = time.monotonic()
+    mount_dir = os.path.dirname(task_dir)
+    container, hit = None, False
+    if CONTAINER_POOL_ENABLED and poolable:
+        with timed_phase(task_id, "container_start"):
+            with _pool_lock:
+                container = _pool.pop((docker_image, mount_dir), None)
+            hit = container is not None
+            if container is None:
+                container = _start_pool_container(docker_cmd, docker_image, mount_dir)
+
+    if container is not None:
+        ready = time.monotonic() - t0
+        log(f"Task {task_id}: {'pool hit' if hit else 'cold start'}, container ready in {ready:.2f}s")
+        report(task_id, phase="running", msg=f"Container running ({'pool hit' if hit else 'cold start'}, "
+                                             f"ready in {ready:.2f}s)", progress=70)
+        # 把 /task 指向本任务的目录，保持和 docker run -v task_dir:/task 一样的路径约定
+        sampler = _ContainerSampler(docker_cmd, container_id=container["id"])
+        try:
+            with timed_phase(task_id, "run"):
+                runres = run_streaming(
+                    task_id,
+                    [docker_cmd, "exec", "-e", "PYTHONUNBUFFERED=1", "-w", task_dir, container["id"],
+                     "sh", "-c", 'ln -sfn "$0" /task && cd /task && exec "$@"', task_dir, *container["cmd"]],
+                    timeout=TASK_RUN_TIMEOUT,
+                    env=_docker_env()
+                )
+        except subprocess.TimeoutExpired:
+            # 杀掉 docker exec 客户端不会停掉容器里的任务，整个容器删掉
+            _remove_containers(docker_cmd, [container["id"]])
+            raise
+        finally:
+            add_metrics(task_id, **sampler.stop())
+        # 125/126/127 既可能是 docker exec 本身没跑起来，也可能就是任务自己的退出码（子进程 command not found 等）。
+        # 只有容器已经不在运行时才认定是 exec 失败、丢掉容器冷启动重跑；否则任务已经跑过，不能再跑第二遍
+        if runres.returncode not in (125, 126, 127) or _container_running(docker_cmd, container["id"]):
+            _return_pool_container(docker_cmd, docker_image, mount_dir, container, healthy=runres.returncode == 0)
+            log(f"Task {task_id}: container exec finished in {time.monotonic() - t0:.2f}s")
+            return runres
+        log(f"Pool container {container['id'][:12]} unusable (exit {runres.returncode}), falling back to docker run")
+        _remove_containers(docker_cmd, [container["id"]])
+        t0 = time.monotonic()
+
+    report(task_id, phase="running", msg="Container running (cold start, docker run)", progress=70)
+    cidfile = os.path.join(tempfile.gettempdir(), f"pi_task_{task_id}_{os.getpid()}.cid")
+    sampler = _ContainerSampler(docker_cmd, cidfile=cidfile)
+    try:
+        with timed_phase(task_id, "run"):
+            runres = run_streaming(
+                task_id,
+                [docker_cmd, "run", "--rm", "--cidfile", cidfile, "-e", "PYTHONUNBUFFERED=1",
+                 "-v", f"{task_dir}:/task", "-v", f"{DATASET_CACHE_DIR}:{DATASET_CACHE_DIR}:ro",
+                 "-w", "/task", docker_image],
+                timeout=TASK_RUN_TIMEOUT,
+                cwd=task_dir,
+                env=_docker_env()
+            )
+    except subprocess.TimeoutExpired:
+        # 同上：docker run 客户端被杀后容器还在跑
+        with contextlib.suppress(OSError):
+            with open(cidfile) as f:
+                _remove_containers(docker_cmd, f.read().split())
+        raise
+    finally:
+        add_metrics(task_id, **sampler.stop())
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(cidfile)
+    log(f"Task {task_id}: cold start (docker run), finished in {time.monotonic() - t0:.2f}s")
+    return runres
+
+def _prepare_image(docker_cmd, task_id, task_dir, image=None):
+    """准备任务镜像，返回 (镜像, 是否用完即删)；失败时已上报 completed_failed，返回 (None, False)。"""
+    if image and _pull_registry_image(docker_cmd, task_id, image):
+        return image, False
+    if image:
+        log(f"Failed to pull prebuilt image {image}, building locally")
+
+    # 选基础镜像：TTL 内不重复 pull；先官方，失败再代理；都失败且本地也没有就判定失败
+    base_image, base_image_id = _ensure_base_image(docker_cmd)
     if not base_image:
         msg = "Failed to pull any base image candidates"
         log(msg)
         report(task_id, phase="completed_failed", msg=msg, status="failed")
+        return None, False
+
+    report(task_id, phase="image_build", msg=f"Preparing Docker image from {base_image}", progress=20, status="running")
+    docker_image, temporary = _ensure_env_image(docker_cmd, task_id, task_dir, base_image, base_image_id)
+    if docker_image is None:
+        report(task_id, phase="completed_failed",
+               msg=f"Docker build failed (base={base_image}). See client.log tail.",
+               status="failed")
+        return None, False
+    return docker_image, temporary
+
+def run_docker_task(task_id, task_dir, image=None):
+    """image: master 集中构建好的镜像引用（registry/repo@sha256:...），有则直接拉取运行，跳过本地构建。"""
+    docker_cmd = _resolve_docker_path()
+    if not docker_cmd:
+        msg = "Docker command not found in PATH"
+        log(msg)
+        report(task_id, phase="completed_failed", msg=msg, status="failed")
         return False
 
-    docker_image = f"task_image_{task_id}"
-
+    docker_image = None
+    temporary = False
     try:
-        report(task_id, phase="image_build", msg=f"Building Docker image from {base_image}", progress=20, status="running")
-
-        # 通过 --build-arg 把 BASE_IMAGE 和 PIP_INDEX_URL 传进 Dockerfile
-        build_cmd = [
-            docker_cmd, "build", "--pull",
-            "--build-arg", f"BASE_IMAGE={base_image}",
-            "--build-arg", f"PIP_INDEX_URL={DEFAULT_PYPI_MIRROR}",
-            "-t", docker_image, "."
-        ]
-
-        build = subprocess.run(
-            build_cmd,
-            cwd=task_dir,
-            capture_output=True,
-            text=True,
-            env=_docker_env()
-        )
-        if build.returncode != 0:
-            tail = (build.stderr or "").strip().splitlines()[-30:]
-            log("DOCKER BUILD STDERR (tail):\n" + "\n".join(tail))
-            report(task_id, phase="completed_failed",
-                   msg=f"Docker build failed (base={base_image}). See client.log tail.",
-                   status="failed")
+        with timed_phase(task_id, "image"):
+            docker_image, temporary = _prepare_image(docker_cmd, task_id, task_dir, image)
+        if docker_image is None:
             return False
 
-        report(task_id, phase="image_built", msg="Docker image built", progress=40)
-        report(task_id, phase="container_started", msg="Starting container", progress=50)
-
-        runres = subprocess.run(
-            [docker_cmd, "run", "--rm", "-v", f"{task_dir}:/task", docker_image],
-            cwd=task_dir,
-            capture_output=True,
-            text=True,
-            env=_docker_env()
-        )
-        report(task_id, phase="running", msg="Container running", progress=70)
+        report(task_id, phase="image_built", msg=f"Docker image ready: {docker_image}", progress=40)
+        runres = _run_in_container(docker_cmd, task_id, task_dir, docker_image, poolable=not temporary)
 
-        log(f"Docker STDOUT:\n{runres.stdout}")
-        log(f"Docker STDERR:\n{runres.stderr}")
+        log(f"Docker STDOUT (tail):\n{runres.stdout}")
+        log(f"Docker STDERR (tail):\n{runres.stderr}")
 
         if runres.returncode != 0:
             report(task_id, phase="completed_failed",
@@ -254,6 +1209,9 @@ def run_docker_task(task_id, task_dir):
         log(f"Exception during docker run: {e}")
         report(task_id, phase="completed_failed", msg=str(e), status="failed")
         return False
+    finally:
+        if temporary:
+            subprocess.run([docker_cmd, "rmi", "-f", docker_image], capture_output=True, text=True)
 
 
 # ===================== 打包 output 目录 =====================
@@ -270,120 +1228,682 @@ def _zip_output_dir(output_dir: Path, result_zip: Path):
 
 
 # ===================== 处理任务 ZIP（保持旧版逻辑） =====================
-def process_task_zip(zip_path):
+def _inject_dependency(dependency_zip, work_dir: Path):
+    """把上游任务的 result.zip 解到 input/ 下（保持 input/output/... 的目录结构）。"""
+    input_dir = work_dir / "input"
+    os.makedirs(input_dir, exist_ok=True)
+    with zipfile.ZipFile(dependency_zip, "r") as zip_ref:
+        zip_ref.extractall(input_dir)
+
+
+def _inject_input(input_zip, work_dir: Path, dest=""):
+    """任务消息 inputs 里的额外输入（map 分片、reduce 要汇总的各分片结果）解到工作目录下的 dest。"""
+    root = work_dir.resolve()
+    target = (root / dest).resolve()
+    if target != root and root not in target.parents:
+        raise ValueError(f"Input destination {dest!r} is outside the work directory")
+    os.makedirs(target, exist_ok=True)
+    with zipfile.ZipFile(input_zip, "r") as zip_ref:
+        zip_ref.extractall(target)
+
+
+def execute_task_zip(zip_path, dependency_zip=None, params=None, work_base=WORK_BASE_DIR, image=None, inputs=(),
+                     datasets=()):
+    """解压、执行并把 output/ 打包，返回 (task_id, work_dir, result_zip)。
+
+    image: 任务消息里带的预构建镜像；为空时用 task_config.json 里的 image（如有）。
+    inputs: [(本地 zip, 工作目录下的相对路径)]，解压完任务包后依次解到对应位置。
+    datasets: 任务消息里的 [{name, digest}]，链接到 input/<name>，执行期间不会被缓存淘汰。
+
+    失败时已经上报 completed_failed，result_zip 为 None；任务 zip / 依赖 zip 用完即删，
+    工作目录留给 finish_task 在上传后清理。
+    """
     task_file = Path(zip_path)
     if not task_file.name.endswith("_task.zip"):
-        return
+        return None
 
     task_id = task_file.stem.replace("_task", "")
-    work_dir = Path(WORK_BASE_DIR) / task_id
+    work_dir = Path(work_base) / task_id
     result_zip = Path(RESULT_DIR) / f"{task_id}_result.zip"
 
     log(f"Processing task: {task_id}")
     report(task_id, phase="queued", msg="Task queued on client", progress=0, status="running")
 
+    dataset_holds = []
     try:
-        os.makedirs(work_dir, exist_ok=True)
-        with zipfile.ZipFile(task_file, "r") as zip_ref:
-            zip_ref.extractall(work_dir)
-        log(f"Extracted task zip to {work_dir}")
+        with timed_phase(task_id, "unpack"):
+            os.makedirs(work_dir, exist_ok=True)
+            with zipfile.ZipFile(task_file, "r") as zip_ref:
+                zip_ref.extractall(work_dir)
+            log(f"Extracted task zip to {work_dir}")
+
+            if dependency_zip:
+                _inject_dependency(dependency_zip, work_dir)
+                log(f"Injected dependency result {dependency_zip} into {work_dir / 'input'}")
+
+            for input_zip, dest in inputs:
+                _inject_input(input_zip, work_dir, dest)
+                log(f"Injected input {os.path.basename(input_zip)} into {work_dir / dest}")
+
+            dataset_holds = _mount_datasets(datasets, work_dir)
+
+        # 批量提交时每个任务自己的参数，任务代码从 task_params.json 读取
+        if params is not None:
+            with open(work_dir / "task_params.json", "w") as f:
+                json.dump(params, f, indent=2)
 
         input_dir = work_dir / "input"
         if input_dir.exists() and not any(input_dir.iterdir()):
             msg = "Task requires input data, but input/ is empty"
             log(f"{msg}. Skipping.")
             report(task_id, phase="completed_failed", msg=msg, status="failed")
-            report(task_id, phase="cleanup", msg="Cleaning up")
-            return
+            return task_id, work_dir, None
 
         config = load_task_config(str(work_dir))
         use_docker = config.get("use_docker", True)
 
-        ok = run_docker_task(task_id, str(work_dir)) if use_docker else run_native_task(task_id, str(work_dir))
+        if use_docker:
+            ok = run_docker_task(task_id, str(work_dir), image or config.get("image"))
+        else:
+            ok = run_native_task(task_id, str(work_dir))
+        if not ok:
+            return task_id, work_dir, None
 
-        if ok:
-            report(task_id, phase="running", msg="Packaging result", progress=80)
-            output_dir = work_dir / "output"
+        report(task_id, phase="running", msg="Packaging result", progress=80)
+        output_dir = work_dir / "output"
+        with timed_phase(task_id, "package"):
             packed = _zip_output_dir(output_dir, result_zip)
-            if not packed:
-                msg = "No output files found after execution."
-                log(msg)
-                report(task_id, phase="completed_failed", msg=msg, status="failed")
-            else:
-                log(f"Packaged result to {result_zip}")
-                report(task_id, phase="running", msg="Uploading result", progress=90)
-                uploaded = upload_result(task_id, result_zip)
-                if uploaded:
-                    report(task_id, phase="completed_success", msg="Task finished and result uploaded", progress=100, status="success")
-                else:
-                    report(task_id, phase="completed_failed", msg="Result upload failed", status="failed")
+        if not packed:
+            msg = "No output files found after execution."
+            log(msg)
+            report(task_id, phase="completed_failed", msg=msg, status="failed")
+            return task_id, work_dir, None
 
-        report(task_id, phase="cleanup", msg="Cleaning up")
+        log(f"Packaged result to {result_zip}")
+        return task_id, work_dir, result_zip
     except Exception as e:
         log(f"Exception while processing task {task_id}: {e}")
         report(task_id, phase="completed_failed", msg=str(e), status="failed")
-        report(task_id, phase="cleanup", msg="Cleaning up after failure")
+        return task_id, work_dir, None
     finally:
-        try:
-            task_file.unlink(missing_ok=True)
-            shutil.rmtree(work_dir, ignore_errors=True)
-        finally:
-            log(f"Cleaned up task {task_id}")
+        task_file.unlink(missing_ok=True)
+        if dependency_zip:
+            Path(dependency_zip).unlink(missing_ok=True)
+        for input_zip, _ in inputs:
+            Path(input_zip).unlink(missing_ok=True)
+        for hold in dataset_holds:
+            hold.close()
+
+
+def finish_task(task_id, work_dir, result_zip):
+    """上传 execute_task_zip 打好的结果（若有），上报最终状态并清理工作目录。"""
+    uploaded = False
+    try:
+        if result_zip is not None:
+            report(task_id, phase="running", msg="Uploading result", progress=90)
+            with timed_phase(task_id, "upload"):
+                uploaded = upload_result(task_id, result_zip)
+            if uploaded:
+                report(task_id, phase="completed_success", msg="Task finished and result uploaded", progress=100, status="success")
+            else:
+                report(task_id, phase="completed_failed", msg="Result upload failed", status="failed")
+        report(task_id, phase="cleanup", msg="Cleaning up", metrics=collect_metrics(task_id))
+    except Exception as e:
+        log(f"Exception while finishing task {task_id}: {e}")
+        report(task_id, phase="completed_failed", msg=str(e), status="failed")
+        report(task_id, phase="cleanup", msg="Cleaning up after failure", metrics=collect_metrics(task_id))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        log(f"Cleaned up task {task_id}")
+        finish_trace(task_id, ok=uploaded)
+
+
+def process_task_zip(zip_path, dependency_zip=None, params=None, work_base=WORK_BASE_DIR):
+    """执行 + 上传 + 清理，一个任务从头跑到尾（不走流水线时使用）。"""
+    run = execute_task_zip(zip_path, dependency_zip, params, work_base)
+    if run:
+        finish_task(*run)
 
 
 # ===================== 从 master 下载任务 ZIP =====================
-def download_task_zip(task_zip_name: str) -> str:
+def _fetch_to(url, part_path, digest=None):
+    """把 url 流式下载到 part_path；中断后保留已下载部分，下次用 Range 接着下。返回文件的 sha256。"""
+    h = hashlib.sha256()
+    offset = 0
+    if os.path.exists(part_path):
+        with open(part_path, "rb") as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                h.update(chunk)
+                offset += len(chunk)
+
+    headers = trace_headers()
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        if digest:
+            headers["If-Range"] = f'"{digest}"'   # 服务端文件变了就整体重发
+    with http_session().get(url, headers=headers, stream=True, timeout=(10, 60)) as resp:
+        if resp.status_code == 416:
+            # 已下载部分不比服务端文件短，丢掉重来
+            os.unlink(part_path)
+            raise requests.exceptions.RequestException(f"Range not satisfiable at offset {offset}")
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            h = hashlib.sha256()
+            offset = 0
+        expected = resp.headers.get("X-Content-SHA256")
+        if digest and expected and expected != digest:
+            raise ValueError(f"Server digest {expected} does not match task message {digest}")
+        with open(part_path, "ab" if offset else "wb") as f:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                h.update(chunk)
+                f.write(chunk)
+    return h.hexdigest()
+
+
+def _fetch_verified(url, part_path, digest, label):
+    """带重试和断点续传地下载到 part_path，有 digest 时校验 sha256；重试用完后抛出异常。"""
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            actual = _fetch_to(url, part_path, digest)
+        except (requests.exceptions.RequestException, OSError) as e:
+            log(f"Download of {label} interrupted (attempt {attempt}/{DOWNLOAD_RETRIES}): {e}")
+            if attempt == DOWNLOAD_RETRIES:
+                raise  # 抛给上层，让任务重新入队
+            time.sleep(min(2 ** attempt, 30))
+            continue
+        if digest and actual != digest:
+            os.unlink(part_path)
+            log(f"Checksum mismatch for {label}: expected {digest}, got {actual}")
+            if attempt == DOWNLOAD_RETRIES:
+                raise ValueError(f"Checksum mismatch for {label}")
+            continue
+        return
+
+
+def _link_or_copy(src, dst):
+    """缓存文件硬链接到目标位置（任务结束删掉目标不影响缓存），跨文件系统时退回复制。"""
+    if os.path.exists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _gc_download_cache(keep=None):
+    """下载缓存超过 DOWNLOAD_CACHE_BYTES 时按 mtime（命中时会刷新）从旧到新删除。"""
+    entries = []
+    for name in os.listdir(DOWNLOAD_CACHE_DIR):
+        path = os.path.join(DOWNLOAD_CACHE_DIR, name)
+        if name == keep or name.endswith((".part", ".lock")):
+            continue
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= DOWNLOAD_CACHE_BYTES:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+            log(f"Evicted {os.path.basename(path)} from download cache")
+        except FileNotFoundError:
+            pass
+
+
+def _download_from_master(endpoint: str, zip_name: str, dest_dir: str = TASK_ZIP_DIR, digest: str = None) -> str:
+    """下载 master 上的文件到 dest_dir，返回本地路径。
+
+    digest 是任务消息里的 sha256：有的话先查本地缓存，下载完校验不一致则丢弃重下；
+    没有（旧版 master 的消息）时只做流式下载和断点续传。
     """
-    从 master 下载任务 zip 保存到本地 TASK_ZIP_DIR，返回本地路径。
+    url = f"{SERVER_URL}{API_BASE}/{endpoint}/{zip_name}"
+    local_path = os.path.join(dest_dir, zip_name)
+
+    if digest:
+        cached = os.path.join(DOWNLOAD_CACHE_DIR, digest)
+        lock = _file_lock(f"dl-{digest[:16]}", DOWNLOAD_CACHE_DIR)   # 多个槽位同时拿到同一个包时只下一次
+        part_path = cached + ".part"
+    else:
+        cached = None
+        lock = contextlib.nullcontext()
+        part_path = local_path + ".part"
+
+    with lock:
+        if cached and os.path.exists(cached):
+            os.utime(cached)
+            _link_or_copy(cached, local_path)
+            log(f"Using cached {zip_name} (sha256={digest[:12]})")
+            return local_path
+
+        log(f"Downloading {zip_name} from {url} to {local_path}")
+        _fetch_verified(url, part_path, digest, zip_name)
+
+        if cached:
+            os.replace(part_path, cached)
+            _link_or_copy(cached, local_path)
+        else:
+            os.replace(part_path, local_path)
+
+    if cached:
+        _gc_download_cache(keep=digest)
+    return local_path
+
+
+def download_task_zip(task_zip_name: str, dest_dir: str = TASK_ZIP_DIR, digest: str = None) -> str:
+    """
+    从 master 下载任务 zip 保存到本地 dest_dir（默认 TASK_ZIP_DIR），返回本地路径。
+    """
+    return _download_from_master("download_task", task_zip_name, dest_dir, digest)
+
+
+def download_dependency_zip(dependency_zip_name: str, dest_dir: str = TASK_ZIP_DIR, digest: str = None) -> str:
     """
-    url = f"{SERVER_URL}{API_BASE}/download_task/{task_zip_name}"
-    local_path = os.path.join(TASK_ZIP_DIR, task_zip_name)
+    下载上游任务的 result.zip（任务消息里的 dependency_zip），返回本地路径。
+    """
+    return _download_from_master("download_result", dependency_zip_name, dest_dir, digest)
+
 
-    log(f"Downloading task zip from {url} to {local_path}")
+def download_input_zip(input_zip_name: str, dest_dir: str = TASK_ZIP_DIR, digest: str = None) -> str:
+    """
+    下载任务消息 inputs 里引用的额外输入 zip，返回本地路径。
+    """
+    return _download_from_master("download_input", input_zip_name, dest_dir, digest)
+
+
+# ===================== 共享数据集 =====================
+_DATASET_NAME_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _tree_bytes(root):
+    total = 0
+    for dirpath, _dirs, files in os.walk(root):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def _chmod_tree(root, dir_mode, file_mode=None):
+    for dirpath, _dirs, files in os.walk(root):
+        os.chmod(dirpath, dir_mode)
+        if file_mode is not None:
+            for name in files:
+                os.chmod(os.path.join(dirpath, name), file_mode)
+
+
+def _remove_tree(root):
+    """只读目录树要先恢复目录的写权限才能删。"""
+    if os.path.isdir(root):
+        _chmod_tree(root, 0o755)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def _dataset_use_lock(digest):
+    """数据集的使用锁文件：任务执行期间持有共享锁，淘汰时拿不到排他锁就跳过。"""
+    return open(os.path.join(DATASET_CACHE_DIR, f"{digest}.use"), "a")
+
+
+def fetch_dataset(name, digest):
+    """确保数据集已解压在本地缓存里，返回缓存目录；没有时从 master 下载、校验 sha256 后解压。"""
+    if not _DIGEST_RE.match(digest or ""):
+        raise ValueError(f"Invalid dataset digest for {name!r}: {digest!r}")
+    path = os.path.join(DATASET_CACHE_DIR, digest)
+    with _file_lock(f"ds-{digest[:16]}", DATASET_CACHE_DIR):   # 多个槽位要同一个数据集时只下载一次
+        if os.path.isdir(path):
+            os.utime(path)
+            log(f"Using cached dataset {name} (sha256={digest[:12]})")
+            return path
+
+        url = f"{SERVER_URL}{API_BASE}/download_dataset/{digest}_dataset.zip"
+        part_path = path + ".part"
+        log(f"Downloading dataset {name} from {url}")
+        _fetch_verified(url, part_path, digest, f"dataset {name}")
+
+        tmp_dir = f"{path}.tmp{os.getpid()}"
+        _remove_tree(tmp_dir)   # 上次解压到一半就断电留下的
+        with zipfile.ZipFile(part_path, "r") as zip_ref:
+            zip_ref.extractall(tmp_dir)
+        size = _tree_bytes(tmp_dir)
+        with open(path + ".size", "w") as f:
+            f.write(str(size))
+        _chmod_tree(tmp_dir, 0o555, 0o444)
+        os.replace(tmp_dir, path)
+        os.unlink(part_path)
+    log(f"Cached dataset {name} (sha256={digest[:12]}, {size} bytes unpacked)")
+    _gc_dataset_cache(keep=digest)
+    return path
+
+
+def _gc_dataset_cache(keep=None):
+    """解压后的数据集总量超过 DATASET_CACHE_BYTES 时按 mtime（使用时会刷新）从旧到新淘汰，跳过正在使用的。"""
+    entries = []
+    for name in os.listdir(DATASET_CACHE_DIR):
+        path = os.path.join(DATASET_CACHE_DIR, name)
+        if not _DIGEST_RE.match(name) or not os.path.isdir(path):
+            continue
+        try:
+            with open(path + ".size") as f:
+                size = int(f.read())
+        except (OSError, ValueError):
+            size = _tree_bytes(path)
+        try:
+            entries.append((os.stat(path).st_mtime, size, name))
+        except FileNotFoundError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, digest in sorted(entries):
+        if total <= DATASET_CACHE_BYTES:
+            break
+        if digest == keep:
+            continue
+        with _dataset_use_lock(digest) as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            path = os.path.join(DATASET_CACHE_DIR, digest)
+            _remove_tree(path)
+            Path(path + ".size").unlink(missing_ok=True)
+        total -= size
+        log(f"Evicted dataset {digest[:12]} from dataset cache")
+
+
+def _mount_datasets(datasets, work_dir: Path):
+    """把任务用到的数据集链接到 input/<名字>，返回持有共享锁的锁文件，任务结束后关闭。"""
+    holds = []
+    try:
+        for dataset in datasets or ():
+            name, digest = dataset["name"], dataset["digest"]
+            if not _DATASET_NAME_RE.match(name) or name.startswith("."):
+                raise ValueError(f"Invalid dataset mount name {name!r}")
+            hold = _dataset_use_lock(digest)
+            holds.append(hold)
+            fcntl.flock(hold, fcntl.LOCK_SH)   # 先占住，再确认缓存还在（期间可能被别的槽位淘汰过）
+            path = fetch_dataset(name, digest)
+            link = work_dir / "input" / name
+            if link.exists() or link.is_symlink():
+                raise ValueError(f"input/{name} already exists in the task package")
+            os.makedirs(link.parent, exist_ok=True)
+            os.symlink(path, link)
+            log(f"Mounted dataset {name} (sha256={digest[:12]}) at {link}")
+    except BaseException:
+        for hold in holds:
+            hold.close()
+        raise
+    return holds
+
+
+# ===================== 执行槽位 =====================
+# 每个槽位内部是三段流水线：预取线程（BLPOP + 下载）-> 执行（槽位主线程）-> 上传线程。
+# 执行当前任务的同时下载下一个、上传上一个，短任务的吞吐取决于网络和 CPU 中较慢的那个，而不是两者之和。
+UPLOAD_QUEUE_SIZE = 2   # 等待上传的结果数上限，上传跟不上时执行阶段会被挡住
+
+def _total_memory_mb():
     try:
-        resp = requests.get(url, timeout=60)
-        resp.raise_for_status()  # 如果请求失败，会抛出异常
-    except requests.exceptions.RequestException as e:
-        log(f"Error downloading {task_zip_name} from {url}: {e}")
-        raise  # 抛给上层，让 main() 记录错误
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
 
-    with open(local_path, "wb") as f:
-        f.write(resp.content)
 
-    return local_path
+def default_slot_count():
+    """默认槽位数：CPU 核数，但不超过 (总内存 - 保留) / SLOT_MEMORY_MB，至少 1 个。"""
+    slots = os.cpu_count() or 1
+    mem_mb = _total_memory_mb()
+    if mem_mb:
+        slots = min(slots, (mem_mb - RESERVED_MEMORY_MB) // SLOT_MEMORY_MB)
+    return max(1, slots)
+
+
+def _slot_dirs(slot):
+    """每个槽位单独的下载目录和工作目录；不同任务依赖同一个上游结果时也不会互相覆盖/删除。"""
+    zip_dir = os.path.join(TASK_ZIP_DIR, f"slot{slot}")
+    work_base = os.path.join(WORK_BASE_DIR, f"slot{slot}")
+    os.makedirs(zip_dir, exist_ok=True)
+    os.makedirs(work_base, exist_ok=True)
+    return zip_dir, work_base
+
+
+def download_task_inputs(task_msg, zip_dir=TASK_ZIP_DIR):
+    """下载任务 zip，有依赖时再下载上游任务的 result.zip，再下载 inputs 里的额外输入、把用到的数据集放进缓存，
+    返回 (任务 zip, 依赖 zip 或 None, [(输入 zip, 解压位置)])，都是本地路径。"""
+    local_zip_path = download_task_zip(task_msg["task_zip"], zip_dir, task_msg.get("task_digest"))
+    dependency_zip = task_msg.get("dependency_zip")
+    local_dep_path = (download_dependency_zip(dependency_zip, zip_dir, task_msg.get("dependency_digest"))
+                      if dependency_zip else None)
+    local_inputs = [(download_input_zip(item["name"], zip_dir, item.get("digest")), item.get("dest", ""))
+                    for item in task_msg.get("inputs") or []]
+    for dataset in task_msg.get("datasets") or []:
+        fetch_dataset(dataset["name"], dataset["digest"])   # 提前进缓存，执行时直接链接
+    return local_zip_path, local_dep_path, local_inputs
+
+
+def _reserve_task(slot_rds, processing_key):
+    """先非阻塞地看高优队列，再阻塞等普通队列；取到的消息原子地挪进 processing_key。"""
+    raw = slot_rds.lmove(TASK_QUEUE_HIGH, processing_key, "LEFT", "RIGHT")
+    if raw is not None:
+        return TASK_QUEUE_HIGH, raw
+    raw = slot_rds.blmove(TASK_QUEUE_NORMAL, processing_key, 2, "LEFT", "RIGHT")
+    if raw is not None:
+        return TASK_QUEUE_NORMAL, raw
+    return None
 
 
-# ===================== 主循环 =====================
-def main():
-    log(f"Environment PATH: {os.environ.get('PATH')}")
-    log("Worker started, waiting for tasks from Redis (high + normal)...")
+def _release_task(slot_rds, processing_key, raw, task_msg=None, reason=None):
+    """任务处理完（无论成败）时从处理中列表删除。
 
-    while True:
+    带 reason 表示还没开始执行就出错了（比如下载失败）：重新放回队列头部，次数用完则进死信队列。
+    """
+    if reason is None:
+        slot_rds.lrem(processing_key, 1, raw)
+        return
+
+    task_msg, dead = fail_attempt(task_msg)
+    if dead:
+        target, phase = TASK_DEAD_LETTER, "dead_letter"
+    else:
+        target = TASK_QUEUE_HIGH if task_msg.get("priority") == "high" else TASK_QUEUE_NORMAL
+        phase = "requeued"
+    pipe = slot_rds.pipeline()
+    pipe.lrem(processing_key, 1, raw)
+    pipe.lpush(target, json.dumps(task_msg))
+    pipe.execute()
+    text = f"{reason}; {attempt_text(task_msg, dead)}"
+    log(f"Task {task_msg['task_id']}: {text}")
+    report(task_msg["task_id"], phase=phase, msg=text)
+
+
+def _heartbeat_loop(slot_rds, worker_id, info, stopped):
+    while not stopped.is_set():
+        try:
+            slot_rds.set(HEARTBEAT_PREFIX + worker_id, info, ex=HEARTBEAT_TTL)
+        except Exception as e:
+            log(f"Heartbeat failed: {e}")
+        stopped.wait(HEARTBEAT_INTERVAL)
+
+
+def _prefetch_loop(slot_rds, processing_key, zip_dir, ready, credits, stopping):
+    """取任务并下载输入。credits 限制已取出但还没执行完的任务数（= 1 + 预取深度）。"""
+    while not stopping():
+        if not credits.acquire(timeout=1):
+            continue
+        raw = task_msg = None
         try:
-            # 阻塞等待队列任务，优先从高优队列取
-            res = rds.blpop([TASK_QUEUE_HIGH, TASK_QUEUE_NORMAL], timeout=5)
+            res = _reserve_task(slot_rds, processing_key)
             if not res:
-                # 5 秒内没有任务，打印一条日志方便确认 worker 活着
-                log("No tasks in queue, waiting...")
+                credits.release()
                 continue
 
             queue_name, raw = res
-            queue_name = queue_name.decode("utf-8")
             task_msg = json.loads(raw.decode("utf-8"))
-            task_id = task_msg["task_id"]
-            task_zip_name = task_msg["task_zip"]
+            log(f"Got task from {queue_name}: task_id={task_msg['task_id']}, zip={task_msg['task_zip']}")
+            start_trace(task_msg)
 
-            log(f"Got task from {queue_name}: task_id={task_id}, zip={task_zip_name}")
+            with timed_phase(task_msg["task_id"], "download"):
+                local_zip_path, local_dep_path, local_inputs = download_task_inputs(task_msg, zip_dir)
+            ready.put((task_msg, raw, local_zip_path, local_dep_path, local_inputs))
+        except Exception as e:
+            credits.release()
+            log(f"Prefetch error: {e}")
+            if task_msg is not None:
+                collect_metrics(task_msg.get("task_id"))   # 任务会重新投递，这次的计时作废
+                finish_trace(task_msg.get("task_id"), ok=False)
+            if raw is not None:
+                try:
+                    if task_msg is None:
+                        slot_rds.lrem(processing_key, 1, raw)   # 无法解析的消息直接丢弃
+                    else:
+                        _release_task(slot_rds, processing_key, raw, task_msg, reason=f"Download failed: {e}")
+                except Exception as e2:
+                    log(f"Failed to release task: {e2}")
+            time.sleep(2)
+    ready.put(None)
 
-            # 1. 从 master 下载任务 zip 到本地
-            local_zip_path = download_task_zip(task_zip_name)
 
-            # 2. 复用原来的处理逻辑
-            process_task_zip(local_zip_path)
+def _upload_loop(uploads, release):
+    while True:
+        item = uploads.get()
+        if item is None:
+            return
+        run, raw = item
+        finish_task(*run)
+        release(raw)
+
+
+def slot_loop(slot, stop, prefetch=1):
+    """单个执行槽位：独立进程、独立 Redis 连接，一次只执行一个任务，最多再预取 prefetch 个。
+
+    收到 SIGTERM/SIGINT（或主进程置位 stop）后不再取新任务，已经取到的任务执行完、上传完再退出。
+    信号处理函数里只改本地标记，不碰 multiprocessing.Event 的锁。
+    """
+    signals = []
+    signal.signal(signal.SIGTERM, lambda *_: signals.append("TERM"))
+    signal.signal(signal.SIGINT, lambda *_: signals.append("INT"))
+    slot_rds = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+    zip_dir, work_base = _slot_dirs(slot)
+    reset_container_pool(f"slot{slot}")
+
+    # 每次启动用新的 worker_id；上一次意外退出留下的处理中列表由 master 在心跳过期后回收
+    worker_id = f"{socket.gethostname()}:slot{slot}:{os.getpid()}"
+    processing_key = PROCESSING_PREFIX + worker_id
+    info = json.dumps({"host": socket.gethostname(), "slot": slot, "pid": os.getpid(), "started_at": time.time()})
+
+    def release(raw):
+        try:
+            _release_task(slot_rds, processing_key, raw)
+        except Exception as e:
+            log(f"Failed to release task: {e}")
+
+    stopped = threading.Event()
+    ready = queue.Queue()
+    uploads = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    credits = threading.BoundedSemaphore(1 + max(prefetch, 0))
+    heartbeat = threading.Thread(target=_heartbeat_loop, args=(slot_rds, worker_id, info, stopped),
+                                 name=f"slot-{slot}-heartbeat", daemon=True)
+    prefetcher = threading.Thread(target=_prefetch_loop, name=f"slot-{slot}-prefetch", daemon=True,
+                                  args=(slot_rds, processing_key, zip_dir, ready, credits,
+                                        lambda: bool(signals) or stop.is_set()))
+    uploader = threading.Thread(target=_upload_loop, args=(uploads, release), name=f"slot-{slot}-upload", daemon=True)
+    heartbeat.start()
+    prefetcher.start()
+    uploader.start()
+    log(f"Slot {slot} started as {worker_id} (prefetch={prefetch}), waiting for tasks from Redis (high + normal)...")
 
+    while True:
+        item = ready.get()
+        if item is None:
+            break
+        task_msg, raw, local_zip_path, local_dep_path, local_inputs = item
+        try:
+            run = execute_task_zip(local_zip_path, local_dep_path, task_msg.get("params"), work_base,
+                                   task_msg.get("image"), local_inputs, task_msg.get("datasets"))
         except Exception as e:
             log(f"Worker loop error: {e}")
-            time.sleep(2)
+            run = None
+        finally:
+            credits.release()
+        if run:
+            uploads.put((run, raw))
+        else:
+            collect_metrics(task_msg.get("task_id"))
+            finish_trace(task_msg.get("task_id"), ok=False)
+            release(raw)
+
+    uploads.put(None)
+    uploader.join()
+    shutdown_container_pool()
+    flush_reports()
+    stopped.set()
+    try:
+        slot_rds.delete(HEARTBEAT_PREFIX + worker_id)
+    except Exception:
+        pass
+    log(f"Slot {slot} stopped")
+
+
+# ===================== 主循环 =====================
+def _start_slot(slot, stop, prefetch):
+    proc = multiprocessing.Process(target=slot_loop, args=(slot, stop, prefetch), name=f"slot-{slot}")
+    proc.start()
+    return proc
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pi task worker")
+    parser.add_argument("--slots", type=int, default=None,
+                        help="number of tasks to run concurrently (default: CPU cores, capped by memory)")
+    parser.add_argument("--prefetch", type=int, default=1,
+                        help="extra tasks each slot may reserve and download ahead of execution (0 disables)")
+    parser.add_argument("--no-warm-pool", action="store_true",
+                        help="start a fresh container per task instead of reusing warm pool containers")
+    parser.add_argument("--prewarm-venv", action="append", default=[], metavar="REQS",
+                        help="build the native-task virtualenv for a requirements file or comma-separated "
+                             "package list before taking tasks (repeatable)")
+    args = parser.parse_args(argv)
+
+    global CONTAINER_POOL_ENABLED
+    if args.no_warm_pool:
+        CONTAINER_POOL_ENABLED = False   # 槽位进程 fork 时继承
+    slots = args.slots if args.slots and args.slots > 0 else default_slot_count()
+
+    log(f"Environment PATH: {os.environ.get('PATH')}")
+    log(f"Worker started with {slots} execution slot(s)")
+
+    for spec in args.prewarm_venv:
+        try:
+            prewarm_venv(spec)
+        except Exception as e:
+            log(f"Failed to pre-warm virtualenv for {spec}: {e}")
+
+    stop = multiprocessing.Event()
+    signals = []
+    signal.signal(signal.SIGTERM, lambda *_: signals.append("TERM"))
+    signal.signal(signal.SIGINT, lambda *_: signals.append("INT"))
+
+    procs = {slot: _start_slot(slot, stop, args.prefetch) for slot in range(slots)}
+    while not signals:
+        # 槽位进程意外退出时重新拉起
+        for slot, proc in procs.items():
+            if not proc.is_alive():
+                log(f"Slot {slot} exited with code {proc.exitcode}, restarting")
+                procs[slot] = _start_slot(slot, stop, args.prefetch)
+        time.sleep(1)
+
+    log("Shutting down: waiting for in-flight tasks to finish...")
+    stop.set()
+    for proc in procs.values():
+        proc.join()
+    log("Worker stopped")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+# dataset_store.py - 共享数据集：在 master 上按内容哈希登记一次，任务包里只写引用
+#
+# 数据集是一个 zip（成员就是数据文件本身），上传到 /pi_task/datasets 后以 <sha256>_dataset.zip 存进
+# 内容寻址存储，相同内容只存一份。任务包的 task_config.json 里写：
+#     "datasets": {"images": "<sha256>", ...}
+# 提交任务时 master 检查引用的数据集都已登记，把 [{name, digest, size}] 放进任务消息；worker 下载校验后
+# 解压进本地的 LRU 缓存，任务的 input/<name> 是指向缓存目录的只读链接，同一节点重复使用不再走网络。
+# 数据集不受保留策略清理，只在 DELETE /pi_task/datasets/<sha256> 时删除。
+
+import re
+import time
+import zipfile
+
+from task_store import SQLiteStore
+
+DATASET_SUFFIX = "_dataset.zip"
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+_NAME_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+DATASET_SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    digest         TEXT PRIMARY KEY,
+    name           TEXT,
+    size           INTEGER NOT NULL,
+    unpacked_bytes INTEGER NOT NULL,
+    files          INTEGER NOT NULL,
+    created_at     REAL NOT NULL,
+    last_used      REAL
+);
+"""
+
+
+def dataset_artifact_name(digest):
+    return f"{digest}{DATASET_SUFFIX}"
+
+
+def parse_dataset_refs(config):
+    """task_config.json 的 datasets 字段 -> [(挂载名, sha256)]，按名字排序；格式不对时抛 ValueError。"""
+    refs = config.get("datasets") or {}
+    if not isinstance(refs, dict):
+        raise ValueError("task_config.json: datasets must map mount names to sha256 digests")
+    parsed = []
+    for name, digest in sorted(refs.items()):
+        if not _NAME_RE.match(name) or name.startswith("."):
+            raise ValueError(f"Invalid dataset mount name {name!r}")
+        if not isinstance(digest, str) or not _DIGEST_RE.match(digest):
+            raise ValueError(f"Dataset {name!r} must be referenced by its sha256 digest")
+        parsed.append((name, digest))
+    return parsed
+
+
+def inspect_dataset_zip(path):
+    """返回 (文件数, 解压后总字节数)；不是 zip 或没有文件时抛 ValueError。"""
+    try:
+        with zipfile.ZipFile(path) as zf:
+            infos = [i for i in zf.infolist() if not i.is_dir()]
+    except zipfile.BadZipFile:
+        raise ValueError("Dataset is not a valid zip file")
+    if not infos:
+        raise ValueError("Dataset zip contains no files")
+    return len(infos), sum(i.file_size for i in infos)
+
+
+class DatasetStore(SQLiteStore):
+    """数据集的元数据；内容本身在 ArtifactStore 里，名字为 <sha256>_dataset.zip。"""
+
+    SCHEMA = DATASET_SCHEMA
+
+    def register(self, digest, size, unpacked_bytes, files, name=None):
+        """重复登记同样的内容只更新说明，返回登记后的记录。"""
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO datasets (digest, name, size, unpacked_bytes, files, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(digest) DO UPDATE SET name = COALESCE(excluded.name, datasets.name)",
+                (digest, name or None, size, unpacked_bytes, files, time.time()),
+            )
+        return self.get(digest)
+
+    def mark_used(self, digests):
+        with self._conn() as conn:
+            conn.executemany("UPDATE datasets SET last_used = ? WHERE digest = ?",
+                             [(time.time(), d) for d in digests])
+
+    def delete(self, digest):
+        with self._conn() as conn:
+            return conn.execute("DELETE FROM datasets WHERE digest = ?", (digest,)).rowcount == 1
+
+    # ---------- 读取 ----------
+    def get(self, digest):
+        row = self._conn().execute("SELECT * FROM datasets WHERE digest = ?", (digest,)).fetchone()
+        return dict(row) if row else None
+
+    def list(self):
+        return [dict(r) for r in self._conn().execute("SELECT * FROM datasets ORDER BY created_at DESC").fetchall()]
@@ -0,0 +1,135 @@
+# event_hub.py - 任务状态事件广播（Redis Pub/Sub + Server-Sent Events）
+#
+# 每条事件只 PUBLISH 一次；每个 gunicorn worker 进程里只有一个订阅线程，
+# 再把事件分发到本进程内各个 SSE 连接的内存队列，打开再多的浏览器标签页也不会读盘。
+
+import json
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_SIZE = 256
+HEARTBEAT_SEC = 15
+
+
+def format_sse(event, name="status"):
+    data = json.dumps(event, ensure_ascii=False)
+    if "id" in event:
+        return f"id: {event['id']}\nevent: {name}\ndata: {data}\n\n"
+    return f"event: {name}\ndata: {data}\n\n"
+
+
+class EventHub:
+    def __init__(self, rds, channel):
+        self.rds = rds
+        self.channel = channel
+        self._subscribers = {}   # 本进程内的 SSE 连接: Queue -> task_id 过滤（None 表示全部）
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def publish(self, event):
+        """把事件广播给所有进程；Redis 不可用时只记日志，不影响上报本身。"""
+        try:
+            self.rds.publish(self.channel, json.dumps(event, ensure_ascii=False))
+        except Exception as e:
+            logger.warning(f"Failed to publish event for task {event.get('task_id')}: {e}")
+
+    def publish_many(self, events):
+        """批量广播，一次 pipeline 往返。"""
+        try:
+            pipe = self.rds.pipeline(transaction=False)
+            for event in events:
+                pipe.publish(self.channel, json.dumps(event, ensure_ascii=False))
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to publish {len(events)} events: {e}")
+
+    # ---------- 进程内订阅 ----------
+    def subscribe(self, task_id=None):
+        self._ensure_listener()
+        q = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers[q] = task_id
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.pop(q, None)
+
+    def _ensure_listener(self):
+        # 延迟到第一次订阅才启动，保证 gunicorn fork 之后每个 worker 各自有一个订阅线程
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name="event-hub", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.rds.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for msg in pubsub.listen():
+                    if msg.get("type") == "message":
+                        self._dispatch(json.loads(msg["data"]))
+            except Exception as e:
+                logger.warning(f"Event hub subscription lost: {e}")
+                time.sleep(2)
+
+    def _dispatch(self, event):
+        with self._lock:
+            if event.get("type") == "log":
+                # 任务输出只推给订阅了这个任务的连接，看板的全局事件流不收
+                targets = [q for q, task_id in self._subscribers.items() if task_id == event.get("task_id")]
+            else:
+                targets = [q for q, task_id in self._subscribers.items()
+                           if task_id is None or task_id == event.get("task_id")]
+        for q in targets:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # 客户端读得太慢：清空队列，让它自己重新同步一次
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait({"type": "resync"})
+
+    # ---------- SSE ----------
+    def stream(self, task_id=None, backlog=None, until=None, live=True):
+        """生成 SSE 文本流。
+
+        backlog: 先补发的历史事件（按 id 升序），订阅之后再取，避免中间漏事件。
+        until:   收到满足条件的事件后结束流，比如任务已经结束。
+        live:    为 False 时只补发历史事件，不再等待新事件。
+        """
+        q = self.subscribe(task_id) if live else None
+        try:
+            last_id = 0
+            for event in (backlog() if backlog else []):
+                last_id = event["id"]
+                yield format_sse(event)
+                if until and until(event):
+                    return
+            if not live:
+                return
+            while True:
+                try:
+                    event = q.get(timeout=HEARTBEAT_SEC)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event.get("type") == "resync":
+                    yield format_sse({}, name="resync")
+                    continue
+                if event.get("type") == "log":
+                    yield format_sse(event, name="log")
+                    continue
+                if event.get("id", 0) <= last_id:
+                    continue
+                yield format_sse(event)
+                if until and until(event):
+                    return
+        finally:
+            if q is not None:
+                self.unsubscribe(q)
@@ -1,27 +1,31 @@
 import os
-import shutil
-import tempfile
 import zipfile
 import textwrap
 
-def generate(task_dir, dep_zip_path):
-    # 解压依赖 zip
-    with tempfile.TemporaryDirectory() as tmpdir:
-        with zipfile.ZipFile(dep_zip_path, "r") as zip_ref:
-            zip_ref.extractall(tmpdir)
-        
-        key_path = os.path.join(tmpdir, "input", "key.bin")
-        enc_data_path = os.path.join(tmpdir, "input", "enc_data.bin")
-
-        if not os.path.exists(key_path) or not os.path.exists(enc_data_path):
+# 生成的代码有变化时加一，让 build_task 的模板缓存失效
+VERSION = 1
+
+def make_inputs(dep_zip_path):
+    """从 aes_enc 任务包里直接读出 key.bin 和 enc_data.bin，不解压整个包。"""
+    with zipfile.ZipFile(dep_zip_path, "r") as zip_ref:
+        names = set(zip_ref.namelist())
+        if "input/key.bin" not in names or "input/enc_data.bin" not in names:
             raise FileNotFoundError("Missing key.bin or enc_data.bin in dependency zip")
+        return {
+            "key.bin": zip_ref.read("input/key.bin"),
+            "enc_data.bin": zip_ref.read("input/enc_data.bin"),
+        }
 
-        os.makedirs(os.path.join(task_dir, "input"), exist_ok=True)
-        os.makedirs(os.path.join(task_dir, "output"), exist_ok=True)
+def generate(task_dir, dep_zip_path):
+    os.makedirs(os.path.join(task_dir, "input"), exist_ok=True)
+    os.makedirs(os.path.join(task_dir, "output"), exist_ok=True)
 
-        shutil.copy(key_path, os.path.join(task_dir, "input", "key.bin"))
-        shutil.copy(enc_data_path, os.path.join(task_dir, "input", "enc_data.bin"))
+    for name, data in make_inputs(dep_zip_path).items():
+        with open(os.path.join(task_dir, "input", name), "wb") as f:
+            f.write(data)
+    write_code(task_dir)
 
+def write_code(task_dir):
     # 写 main.py，使用 main() 函数结构
     main_code = textwrap.dedent("""\
         import os
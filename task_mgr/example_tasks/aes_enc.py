@@ -2,28 +2,37 @@ import os
 import secrets
 import textwrap
 from Crypto.Cipher import AES
-from Crypto.Random import get_random_bytes
 
-def generate(task_dir):
-    input_data = secrets.token_bytes(1024 * 1024)
-    key = get_random_bytes(32)  # 256-bit
-    iv = get_random_bytes(16)
+# 生成的代码有变化时加一，让 build_task 的模板缓存失效
+VERSION = 1
+
+def make_inputs(randbytes=secrets.token_bytes):
+    """返回 {input 下的文件名: 内容}。"""
+    input_data = randbytes(1024 * 1024)
+    key = randbytes(32)  # 256-bit
+    iv = randbytes(16)
 
     cipher = AES.new(key, AES.MODE_CBC, iv)
     pad_len = 16 - len(input_data) % 16
     padded_data = input_data + bytes([pad_len] * pad_len)
     encrypted = cipher.encrypt(padded_data)
 
+    return {
+        "data.bin": input_data,
+        "key.bin": key,
+        "enc_data.bin": iv + encrypted,
+    }
+
+def generate(task_dir):
     os.makedirs(os.path.join(task_dir, "input"), exist_ok=True)
     os.makedirs(os.path.join(task_dir, "output"), exist_ok=True)
 
-    with open(os.path.join(task_dir, "input", "data.bin"), "wb") as f:
-        f.write(input_data)
-    with open(os.path.join(task_dir, "input", "key.bin"), "wb") as f:
-        f.write(key)
-    with open(os.path.join(task_dir, "input", "enc_data.bin"), "wb") as f:
-        f.write(iv + encrypted)
+    for name, data in make_inputs().items():
+        with open(os.path.join(task_dir, "input", name), "wb") as f:
+            f.write(data)
+    write_code(task_dir)
 
+def write_code(task_dir):
     main_py_code = textwrap.dedent("""\
         import os
         from Crypto.Cipher import AES
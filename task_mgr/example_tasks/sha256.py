@@ -3,12 +3,21 @@ import secrets
 import json
 import textwrap
 
+# 生成的代码/配置有变化时加一，让 build_task 的模板缓存失效
+VERSION = 1
+
+def make_inputs(randbytes=secrets.token_bytes):
+    """返回 {input 下的文件名: 内容}。"""
+    return {"data.bin": randbytes(1024 * 1024)}  # 1MB random data
+
 def generate(task_dir):
     # 写入随机输入数据
-    input_path = os.path.join(task_dir, "input", "data.bin")
-    with open(input_path, "wb") as f:
-        f.write(secrets.token_bytes(1024 * 1024))  # 1MB random data
+    for name, data in make_inputs().items():
+        with open(os.path.join(task_dir, "input", name), "wb") as f:
+            f.write(data)
+    write_code(task_dir)
 
+def write_code(task_dir):
     # 写入 main.py，统一风格
     main_code = textwrap.dedent("""\
         import hashlib
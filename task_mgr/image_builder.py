@@ -0,0 +1,111 @@
+# image_builder.py - 在 master 上为 worker 的架构集中构建任务镜像，推到局域网 registry
+#
+# 各个 Pi 不再各自 pip install 一遍：镜像在 master 上用 docker buildx 交叉构建一次（--platform），
+# 推到局域网 registry（一个 registry:2 容器即可），任务包的 task_config.json 里记下
+# registry/仓库@sha256:... 形式的引用，worker 直接按 digest 拉取运行。
+#
+# registry 走 HTTP 时：buildx 的 builder 要在 buildkitd.toml 里把它配成 insecure，
+# worker 的 /etc/docker/daemon.json 要加 "insecure-registries"。
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import zipfile
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+BASE_IMAGE = "python:3.11-slim-bookworm"
+ENV_FILES = ("Dockerfile", "requirements.txt")
+
+
+class ImageBuildError(Exception):
+    pass
+
+
+class ImageBuilder:
+    def __init__(self, registry, platforms="linux/arm64", repo="pi_task_env", pip_index_url=""):
+        self.registry = registry
+        self.platforms = platforms
+        self.repo = repo
+        self.pip_index_url = pip_index_url
+        self.pip_trusted_host = urlparse(pip_index_url).hostname if pip_index_url.startswith("http://") else ""
+
+    def _docker(self):
+        docker_cmd = shutil.which("docker")
+        if not docker_cmd:
+            raise ImageBuildError("Docker command not found on master")
+        return docker_cmd
+
+    def env_tag(self, files):
+        """files: 文件名 -> 内容；相同的 Dockerfile + requirements + 平台得到同一个 tag。"""
+        h = hashlib.sha256(f"{BASE_IMAGE}\0{self.platforms}".encode())
+        for name in ENV_FILES:
+            h.update(b"\0" + name.encode() + b"\0" + files.get(name, b""))
+        return f"{self.registry}/{self.repo}:{h.hexdigest()[:16]}"
+
+    def _remote_digest(self, docker_cmd, tag):
+        """registry 里已有这个 tag 时返回它的 manifest digest，否则返回 None。"""
+        res = subprocess.run([docker_cmd, "buildx", "imagetools", "inspect", tag, "--format", "{{json .Manifest}}"],
+                             capture_output=True, text=True)
+        if res.returncode != 0:
+            return None
+        try:
+            return json.loads(res.stdout)["digest"]
+        except (ValueError, KeyError):
+            return None
+
+    def build(self, files, progress=None):
+        """构建并推送镜像，返回按 digest 固定的引用 registry/repo@sha256:...。"""
+        docker_cmd = self._docker()
+        tag = self.env_tag(files)
+        name = tag.rsplit(":", 1)[0]
+
+        digest = self._remote_digest(docker_cmd, tag)
+        if digest:
+            logger.info(f"Task image {tag} already in registry ({digest})")
+            return f"{name}@{digest}"
+
+        if progress:
+            progress(85, f"Building task image for {self.platforms}")
+        with tempfile.TemporaryDirectory() as tmp:
+            ctx = os.path.join(tmp, "context")
+            os.makedirs(ctx)
+            for filename, content in files.items():
+                with open(os.path.join(ctx, filename), "wb") as f:
+                    f.write(content)
+            metadata_path = os.path.join(tmp, "metadata.json")
+            cmd = [docker_cmd, "buildx", "build",
+                   "--platform", self.platforms,
+                   "--build-arg", f"BASE_IMAGE={BASE_IMAGE}",
+                   "--build-arg", f"PIP_INDEX_URL={self.pip_index_url}",
+                   "--build-arg", f"PIP_TRUSTED_HOST={self.pip_trusted_host}",
+                   "--metadata-file", metadata_path,
+                   "--push", "-t", tag, ctx]
+            res = subprocess.run(cmd, capture_output=True, text=True)
+            if res.returncode != 0:
+                tail = "\n".join((res.stderr or "").strip().splitlines()[-30:])
+                logger.error(f"buildx build for {tag} failed:\n{tail}")
+                raise ImageBuildError(f"Image build failed: {tail[-400:]}")
+            with open(metadata_path) as f:
+                digest = json.load(f).get("containerimage.digest")
+        if not digest:
+            raise ImageBuildError("buildx did not report an image digest")
+        logger.info(f"Pushed task image {tag} ({digest})")
+        return f"{name}@{digest}"
+
+    def build_for_zip(self, zip_path, progress=None):
+        """从任务包里取 Dockerfile / requirements.txt 构建镜像，返回镜像引用。"""
+        files = {}
+        with zipfile.ZipFile(zip_path) as zf:
+            names = set(zf.namelist())
+            for filename in ENV_FILES:
+                if filename in names:
+                    files[filename] = zf.read(filename)
+        if "Dockerfile" not in files:
+            raise ImageBuildError("Task package has no Dockerfile")
+        return self.build(files, progress)
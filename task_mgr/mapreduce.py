@@ -0,0 +1,219 @@
+# mapreduce.py - scatter/gather：一个自定义任务包按 input/ 切成 N 片分给多台 Pi 并行跑，再合并成一个结果
+#
+# 提交到 /pi_task/start_mapreduce 的任务包被拆成两部分：
+#   - 代码包：input/ 以外的所有文件，N 个 map 任务共用同一个 blob；
+#   - N 个分片包：input/ 下的文件按个数或字节数分成 N 份，每份存成 <map 任务 ID>_shard.zip，
+#     任务消息的 inputs 字段引用它，worker 下载后解到工作目录（文件仍在 input/ 下）。
+# map 任务从 task_params.json 读到 {"job_id", "shard", "shards"}。
+# 所有 map 任务都有结果后进入归约：
+#   - 任务包里有 reduce.py：用它替换 main.py 生成 reduce 任务包，各分片的结果解到 input/shard_XXXX/ 下，
+#     reduce 任务的结果就是整个作业的结果；
+#   - 没有 reduce.py：master 直接把各分片的 output/ 合并成 output/shard_XXXX/...。
+# 作业本身也登记成一个任务，进度、事件、结果下载都和普通任务一样，别的任务也可以用 dependency_id 依赖它。
+
+import os
+import time
+import zipfile
+
+from task_store import SQLiteStore, owner_gone
+from zip_copy import copy_member
+
+SPLIT_MODES = ("count", "bytes")
+REDUCE_SCRIPT = "reduce.py"
+INPUT_PREFIX = "input/"
+
+MAPREDUCE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mapreduce_jobs (
+    job_id         TEXT PRIMARY KEY,
+    shards         INTEGER NOT NULL,
+    split_by       TEXT NOT NULL,
+    has_reduce     INTEGER NOT NULL DEFAULT 0,
+    status         TEXT NOT NULL,
+    reduce_task_id TEXT,
+    reducer        TEXT,
+    message        TEXT,
+    created_at     REAL NOT NULL,
+    updated_at     REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mapreduce_tasks (
+    task_id  TEXT PRIMARY KEY,
+    job_id   TEXT NOT NULL,
+    shard    INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_mapreduce_tasks_job ON mapreduce_tasks(job_id, shard);
+"""
+
+REDUCE_SHARD = -1   # mapreduce_tasks.shard 为 -1 的是 reduce 任务
+
+
+def shard_dir(shard):
+    return f"shard_{shard:04d}"
+
+
+# ===================== 拆包 / 合并 =====================
+def plan_shards(infos, shards, split_by="count"):
+    """把 input/ 下的文件分成最多 shards 份，返回每份的 ZipInfo 列表（不会有空分片）。
+
+    count：按文件名排序后切成连续的几段，每段文件数相差不超过 1；
+    bytes：从大到小依次放进当前总字节数最小的分片，各分片大小尽量接近。
+    """
+    if split_by not in SPLIT_MODES:
+        raise ValueError(f"split_by must be one of {', '.join(SPLIT_MODES)}")
+    files = sorted(infos, key=lambda i: i.filename)
+    shards = max(1, min(shards, len(files)))
+    if split_by == "count":
+        base, extra = divmod(len(files), shards)
+        plan, start = [], 0
+        for i in range(shards):
+            end = start + base + (1 if i < extra else 0)
+            plan.append(files[start:end])
+            start = end
+        return plan
+
+    plan = [[] for _ in range(shards)]
+    totals = [0] * shards
+    for info in sorted(files, key=lambda i: i.file_size, reverse=True):
+        i = totals.index(min(totals))
+        plan[i].append(info)
+        totals[i] += info.file_size
+    return [sorted(p, key=lambda i: i.filename) for p in plan]
+
+
+def split_package(zip_path, shards, split_by, out_dir):
+    """把任务包拆成代码包和若干分片包，返回 (代码包路径, [分片包路径], 是否有 reduce.py)。
+
+    分片数不超过 input/ 下的文件数；input/ 为空时抛 ValueError。
+    """
+    with zipfile.ZipFile(zip_path) as zin:
+        infos = zin.infolist()
+        names = {i.filename for i in infos}
+        inputs = [i for i in infos if i.filename.startswith(INPUT_PREFIX) and not i.is_dir()]
+        if "main.py" not in names:
+            raise ValueError("Task package must contain main.py in the root directory")
+        if not inputs:
+            raise ValueError("Task package has no files under input/ to split")
+
+        code_path = os.path.join(out_dir, "code.zip")
+        with zipfile.ZipFile(code_path, "w") as zout:
+            for info in infos:
+                if not info.filename.startswith(INPUT_PREFIX):
+                    copy_member(zin, info, zout, info.filename)
+
+        shard_paths = []
+        for n, members in enumerate(plan_shards(inputs, shards, split_by)):
+            path = os.path.join(out_dir, f"{shard_dir(n)}.zip")
+            with zipfile.ZipFile(path, "w") as zout:
+                for info in members:
+                    copy_member(zin, info, zout, info.filename)
+            shard_paths.append(path)
+    return code_path, shard_paths, REDUCE_SCRIPT in names
+
+
+def make_reduce_package(code_path, out_path):
+    """reduce 任务包：代码包里的 reduce.py 换成 main.py，镜像/依赖和 map 任务完全相同。"""
+    with zipfile.ZipFile(code_path) as zin, zipfile.ZipFile(out_path, "w") as zout:
+        for info in zin.infolist():
+            if info.filename == "main.py":
+                continue
+            if info.filename == REDUCE_SCRIPT:
+                copy_member(zin, info, zout, "main.py")
+            else:
+                copy_member(zin, info, zout, info.filename)
+
+
+def merge_results(result_paths, out_path):
+    """没有 reduce.py 时由 master 合并：第 i 个分片的 output/xxx 放到 output/shard_000i/xxx。"""
+    with zipfile.ZipFile(out_path, "w") as zout:
+        zout.writestr("output/", b"")
+        for shard, path in enumerate(result_paths):
+            with zipfile.ZipFile(path) as zin:
+                for info in zin.infolist():
+                    rel = info.filename[len("output/"):] if info.filename.startswith("output/") else info.filename
+                    if not rel or info.is_dir():
+                        continue
+                    copy_member(zin, info, zout, f"output/{shard_dir(shard)}/{rel}")
+
+
+# ===================== 作业登记 =====================
+class MapReduceJobs(SQLiteStore):
+    """作业状态：mapping -> reducing -> done，任一分片最终失败则为 failed。
+
+    状态迁移用带条件的 UPDATE，多个 gunicorn worker 同时收到最后几个分片的结果时只有一个会去做归约。
+    归约在进入 reducing 的那个进程的后台线程里执行，reducer 记下是哪个进程；
+    它在提交 reduce 任务/合并完之前退出的话，由别的进程用 reclaim_reduce 接手重做。
+    """
+
+    SCHEMA = MAPREDUCE_SCHEMA
+
+    def create(self, job_id, map_task_ids, split_by, has_reduce):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO mapreduce_jobs (job_id, shards, split_by, has_reduce, status, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, 'mapping', ?, ?)",
+                (job_id, len(map_task_ids), split_by, int(bool(has_reduce)), now, now),
+            )
+            conn.executemany("INSERT INTO mapreduce_tasks (task_id, job_id, shard) VALUES (?, ?, ?)",
+                             [(task_id, job_id, n) for n, task_id in enumerate(map_task_ids)])
+
+    def add_reduce_task(self, job_id, task_id):
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO mapreduce_tasks (task_id, job_id, shard) VALUES (?, ?, ?)",
+                         (task_id, job_id, REDUCE_SHARD))
+            conn.execute("UPDATE mapreduce_jobs SET reduce_task_id = ?, updated_at = ? WHERE job_id = ?",
+                         (task_id, time.time(), job_id))
+
+    def transition(self, job_id, from_status, to_status, message=None, reducer=None):
+        """仅当作业当前处于 from_status 时改成 to_status，返回是否由本次调用完成了迁移。"""
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE mapreduce_jobs SET status = ?, message = COALESCE(?, message),"
+                " reducer = COALESCE(?, reducer), updated_at = ? WHERE job_id = ? AND status = ?",
+                (to_status, message, reducer, time.time(), job_id, from_status),
+            )
+            return cur.rowcount == 1
+
+    def reclaim_reduce(self, job, reducer):
+        """job 停在 reducing、还没有 reduce 任务、负责归约的进程也已经不在时，改由 reducer 接手。
+
+        返回是否接手成功；条件更新保证多个进程同时发现时只有一个会重做。
+        """
+        if job["status"] != "reducing" or job["reduce_task_id"] or not owner_gone(job["reducer"]):
+            return False
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE mapreduce_jobs SET reducer = ?, updated_at = ?"
+                " WHERE job_id = ? AND status = 'reducing' AND reduce_task_id IS NULL AND reducer IS ?",
+                (reducer, time.time(), job["job_id"], job["reducer"]),
+            )
+            return cur.rowcount == 1
+
+    # ---------- 读取 ----------
+    def job_of(self, task_id):
+        """task_id 是某个作业的 map / reduce 任务时返回 (job_id, shard)，否则返回 None。"""
+        row = self._conn().execute("SELECT job_id, shard FROM mapreduce_tasks WHERE task_id = ?",
+                                   (task_id,)).fetchone()
+        return (row["job_id"], row["shard"]) if row else None
+
+    def get(self, job_id):
+        row = self._conn().execute("SELECT * FROM mapreduce_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row, has_reduce=bool(row["has_reduce"]))
+        rows = self._conn().execute(
+            "SELECT task_id FROM mapreduce_tasks WHERE job_id = ? AND shard >= 0 ORDER BY shard", (job_id,)
+        ).fetchall()
+        job["map_task_ids"] = [r["task_id"] for r in rows]
+        return job
+
+    def reducing_job_ids(self):
+        return [r["job_id"] for r in
+                self._conn().execute("SELECT job_id FROM mapreduce_jobs WHERE status = 'reducing'").fetchall()]
+
+    def pinned_task_ids(self):
+        """还没归约完的作业的 map 任务，它们的结果不能被保留策略清理。"""
+        rows = self._conn().execute(
+            "SELECT t.task_id FROM mapreduce_tasks t JOIN mapreduce_jobs j ON j.job_id = t.job_id"
+            " WHERE j.status IN ('mapping', 'reducing') AND t.shard >= 0"
+        ).fetchall()
+        return {r["task_id"] for r in rows}
@@ -0,0 +1,145 @@
+# queue_reaper.py - 可靠队列的回收端
+#
+# worker 用 LMOVE/BLMOVE 把消息从优先级队列挪进自己的处理中列表 pi_task_processing:{worker_id}，
+# 并定期刷新心跳键 pi_task_worker:{worker_id}（带 TTL），任务上传/失败上报后再 LREM 掉。
+# 心跳过期说明 worker 断电或崩溃：这里把它处理中列表里的消息重新放回队列头部并累加 attempts，
+# 超过 max_attempts 的放进死信队列，并把任务状态标记为失败。
+# worker 自己在开始执行前失败（比如下载失败）时也走 fail_attempt，两边的计数和上限是同一套。
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+PROCESSING_PREFIX = "pi_task_processing:"
+HEARTBEAT_PREFIX = "pi_task_worker:"
+LOCK_KEY = "pi_task_reaper_lock"
+MAX_TASK_ATTEMPTS = 3   # 同一个任务最多被取走几次
+
+
+def fail_attempt(msg, max_attempts=MAX_TASK_ATTEMPTS):
+    """记下一次失败的投递，返回 (新消息, 是否放弃)。
+
+    attempts 是已经失败的投递次数：正在执行的是第 attempts + 1 次，第 max_attempts 次也失败就放弃。
+    """
+    msg = dict(msg, attempts=msg.get("attempts", 0) + 1)
+    return msg, msg["attempts"] >= max_attempts
+
+
+def attempt_text(msg, dead):
+    """fail_attempt 之后的状态说明，master 和 worker 用同样的措辞。"""
+    if dead:
+        return f"giving up after {msg['attempts']} attempts"
+    return f"requeued after attempt {msg['attempts']}"
+
+
+class QueueReaper:
+    def __init__(self, rds, task_store, event_hub, queues, dead_letter_queue, max_attempts=MAX_TASK_ATTEMPTS,
+                 interval=15):
+        """queues: priority -> 队列名，如 {"high": "pi_task_high", "normal": "pi_task_normal"}。"""
+        self.rds = rds
+        self.task_store = task_store
+        self.event_hub = event_hub
+        self.queues = queues
+        self.dead_letter_queue = dead_letter_queue
+        self.max_attempts = max_attempts
+        self.interval = interval
+        self._thread = None
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name="queue-reaper", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                if self.rds.set(LOCK_KEY, self._owner, nx=True, ex=max(self.interval - 1, 1)):
+                    self.reap_once()
+            except Exception as e:
+                logger.warning(f"Queue reaper pass failed: {e}")
+            time.sleep(self.interval)
+
+    # ---------- 回收 ----------
+    def reap_once(self):
+        """处理所有心跳已过期的 worker，返回 (重新入队数, 进死信数)。"""
+        requeued = dead = 0
+        for key in self.rds.scan_iter(match=PROCESSING_PREFIX + "*"):
+            key = key.decode("utf-8")
+            worker_id = key[len(PROCESSING_PREFIX):]
+            if self.rds.exists(HEARTBEAT_PREFIX + worker_id):
+                continue
+            for raw in self.rds.lrange(key, 0, -1):
+                moved = self._recover(key, raw, worker_id)
+                if moved == "requeued":
+                    requeued += 1
+                elif moved == "dead":
+                    dead += 1
+        if requeued or dead:
+            logger.info(f"Queue reaper: requeued {requeued} tasks, moved {dead} to {self.dead_letter_queue}")
+        return requeued, dead
+
+    def _recover(self, key, raw, worker_id):
+        try:
+            msg = json.loads(raw)
+        except ValueError:
+            logger.warning(f"Dropping unparsable message from {key}: {raw[:200]!r}")
+            self.rds.lrem(key, 1, raw)
+            return None
+
+        msg, dead = fail_attempt(msg, self.max_attempts)
+        if dead:
+            target, phase = self.dead_letter_queue, "dead_letter"
+        else:
+            target = self.queues.get(msg.get("priority"), self.queues["normal"])
+            phase = "requeued"
+        text = f"Worker {worker_id} lost; {attempt_text(msg, dead)}"
+
+        if not self._move(key, raw, target, json.dumps(msg)):
+            return None   # worker 刚好处理完，消息已经不在列表里
+        event = self.task_store.update_status(msg.get("task_id"), phase=phase, message=text)
+        if event:
+            self.event_hub.publish(event)
+        logger.info(f"Task {msg.get('task_id')}: {text}")
+        return "dead" if phase == "dead_letter" else "requeued"
+
+    def _move(self, src, raw, dst, new_raw):
+        """把 raw 从 src 原子地挪到 dst 头部（内容换成 new_raw）；raw 已不在 src 时返回 False。"""
+        with self.rds.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(src)
+                    if raw not in pipe.lrange(src, 0, -1):
+                        pipe.unwatch()
+                        return False
+                    pipe.multi()
+                    pipe.lrem(src, 1, raw)
+                    pipe.lpush(dst, new_raw)
+                    pipe.execute()
+                    return True
+                except redis.WatchError:
+                    continue
+
+    # ---------- 统计 ----------
+    def stats(self):
+        workers = {}
+        for key in self.rds.scan_iter(match=HEARTBEAT_PREFIX + "*"):
+            worker_id = key.decode("utf-8")[len(HEARTBEAT_PREFIX):]
+            raw = self.rds.get(key)
+            workers[worker_id] = {"info": json.loads(raw) if raw else None, "alive": True, "in_flight": 0}
+        for key in self.rds.scan_iter(match=PROCESSING_PREFIX + "*"):
+            worker_id = key.decode("utf-8")[len(PROCESSING_PREFIX):]
+            entry = workers.setdefault(worker_id, {"info": None, "alive": False, "in_flight": 0})
+            entry["in_flight"] = self.rds.llen(key)
+        return {
+            "queues": {name: self.rds.llen(name) for name in self.queues.values()},
+            "dead_letter": self.rds.llen(self.dead_letter_queue),
+            "workers": workers,
+        }
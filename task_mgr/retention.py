@@ -0,0 +1,193 @@
+# retention.py - 任务包/结果的保留策略：按总字节预算和最长保留时间做 LRU 清理
+#
+# 存储本身已经按 digest 分目录（blobs/ab/cd/...），这里只负责决定删哪些引用：
+#   - 超过 max_age 没被下载过的结果/已结束任务的任务包直接清理；
+#   - 总量超过 byte_budget 时按最后下载时间从旧到新清理，直到回到预算以内；
+#   - 还在排队/运行的任务依赖的上游结果、以及它们自己的任务包/输入分片永远不动；
+#   - 还没归约完的 map-reduce 作业的各分片结果也不动；
+#   - 登记的共享数据集只在显式删除时清理，也不计入字节预算。
+# 另外顺带清理上传中断留下的 tmp/*.part、过期的构建目录、长期没更新的任务输出日志/追踪记录。
+# 旧版的 *_status.txt 不动：tasks.db 丢失或损坏时还要靠它们重新导入。
+
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+from pathlib import Path
+
+from dataset_store import DATASET_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = "pi_task_retention_lock"
+LAST_RUN_KEY = "pi_task_retention_last_run"   # 清理只在一个 worker 里跑，统计放 Redis 供所有 worker 查询
+STALE_SPOOL_SEC = 6 * 3600       # 超过这个时间还没写完的上传临时文件视为中断
+BUILD_MAX_AGE_SEC = 24 * 3600    # 构建产物保留一天，足够前端下载
+
+
+def _task_id_of(name):
+    for suffix in ("_task.zip", "_result.zip", "_shard.zip"):
+        if name.endswith(suffix):
+            return name[:-len(suffix)], suffix
+    return None, None
+
+
+def _dir_size(path):
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class RetentionManager:
+    def __init__(self, task_store, artifact_store, event_hub, rds, task_dir, build_dir,
+                 byte_budget, max_age, interval=600, task_logs=None, trace_store=None, mapreduce_jobs=None):
+        self.task_store = task_store
+        self.artifact_store = artifact_store
+        self.event_hub = event_hub
+        self.rds = rds
+        self.task_dir = Path(task_dir)
+        self.build_dir = Path(build_dir)
+        self.byte_budget = byte_budget
+        self.max_age = max_age
+        self.interval = interval
+        self.task_logs = task_logs
+        self.trace_store = trace_store
+        self.mapreduce_jobs = mapreduce_jobs
+        self.last_run = None    # 上一次清理的统计
+        self._thread = None
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name="retention", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                if self._acquire():
+                    self.run_once()
+            except Exception as e:
+                logger.warning(f"Retention pass failed: {e}")
+            time.sleep(self.interval)
+
+    def _acquire(self):
+        """多个 gunicorn worker 只让一个做清理；Redis 不可用时各自清理也不会出错，只是重复劳动。"""
+        try:
+            return bool(self.rds.set(LOCK_KEY, self._owner, nx=True, ex=max(self.interval - 5, 1)))
+        except Exception:
+            return True
+
+    # ---------- 清理 ----------
+    def run_once(self):
+        now = time.time()
+        stats = {"started_at": now, "evicted": 0, "freed_bytes": 0, "results_evicted": 0,
+                 "spools_removed": self._sweep_spools(now),
+                 "builds_removed": self._sweep_builds(now),
+                 "logs_removed": self.task_logs.sweep(self.max_age, now) if self.task_logs else 0,
+                 "traces_removed": self.trace_store.sweep(self.max_age, now) if self.trace_store else 0}
+
+        active = self.task_store.active_task_ids()
+        pinned = self.task_store.pending_dependencies()
+        if self.mapreduce_jobs:
+            pinned |= self.mapreduce_jobs.pinned_task_ids()
+        blob_bytes, _, _ = self.artifact_store.usage()
+        rows = list(self.artifact_store.iter_lru())
+        blob_bytes -= sum(row["size"] for row in rows if row["name"].endswith(DATASET_SUFFIX))
+
+        for row in rows:
+            over_budget = blob_bytes > self.byte_budget
+            expired = now - row["last_access"] > self.max_age
+            if not over_budget and not expired:
+                # 按 last_access 升序，后面的只会更新
+                break
+            if row["name"].endswith(DATASET_SUFFIX):
+                continue
+            task_id, suffix = _task_id_of(row["name"])
+            if task_id in active:
+                continue
+            if suffix == "_result.zip" and task_id in pinned:
+                continue
+            if not self.artifact_store.delete(row["name"]):
+                continue
+            stats["evicted"] += 1
+            if not self.artifact_store.blob_path(row["digest"]).exists():
+                blob_bytes -= row["size"]
+                stats["freed_bytes"] += row["size"]
+            if suffix == "_result.zip":
+                stats["results_evicted"] += 1
+                event = self.task_store.clear_result(task_id)
+                if event:
+                    self.event_hub.publish(event)
+
+        stats["finished_at"] = time.time()
+        self.last_run = stats
+        try:
+            self.rds.set(LAST_RUN_KEY, json.dumps(stats))
+        except Exception:
+            pass
+        if stats["evicted"] or stats["spools_removed"] or stats["builds_removed"]:
+            logger.info(f"Retention: evicted {stats['evicted']} artifacts ({stats['freed_bytes']} bytes), "
+                        f"removed {stats['spools_removed']} stale uploads, {stats['builds_removed']} build dirs")
+        return stats
+
+    def _sweep_spools(self, now):
+        count = 0
+        for f in self.artifact_store.tmp_dir.glob("*.part"):
+            try:
+                if now - f.stat().st_mtime > STALE_SPOOL_SEC:
+                    f.unlink()
+                    count += 1
+            except FileNotFoundError:
+                pass
+        return count
+
+    def _sweep_builds(self, now):
+        if not self.build_dir.exists():
+            return 0
+        count = 0
+        for d in self.build_dir.iterdir():
+            try:
+                if d.is_dir() and now - d.stat().st_mtime > BUILD_MAX_AGE_SEC:
+                    shutil.rmtree(d, ignore_errors=True)
+                    count += 1
+            except FileNotFoundError:
+                pass
+        return count
+
+    # ---------- 统计 ----------
+    def _last_run(self):
+        try:
+            raw = self.rds.get(LAST_RUN_KEY)
+            if raw:
+                return json.loads(raw)
+        except Exception:
+            pass
+        return self.last_run
+
+    def report(self):
+        blob_bytes, blob_count, ref_count = self.artifact_store.usage()
+        disk = shutil.disk_usage(self.task_dir)
+        return {
+            "blob_bytes": blob_bytes,
+            "blob_count": blob_count,
+            "artifact_count": ref_count,
+            "tmp_bytes": _dir_size(self.artifact_store.tmp_dir),
+            "build_bytes": _dir_size(self.build_dir) if self.build_dir.exists() else 0,
+            "log_bytes": self.task_logs.usage() if self.task_logs else 0,
+            "byte_budget": self.byte_budget,
+            "max_age_sec": self.max_age,
+            "pinned_results": sorted(self.task_store.pending_dependencies()),
+            "disk_total": disk.total,
+            "disk_used": disk.used,
+            "disk_free": disk.free,
+            "last_run": self._last_run(),
+        }
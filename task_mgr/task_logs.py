@@ -0,0 +1,95 @@
+# task_logs.py - 任务输出（stdout/stderr）的落盘存储
+#
+# worker 把任务输出逐行攒批 POST 到 /pi_task/task_log/<task_id>，这里按任务追加到 logs/<task_id>.log，
+# 每个任务最多 max_bytes，超出后写一行截断标记、之后的输出丢弃。
+# 前端按字节偏移增量读取（GET ?offset=），新追加的内容同时作为 SSE 的 log 事件推送。
+
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+READ_CHUNK = 64 * 1024
+TRUNCATED_MARK = "[... output truncated: log size limit reached ...]\n"
+_TASK_ID_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+class TaskLogStore:
+    def __init__(self, root, max_bytes=8 * 1024 * 1024):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, task_id):
+        if not _TASK_ID_RE.match(task_id or "") or task_id.startswith("."):
+            return None
+        return self.root / f"{task_id}.log"
+
+    def append(self, task_id, lines, dropped=0):
+        """lines: [{"stream": "stdout"/"stderr", "line": ...}]。返回 (写入起点偏移, 写入的文本, 是否已截断)。"""
+        path = self.path(task_id)
+        if path is None:
+            raise ValueError(f"Invalid task id {task_id!r}")
+        parts = []
+        if dropped:
+            parts.append(f"[... {dropped} lines dropped on worker ...]\n")
+        for entry in lines:
+            prefix = "[stderr] " if entry.get("stream") == "stderr" else ""
+            parts.append(f"{prefix}{entry.get('line', '')}\n")
+        data = "".join(parts).encode("utf-8", errors="replace")
+
+        with self._lock, open(path, "ab") as f:
+            offset = f.tell()
+            if offset >= self.max_bytes:
+                return offset, "", True
+            truncated = offset + len(data) > self.max_bytes
+            if truncated:
+                room = self.max_bytes - offset
+                data = data[:room].decode("utf-8", errors="ignore").encode("utf-8")
+                data = data[:data.rfind(b"\n") + 1] + TRUNCATED_MARK.encode()
+            f.write(data)
+        return offset, data.decode("utf-8"), truncated
+
+    def read(self, task_id, offset=0, limit=READ_CHUNK):
+        """从 offset 起最多读 limit 字节（在行边界截断），返回 None 表示还没有输出。"""
+        path = self.path(task_id)
+        if path is None or not path.exists():
+            return None
+        size = path.stat().st_size
+        offset = min(max(offset, 0), size)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(limit)
+        if offset + len(data) < size and b"\n" in data:
+            data = data[:data.rfind(b"\n") + 1]   # 只返回完整的行，剩下的下次再读
+        return {
+            "offset": offset,
+            "next_offset": offset + len(data),
+            "size": size,
+            "truncated": size >= self.max_bytes,
+            "text": data.decode("utf-8", errors="replace"),
+        }
+
+    def sweep(self, max_age, now=None):
+        """删除超过 max_age 没有更新的日志，返回删除的个数。"""
+        now = now or time.time()
+        count = 0
+        for f in self.root.glob("*.log"):
+            try:
+                if now - f.stat().st_mtime > max_age:
+                    f.unlink()
+                    count += 1
+            except FileNotFoundError:
+                pass
+        return count
+
+    def usage(self):
+        total = 0
+        for f in self.root.glob("*.log"):
+            try:
+                total += f.stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
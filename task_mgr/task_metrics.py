@@ -0,0 +1,121 @@
+# task_metrics.py - 把 worker 上报的阶段耗时/资源用量聚合成直方图
+#
+# 按 (任务类型, 节点) 分组，每个指标一个固定桶的直方图（累计计数，和 Prometheus 的 le 桶一致），
+# 另外给出 count / sum / p50 / p95。/pi_task/metrics 默认返回 JSON，?format=prometheus 返回文本格式。
+
+import math
+
+TIME_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+BYTE_BUCKETS = tuple(1024 ** 2 * 4 ** i for i in range(8))   # 1 MiB .. 16 GiB
+
+RESOURCE_FIELDS = {
+    "total_sec": TIME_BUCKETS,
+    "cpu_user_sec": TIME_BUCKETS,
+    "cpu_sys_sec": TIME_BUCKETS,
+    "max_rss_bytes": BYTE_BUCKETS,
+    "read_bytes": BYTE_BUCKETS,
+    "write_bytes": BYTE_BUCKETS,
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.values = []
+
+    def observe(self, value):
+        if value is not None:
+            self.values.append(float(value))
+
+    def _percentile(self, ordered, q):
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+    def to_dict(self):
+        ordered = sorted(self.values)
+        counts, i = [], 0
+        for le in self.buckets:
+            while i < len(ordered) and ordered[i] <= le:
+                i += 1
+            counts.append([le, i])
+        counts.append(["+Inf", len(ordered)])
+        return {
+            "count": len(ordered),
+            "sum": round(sum(ordered), 3),
+            "p50": self._percentile(ordered, 0.5) if ordered else None,
+            "p95": self._percentile(ordered, 0.95) if ordered else None,
+            "buckets": counts,
+        }
+
+
+def aggregate(rows):
+    """rows: TaskStore.metric_rows() 的结果。返回按 (task_type, node) 分组的直方图列表。"""
+    groups = {}
+    for row in rows:
+        key = (row.get("task_type") or "Unknown", row.get("node") or "Unknown")
+        group = groups.setdefault(key, {"phases": {}, "resources": {f: Histogram(b) for f, b in RESOURCE_FIELDS.items()},
+                                        "tasks": 0})
+        group["tasks"] += 1
+        for phase, sec in row["phases"].items():
+            group["phases"].setdefault(phase, Histogram(TIME_BUCKETS)).observe(sec)
+        for field, hist in group["resources"].items():
+            hist.observe(row.get(field))
+
+    result = []
+    for (task_type, node), group in sorted(groups.items()):
+        result.append({
+            "task_type": task_type,
+            "node": node,
+            "tasks": group["tasks"],
+            "phases": {name: hist.to_dict() for name, hist in sorted(group["phases"].items())},
+            "resources": {name: hist.to_dict() for name, hist in group["resources"].items() if hist.values},
+        })
+    return result
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{k}="{_label_value(v)}"' for k, v in labels.items()) + "}"
+
+
+def _histogram_lines(name, hist, **labels):
+    lines = []
+    for le, count in hist["buckets"]:
+        lines.append(f"{name}_bucket{_labels(**labels, le=le)} {count}")
+    lines.append(f"{name}_sum{_labels(**labels)} {hist['sum']}")
+    lines.append(f"{name}_count{_labels(**labels)} {hist['count']}")
+    return lines
+
+
+def render_prometheus(groups):
+    """aggregate() 的结果转成 Prometheus 文本格式。"""
+    series = {
+        "pi_task_phase_seconds": [],
+        "pi_task_total_seconds": [],
+        "pi_task_cpu_seconds": [],
+        "pi_task_max_rss_bytes": [],
+        "pi_task_io_bytes": [],
+    }
+    for g in groups:
+        labels = {"task_type": g["task_type"], "node": g["node"]}
+        for phase, hist in g["phases"].items():
+            series["pi_task_phase_seconds"] += _histogram_lines("pi_task_phase_seconds", hist, **labels, phase=phase)
+        res = g["resources"]
+        if "total_sec" in res:
+            series["pi_task_total_seconds"] += _histogram_lines("pi_task_total_seconds", res["total_sec"], **labels)
+        for field, mode in (("cpu_user_sec", "user"), ("cpu_sys_sec", "system")):
+            if field in res:
+                series["pi_task_cpu_seconds"] += _histogram_lines("pi_task_cpu_seconds", res[field], **labels, mode=mode)
+        if "max_rss_bytes" in res:
+            series["pi_task_max_rss_bytes"] += _histogram_lines("pi_task_max_rss_bytes", res["max_rss_bytes"], **labels)
+        for field, direction in (("read_bytes", "read"), ("write_bytes", "write")):
+            if field in res:
+                series["pi_task_io_bytes"] += _histogram_lines("pi_task_io_bytes", res[field], **labels,
+                                                               direction=direction)
+    out = []
+    for name, lines in series.items():
+        out.append(f"# TYPE {name} histogram")
+        out += lines
+    return "\n".join(out) + "\n"
@@ -1,16 +1,30 @@
 import os
 import time
 import logging
-import shutil
+import tempfile
+import threading
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, Request, Response, render_template, request, jsonify, send_file, send_from_directory, stream_with_context, redirect, g, has_request_context
 import paramiko
 from werkzeug.utils import secure_filename
-from zipfile import ZipFile
-from threading import Lock
-from subprocess import run, CalledProcessError
+import zipfile
 import json
 import redis
+from task_store import TaskStore, format_status_log, process_owner
+from event_hub import EventHub
+from artifact_store import ArtifactStore
+from build_jobs import BuildJobs
+from retention import RetentionManager
+from queue_reaper import MAX_TASK_ATTEMPTS, QueueReaper
+from image_builder import ImageBuilder
+from wheelhouse import Wheelhouse, normalize_name
+from task_logs import TaskLogStore
+import task_metrics
+from tracing import TraceStore, make_span, new_trace_id, new_span_id, format_traceparent, parse_traceparent, parse_baggage
+import build_task as task_builder
+import mapreduce
+from mapreduce import MapReduceJobs
+from dataset_store import DatasetStore, dataset_artifact_name, inspect_dataset_zip, parse_dataset_refs
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
@@ -27,199 +41,407 @@ REDIS_HOST = "127.0.0.1"   # Redis 跑在主节点
 REDIS_PORT = 6379
 TASK_QUEUE_HIGH = "pi_task_high"      # 高优先级队列
 TASK_QUEUE_NORMAL = "pi_task_normal"  # 普通优先级队列
+TASK_DEAD_LETTER = "pi_task_dead"     # worker 反复丢失的任务最终放这里
+TASK_ID_SEQ_KEY = "pi_task_id_seq"    # 任务 ID 序号计数器
+TASK_ID_SEQ_WIDTH = 10               # 序号补零到固定宽度，任务 ID 按字符串排序和按提交顺序一致
+MAX_BATCH_TASKS = 10000               # 单次批量提交的任务数上限
+
+TASK_EVENT_CHANNEL = "pi_task_events"  # 任务状态事件广播频道
 
 rds = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+event_hub = EventHub(rds, TASK_EVENT_CHANNEL)
+
+# 任务元数据索引（SQLite），首次启动时把旧的 *_status.txt 导入
+TASK_DB_PATH = TASK_DIR.parent / "tasks.db"
+INDEX_PAGE_SIZE = 50
+TASKS_API_MAX_LIMIT = 500
+TERMINAL_STATUSES = ("success", "failed")
+FINAL_PHASES = (None, "cleanup", "dead_letter")   # 任务结束时最后一条事件的 phase
+METRICS_WINDOW_SEC = 7 * 24 * 3600   # /metrics 默认只聚合最近 7 天
+task_store = TaskStore(TASK_DB_PATH)
+migrated = task_store.migrate_status_files(TASK_DIR)
+if migrated:
+    logger.info(f"Migrated {migrated} legacy status files into {TASK_DB_PATH}")
+
+# 任务包/结果按 SHA-256 内容寻址存放在 TASK_DIR/blobs 下，相同内容只存一份
+artifact_store = ArtifactStore(TASK_DIR, TASK_DB_PATH)
+imported = artifact_store.import_legacy_files(TASK_DIR)
+if imported:
+    logger.info(f"Imported {imported} legacy task/result zips into the artifact store")
+
+# 任务包构建：后台有界线程池，构建产物放在 BUILD_DIR/<job_id>/ 下
+BUILD_DIR = TASK_DIR.parent / "builds"
+BUILD_WORKERS = 2
+build_jobs = BuildJobs(TASK_DB_PATH, BUILD_DIR, max_workers=BUILD_WORKERS)
+
+# 任务输出：worker 逐行攒批上传，每个任务一个日志文件，超过上限截断
+TASK_LOG_DIR = TASK_DIR.parent / "logs"
+TASK_LOG_MAX_BYTES = 8 * 1024 * 1024
+task_logs = TaskLogStore(TASK_LOG_DIR, max_bytes=TASK_LOG_MAX_BYTES)
+
+# 链路追踪：每个任务一个 trace，span 按任务存在 traces/<task_id>.jsonl；
+# 填了 OTLP_ENDPOINT（如 http://192.168.12.201:4318）时同时转发给 OpenTelemetry collector
+TRACE_DIR = TASK_DIR.parent / "traces"
+OTLP_ENDPOINT = ""
+# worker 带 traceparent 调用的接口
+TRACED_ENDPOINTS = ("download_task", "download_result", "download_input", "download_dataset", "upload_result")
+trace_store = TraceStore(TRACE_DIR, otlp_endpoint=OTLP_ENDPOINT)
+
+# map-reduce 作业：任务包按 input/ 分片后分给多个 worker 并行执行，全部完成后归约成一个结果
+MAPREDUCE_MAX_SHARDS = 256
+mapreduce_jobs = MapReduceJobs(TASK_DB_PATH)
+
+# 共享数据集：按 sha256 登记一次，任务包的 task_config.json 里用 "datasets": {"名字": "sha256"} 引用
+dataset_store = DatasetStore(TASK_DB_PATH)
+
+# 局域网 PyPI 缓存：worker 的 pip 都指向 /pi_task/pypi/simple/，缺的包第一次请求时从上游下载并缓存
+WHEELHOUSE_DIR = TASK_DIR.parent / "wheelhouse"
+PYPI_UPSTREAM = "https://pypi.tuna.tsinghua.edu.cn/simple"
+PYPI_INDEX_URL = "http://192.168.12.201:5000/pi_task/pypi/simple/"   # worker / 构建容器访问用的地址
+wheelhouse = Wheelhouse(WHEELHOUSE_DIR, PYPI_UPSTREAM)
+
+# 可选：任务镜像在 master 上按 worker 架构集中构建，推到局域网 registry，worker 按 digest 拉取
+IMAGE_REGISTRY = "192.168.12.201:5001"   # registry:2 容器
+IMAGE_PLATFORMS = "linux/arm64"          # worker（树莓派）的架构，多个用逗号分隔
+image_builder = ImageBuilder(IMAGE_REGISTRY, platforms=IMAGE_PLATFORMS, pip_index_url=PYPI_INDEX_URL)
+
+# 保留策略：存储总量超过预算或长期没人下载时按 LRU 清理，被未完成任务依赖的结果不清理
+RETENTION_BYTE_BUDGET = 4 * 1024 ** 3    # 4 GiB
+RETENTION_MAX_AGE = 30 * 24 * 3600       # 30 天没被下载过就清理
+RETENTION_INTERVAL = 600
+retention = RetentionManager(task_store, artifact_store, event_hub, rds, TASK_DIR, BUILD_DIR,
+                             byte_budget=RETENTION_BYTE_BUDGET, max_age=RETENTION_MAX_AGE,
+                             interval=RETENTION_INTERVAL, task_logs=task_logs, trace_store=trace_store,
+                             mapreduce_jobs=mapreduce_jobs)
+retention.start()
+
+# 可靠队列：worker 心跳过期后，把它处理中列表里的任务放回队列，多次失败的进死信队列
+queue_reaper = QueueReaper(rds, task_store, event_hub,
+                           {"high": TASK_QUEUE_HIGH, "normal": TASK_QUEUE_NORMAL},
+                           TASK_DEAD_LETTER, max_attempts=MAX_TASK_ATTEMPTS)
+queue_reaper.start()
+
+class ArtifactRequest(Request):
+    """上传的文件分块直接写到存储的 tmp 目录，边写边算 SHA-256，不经过 Werkzeug 的内存/临时文件缓冲。"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return artifact_store.open_spool()
 
 app = Flask(__name__)
+app.request_class = ArtifactRequest
 app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024  # Max file size: 1GB
-task_status_map = {}     # task_id -> status
-status_lock = Lock()     # 多线程并发写保护
 
 API_BASE = "/pi_task"
 
+@app.before_request
+def _mark_request_start():
+    g.request_started = time.time()
+
+@app.after_request
+def _record_server_span(resp):
+    """worker 带着 traceparent 来下载/上传时，在它的 span 下面记一个 server span。"""
+    if request.endpoint in TRACED_ENDPOINTS:
+        parent = parse_traceparent(request.headers.get("traceparent"))
+        task_id = parse_baggage(request.headers.get("baggage")).get("task.id")
+        if parent and task_id:
+            span = make_span(f"{request.method} {request.endpoint}", parent[0], parent[1],
+                             g.request_started, time.time(), kind="SPAN_KIND_SERVER", ok=resp.status_code < 400,
+                             attributes={"task.id": task_id, "http.method": request.method,
+                                         "http.route": request.url_rule.rule, "http.status_code": resp.status_code,
+                                         "http.request_content_length": request.content_length or 0})
+            trace_store.record(task_id, [span])
+    return resp
+
 @app.route(API_BASE + '/')
 def index():
+    page = request.args.get("page", 1, type=int)
+    tasks, total = task_store.page_tasks(page, INDEX_PAGE_SIZE)
     ip_groups = {}
-    for f in sorted(TASK_DIR.glob("*_status.txt")):
-        task_id = f.name.replace("_status.txt", "")
-        result_file = TASK_DIR / f"{task_id}_result.zip"
-        submit_time = None
-        finish_time = None
-        ip = "Unknown"
-        use_docker = None
-        task_type = "Unknown"
-
-        with open(f, 'r') as sf:
-            for line in sf:
-                if line.startswith("Submitted at:"):
-                    submit_time = line.strip().split(":", 1)[1].strip()
-                elif line.startswith("Completed at:"):
-                    finish_time = line.strip().split(":", 1)[1].strip()
-                elif line.startswith("Client IP:"):
-                    ip = line.strip().split(":", 1)[1].strip()
-                elif line.startswith("Use Docker:"):
-                    use_docker = line.strip().split(":", 1)[1].strip().lower() == "true"
-                elif line.startswith("Task type:"):
-                    task_type = line.strip().split(":", 1)[1].strip()
-
-        task_info = {
-            "id": task_id,
-            "task_type": task_type,
-            "has_result": result_file.exists(),
-            "submit_time": submit_time,
-            "finish_time": finish_time,
-            "use_docker": use_docker
-        }
-
-
-        if ip not in ip_groups:
-            ip_groups[ip] = []
-        ip_groups[ip].append(task_info)
-
-    return render_template('index.html', ip_groups=ip_groups)
+    for task in tasks:
+        ip_groups.setdefault(task["client_ip"], []).append(task)
+
+    pages = max((total + INDEX_PAGE_SIZE - 1) // INDEX_PAGE_SIZE, 1)
+    return render_template('index.html', ip_groups=ip_groups, page=page, pages=pages, total=total,
+                           server_time=time.time())
+
+def _build_task_image(output_path, progress):
+    """集中构建任务镜像，并把 registry/repo@sha256:... 写进任务包的 task_config.json。"""
+    image = image_builder.build_for_zip(output_path, progress)
+    progress(95, f"Task image pushed: {image}")
+    task_builder.update_task_config(str(output_path), image=image)
+
+def _build_example_job(job_dir, output_path, progress, example_task, dep_zip_path, seed, central_image=False):
+    progress(20, f"Generating {example_task} example task")
+    task_builder.build_example_task(example_task, str(output_path), dep_zip_path, seed=seed)
+    if central_image:
+        _build_task_image(output_path, progress)
+
+def _build_custom_job(job_dir, output_path, progress, use_docker, has_input, central_image=False):
+    code_dir = job_dir / "code"
+    input_dir = job_dir / "input" if has_input else None
+
+    # 解压代码 zip / 输入 zip
+    progress(15, "Extracting code")
+    with zipfile.ZipFile(job_dir / "code.zip", 'r') as zip_ref:
+        zip_ref.extractall(code_dir)
+    if input_dir:
+        progress(30, "Extracting input data")
+        with zipfile.ZipFile(job_dir / "input.zip", 'r') as zip_ref:
+            zip_ref.extractall(input_dir)
+
+    progress(50, "Packaging task")
+    task_builder.build_custom_task(str(code_dir), str(input_dir) if input_dir else None, str(output_path), use_docker)
+    if central_image and use_docker:
+        _build_task_image(output_path, progress)
+
+def _build_job_urls(job_id):
+    return {
+        "status_url": f"{API_BASE}/build_jobs/{job_id}",
+        "download_url": f"{API_BASE}/build_jobs/{job_id}/download",
+    }
 
 @app.route(API_BASE + '/build_task', methods=['POST'])
 def build_task():
-    app.logger.info(f"Request headers: {dict(request.headers)}")
-    app.logger.info(f"Request form keys: {list(request.form.keys())}")
-    app.logger.info(f"Request files keys: {list(request.files.keys())}")
+    """提交一个构建任务，立即返回 job_id；构建在后台线程池里完成，
+    通过 /build_jobs/<job_id> 查询进度，完成后从 /build_jobs/<job_id>/download 下载。"""
+    app.logger.info(f"Request form keys: {list(request.form.keys())}, files keys: {list(request.files.keys())}")
     try:
         task_mode = request.form.get("task_mode")
-        import tempfile
-        from subprocess import run
-
-        app.logger.info(f"Received task_mode: {task_mode}")
-
-        # 打印所有的表单数据
-        for key, value in request.form.items():
-            app.logger.info(f"Form data - {key}: {value}")
-
-        # 打印上传的文件信息
-        for file in request.files.values():
-            app.logger.info(f"Received file - {file.filename}")
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            build_dir = Path(tmpdir)
-
-            # 统一创建输出目录
-            output_dir = build_dir / "output"
-            output_dir.mkdir(parents=True, exist_ok=True)
-
-            if task_mode == "example":
-                example_task = request.form.get("example_task")
-                if not example_task:
-                    return "缺少 example_task 参数", 400
-
-                # 定义输出 zip 路径
-                output_zip_path = output_dir / f"{example_task}_example_task.zip"
-
-                if example_task == "aes_dec":
-                    dep_zip = request.files.get("dep_zip")
-                    if not dep_zip:
-                        return "缺少依赖 ZIP", 400
-                    dep_zip_path = build_dir / "dep.zip"
-                    dep_zip.save(dep_zip_path)
-
-                    cmd = [
-                        f"{BASE_DIR}/myvenv/bin/python3",
-                        f"{BASE_DIR}/build_task.py",
-                        "-e", example_task,
-                        "-d", str(dep_zip_path),
-                        "-o", str(output_zip_path)
-                    ]
-                else:
-                    cmd = [
-                        f"{BASE_DIR}/myvenv/bin/python3",
-                        f"{BASE_DIR}/build_task.py",
-                        "-e", example_task,
-                        "-o", str(output_zip_path)
-                    ]
-
-                result = run(cmd, cwd=build_dir, capture_output=True)
-                if result.returncode != 0:
-                    app.logger.error(f"Build_task.py failed:\nSTDOUT:\n{result.stdout.decode()}\nSTDERR:\n{result.stderr.decode()}")
-                    return f"Build failed: {result.stderr.decode()}", 400
-
-                zip_path = output_zip_path
-
-            elif task_mode == "custom":
-                task_name = request.form.get("custom_task_name")
-                code_zip = request.files.get("code_zip")
-                input_zip = request.files.get("input_zip")
-                use_docker = request.form.get("use_docker") == "on"
-
-                if not task_name or not code_zip:
-                    return "Missing required fields", 400
-
-                code_dir = build_dir / "code"
-                input_dir = build_dir / "input"
-
-                if code_dir.exists():
-                    shutil.rmtree(code_dir)
-                code_dir.mkdir(parents=True, exist_ok=True)
-
-                # 保存并解压代码 zip
-                code_zip_path = build_dir / "code.zip"
-                code_zip.save(code_zip_path)
-                with zipfile.ZipFile(code_zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(code_dir)
-
-                # 处理输入 zip
-                if input_zip:
-                    if input_dir.exists():
-                        shutil.rmtree(input_dir)
-                    input_dir.mkdir(parents=True, exist_ok=True)
-                    input_zip_path = build_dir / "input.zip"
-                    input_zip.save(input_zip_path)
-                    with zipfile.ZipFile(input_zip_path, 'r') as zip_ref:
-                        zip_ref.extractall(input_dir)
-                else:
-                    input_dir = None
-
-                output_zip_path = output_dir / f"{task_name}_user_task.zip"
-
-                cmd = [
-                    f"{BASE_DIR}/myvenv/bin/python3",
-                    f"{BASE_DIR}/build_task.py",
-                    "-i", str(code_dir),
-                    "-o", str(output_zip_path),
-                ]
-
-                if input_dir:
-                    cmd.extend(["-d", str(input_dir)])
-
-                if not use_docker:
-                    cmd.append("--no-docker")
-
-                result = run(cmd, cwd=build_dir, capture_output=True)
-                if result.returncode != 0:
-                    app.logger.error(f"Build_task.py failed:\nSTDOUT:\n{result.stdout.decode()}\nSTDERR:\n{result.stderr.decode()}")
-                    return f"Build failed: {result.stderr.decode()}", 400
-
-                zip_path = output_zip_path
-
-            else:
-                return "Invalid task mode", 400
-
-            if not zip_path.exists():
-                return "Built zip not found", 500
-
-            return send_from_directory(zip_path.parent, zip_path.name, as_attachment=True)
+        central_image = request.form.get("central_image") == "on"   # 在 master 上集中构建镜像
+
+        if task_mode == "example":
+            example_task = request.form.get("example_task")
+            if not example_task:
+                return jsonify({'status': 'error', 'message': "缺少 example_task 参数"}), 400
+            if example_task not in task_builder.EXAMPLE_REQUIREMENTS:
+                return jsonify({'status': 'error', 'message': f"Unsupported example task {example_task}"}), 400
+
+            seed = request.form.get("seed", type=int)  # 可选：固定种子生成输入数据，基准测试可复现
+            dep_zip = request.files.get("dep_zip")
+            if example_task == "aes_dec" and not dep_zip:
+                return jsonify({'status': 'error', 'message': "缺少依赖 ZIP"}), 400
+
+            job_id = build_jobs.create("example", example_task)
+            dep_zip_path = None
+            if example_task == "aes_dec":
+                dep_zip_path = str(build_jobs.job_dir(job_id) / "dep.zip")
+                dep_zip.save(dep_zip_path)
+
+            build_jobs.submit(job_id, f"{example_task}_example_task.zip", _build_example_job,
+                              example_task, dep_zip_path, seed, central_image)
+
+        elif task_mode == "custom":
+            task_name = secure_filename(request.form.get("custom_task_name") or "")
+            code_zip = request.files.get("code_zip")
+            input_zip = request.files.get("input_zip")
+            use_docker = request.form.get("use_docker") == "on"
+
+            if not task_name or not code_zip:
+                return jsonify({'status': 'error', 'message': "Missing required fields"}), 400
+
+            # 上传的文件必须在请求结束前存下来，解压和打包交给后台线程
+            job_id = build_jobs.create("custom", task_name)
+            job_dir = build_jobs.job_dir(job_id)
+            code_zip.save(job_dir / "code.zip")
+            if input_zip:
+                input_zip.save(job_dir / "input.zip")
+
+            build_jobs.submit(job_id, f"{task_name}_user_task.zip", _build_custom_job,
+                              use_docker, bool(input_zip), central_image)
+
+        else:
+            return jsonify({'status': 'error', 'message': "Invalid task mode"}), 400
+
+        return jsonify({'status': 'success', 'job_id': job_id, **_build_job_urls(job_id)}), 202
 
     except Exception:
         import traceback
         app.logger.error(traceback.format_exc())
-        return "Internal Server Error", 500
+        return jsonify({'status': 'error', 'message': "Internal Server Error"}), 500
+
+@app.route(API_BASE + '/build_jobs/<job_id>')
+def build_job_status(job_id):
+    job = build_jobs.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Build job not found'}), 404
+    job.update(_build_job_urls(job_id))
+    if job["status"] != "done":
+        job["download_url"] = None
+    return jsonify(job)
+
+@app.route(API_BASE + '/build_jobs/<job_id>/download')
+def build_job_download(job_id):
+    job = build_jobs.get(job_id)
+    path = build_jobs.output_path(job) if job else None
+    if path is None:
+        return jsonify({'status': 'error', 'message': 'Build output not available'}), 404
+    return send_file(path, mimetype="application/zip", as_attachment=True, download_name=path.name)
 
 @app.route(API_BASE + "/list_result_tasks")
 def list_result_tasks():
-    task_ids = []
-    for filename in os.listdir(TASK_DIR):
-        if filename.endswith("_result.zip"):
-            task_id = filename[:-11]  # 去掉 _result.zip
-            task_ids.append(task_id)
-    return jsonify(task_ids)
+    limit = request.args.get("limit", 200, type=int)
+    return jsonify(task_store.list_result_task_ids(limit))
+
+
+@app.route(API_BASE + "/storage")
+def storage_usage():
+    """存储占用：blob 总量、临时文件、构建目录、磁盘剩余空间以及上一次清理的统计。"""
+    return jsonify(retention.report())
+
 
+@app.route(API_BASE + "/queue_stats")
+def queue_stats():
+    """各队列长度、死信数，以及每个 worker 槽位的心跳和处理中任务数。"""
+    return jsonify(queue_reaper.stats())
+
+
+@app.route(API_BASE + "/metrics")
+def task_metrics_histograms():
+    """按任务类型和节点聚合的阶段耗时/资源用量直方图。?since=<epoch> 改时间窗口，?format=prometheus 输出文本格式。"""
+    args = request.args
+    since = args.get("since", type=float)
+    rows = task_store.metric_rows(since=since if since is not None else time.time() - METRICS_WINDOW_SEC,
+                                  task_type=args.get("task_type"), node=args.get("node"))
+    groups = task_metrics.aggregate(rows)
+    if args.get("format") == "prometheus":
+        return Response(task_metrics.render_prometheus(groups), mimetype="text/plain; version=0.0.4")
+    return jsonify({"tasks": len(rows), "groups": groups})
+
+
+@app.route(API_BASE + "/tasks")
+def list_tasks():
+    """任务列表 JSON 接口：游标分页 + 过滤，updated_since 用于增量拉取。"""
+    args = request.args
+    server_time = time.time()
+    try:
+        tasks, next_cursor = task_store.query_tasks(
+            client_ip=args.get("client_ip"),
+            task_type=args.get("task_type"),
+            status=args.get("status"),
+            submitted_after=args.get("submitted_after", type=float),
+            submitted_before=args.get("submitted_before", type=float),
+            updated_since=args.get("updated_since", type=float),
+            cursor=args.get("cursor"),
+            limit=min(max(args.get("limit", 50, type=int), 1), TASKS_API_MAX_LIMIT),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"tasks": tasks, "next_cursor": next_cursor, "server_time": server_time})
+
+def _new_task_ids(count):
+    """用 Redis INCRBY 一次分配 count 个全局递增序号，同一秒内多次提交也不会撞 ID。
+
+    列表和分页按 (submitted_at, task_id) 排序，批量提交的任务 submitted_at 相同，
+    序号补零后 "…-0000000010" 才会排在 "…-0000000009" 之后。
+    """
+    last = rds.incrby(TASK_ID_SEQ_KEY, count)
+    timestamp = int(time.time())
+    return [f"{timestamp}-{seq:0{TASK_ID_SEQ_WIDTH}d}" for seq in range(last - count + 1, last + 1)]
+
+def _parse_priority(value):
+    #从表单取优先级，没有就默认 normal
+    priority = (value or "normal").lower()
+    return priority if priority in ("high", "normal") else "normal"
+
+def _resolve_dependency(dependency_id):
+    """依赖任务的结果不再在 master 上解压、重新打包进任务 zip，
+    而是在任务消息里引用上游结果，由 worker 直接下载后解到 input/ 下。"""
+    if not dependency_id:
+        return {}
+    dep_result_name = f"{dependency_id}_result.zip"
+    dep_artifact = artifact_store.lookup(dep_result_name)
+    if dep_artifact is None:
+        logger.warning(f"Dependency result {dep_result_name} not found.")
+        return {}
+    return {
+        "dependency_id": dependency_id,
+        "dependency_zip": dep_result_name,
+        "dependency_digest": dep_artifact["digest"],
+    }
+
+def _resolve_datasets(task_config):
+    """task_config.json 引用的数据集换成任务消息里的 [{name, digest, size}]。
+    引用了没登记的数据集时直接报错，而不是等 worker 下载失败、反复重试。"""
+    refs = parse_dataset_refs(task_config)
+    if not refs:
+        return {}
+    datasets = []
+    for name, digest in refs:
+        dataset = dataset_store.get(digest)
+        if dataset is None or not artifact_store.exists(dataset_artifact_name(digest)):
+            raise ValueError(f"Dataset {name!r} ({digest}) is not registered on the master")
+        datasets.append({"name": name, "digest": digest, "size": dataset["unpacked_bytes"]})
+    dataset_store.mark_used([digest for _, digest in refs])
+    return {"datasets": datasets}
+
+def _submit_tasks(tasks):
+    """登记并入队一批任务。
+
+    tasks: dict 列表，含 task_id / ip / task_type / priority / dependency_id / use_docker，
+    以及要放进 Redis 消息的 message 字段。元数据在一个 SQLite 事务里写入，
+    消息按优先级各用一条 RPUSH，经同一个 pipeline 发出。
+    """
+    events = task_store.create_tasks([{
+        "task_id": t["task_id"], "client_ip": t["ip"], "task_type": t["task_type"],
+        "priority": t["priority"], "dependency_id": t.get("dependency_id"), "use_docker": t.get("use_docker"),
+    } for t in tasks])
+
+    queues = {TASK_QUEUE_HIGH: [], TASK_QUEUE_NORMAL: []}
+    enqueued_at = time.time()
+    for t in tasks:
+        queue_name = TASK_QUEUE_HIGH if t["priority"] == "high" else TASK_QUEUE_NORMAL
+        t["message"]["enqueued_at"] = enqueued_at   # worker 据此记录排队等待的 span
+        queues[queue_name].append(json.dumps(t["message"]))
+
+    # 不再分发task，而是写入 Redis 队列
+    pipe = rds.pipeline(transaction=False)
+    for queue_name, messages in queues.items():
+        if messages:
+            pipe.rpush(queue_name, *messages)
+    pipe.execute()
+    event_hub.publish_many(events)
+    for queue_name, messages in queues.items():
+        if messages:
+            logger.info(f"Pushed {len(messages)} task(s) into Redis queue {queue_name}")
+
+    # 根 span：从收到提交请求到消息入队
+    started = g.request_started if has_request_context() else enqueued_at
+    now = time.time()
+    for t in tasks:
+        trace_id, span_id = t["trace"]
+        trace_store.record(t["task_id"], [make_span(
+            "submit", trace_id, None, started, now, kind="SPAN_KIND_PRODUCER", span_id=span_id,
+            attributes={"task.id": t["task_id"], "task.type": t["task_type"], "task.priority": t["priority"],
+                        "messaging.destination": TASK_QUEUE_HIGH if t["priority"] == "high" else TASK_QUEUE_NORMAL})])
+
+def _make_task(task_id, ip, task_type, priority, digest, size, task_config, dependency_id="", params=None):
+    task_zip = f"{task_id}_task.zip"
+    trace_id, span_id = new_trace_id(), new_span_id()
+    message = {
+        "task_id": task_id,
+        "task_zip": task_zip,
+        "task_type": task_type,
+        "priority": priority,
+        "task_digest": digest,
+        "task_size": size,
+        "traceparent": format_traceparent(trace_id, span_id),
+    }
+    message.update(_resolve_dependency(dependency_id))
+    message.update(_resolve_datasets(task_config))
+    if task_config.get("image"):
+        message["image"] = task_config["image"]   # master 集中构建好的镜像，worker 跳过构建
+    if params is not None:
+        message["params"] = params
+    return {
+        "task_id": task_id,
+        "ip": ip,
+        "task_type": task_type,
+        "priority": priority,
+        "dependency_id": dependency_id,
+        "use_docker": task_config.get("use_docker", True),
+        "message": message,
+        "trace": (trace_id, span_id),
+    }
 
 @app.route(API_BASE + '/start_task', methods=['POST'])
 def start_task():
@@ -228,78 +450,287 @@ def start_task():
         task_file = request.files['task_file']
         task_type = request.form['task_type']
         dependency_id = request.form.get('dependency_id', '').strip()
+        priority = _parse_priority(request.form.get("priority"))
 
-        #从表单取优先级，没有就默认 normal
-        priority = request.form.get("priority", "normal").lower()
-        if priority not in ("high", "normal"):
-            priority = "normal"
-
-        timestamp = str(int(time.time()))
-        filename = secure_filename(task_file.filename)
-        task_id = timestamp
+        task_id = _new_task_ids(1)[0]
         saved_zip_name = f"{task_id}_task.zip"
-        saved_zip_path = os.path.join(TASK_DIR, saved_zip_name)
-        task_file.save(saved_zip_path)
-
-        logger.info(f"Task file saved to {saved_zip_path}")
-
-        if dependency_id:
-            dep_result_path = os.path.join(TASK_DIR, f"{dependency_id}_result.zip")
-            if os.path.exists(dep_result_path):
-                import tempfile
-                with tempfile.TemporaryDirectory() as tmpdir:
-                    with ZipFile(dep_result_path, 'r') as dep_zip:
-                        dep_zip.extractall(os.path.join(tmpdir, "input"))
-                    task_unzip_path = os.path.join(tmpdir, "task")
-                    os.makedirs(task_unzip_path, exist_ok=True)
-                    with ZipFile(saved_zip_path, 'r') as task_zip:
-                        task_zip.extractall(task_unzip_path)
-                    # 把依赖任务的 output 注入到新任务的 input 里
-                    shutil.copytree(os.path.join(tmpdir, "input"), os.path.join(task_unzip_path, "input"), dirs_exist_ok=True)
-                    with ZipFile(saved_zip_path, 'w') as final_zip:
-                        for root, dirs, files in os.walk(task_unzip_path):
-                            for file in files:
-                                abs_path = os.path.join(root, file)
-                                rel_path = os.path.relpath(abs_path, task_unzip_path)
-                                final_zip.write(abs_path, rel_path)
-                logger.info(f"Dependency result from {dependency_id} injected.")
-            else:
-                logger.warning(f"Dependency result {dependency_id}_result.zip not found.")
-
-        status_file = os.path.join(TASK_DIR, f"{task_id}_status.txt")
-        with open(status_file, 'w') as f:
-            f.write(f"Task {task_id} submitted.\n")
-            f.write(f"Submitted at: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"Client IP: {ip}\n")
-            f.write(f"Task type: {task_type}\n")
-            f.write(f"Priority: {priority}\n") 
-            if dependency_id:
-                f.write(f"Depends on: {dependency_id}\n")
-            f.write(f"Current status: queued\n")
-
-        #result = distribute_task(ip, saved_zip_path, saved_zip_name)
-        # 不再分发task，而是写入 Redis 队列
-        task_message = {
-            "task_id": task_id,
-            "task_zip": saved_zip_name,
-            "task_type": task_type,
-            "priority": priority,
-        }
-        if priority == "high":
-            queue_name = TASK_QUEUE_HIGH
-        else:
-            queue_name = TASK_QUEUE_NORMAL
-        rds.rpush(queue_name, json.dumps(task_message))
-        logger.info(f"Pushed task {task_id} into Redis queue {queue_name}")
+        task_digest, task_size = artifact_store.adopt(saved_zip_name, task_file.stream)
+        task_config = _read_task_config(artifact_store.blob_path(task_digest))
+
+        logger.info(f"Task file saved as {saved_zip_name} (sha256={task_digest}, {task_size} bytes)")
+
+        _submit_tasks([_make_task(task_id, ip, task_type, priority, task_digest, task_size,
+                                  task_config, dependency_id)])
         return jsonify({'status': 'success',
                         'message': 'Task queued, waiting for worker to pick it up',
                         'task_id': task_id})
 
-        
     except Exception as e:
         logger.exception("Failed to start task")
         return jsonify({'status': 'error', 'message': str(e)})
 
+@app.route(API_BASE + '/start_tasks', methods=['POST'])
+def start_tasks():
+    """批量提交，两种用法：
+
+    1. 多个任务包：表单里多个 task_files，每个包一个任务；
+    2. 一个任务包 + 多组参数：task_file 加上 params（JSON 数组），每组参数一个任务，
+       共用同一份任务包，worker 把参数写到 task_params.json。
+
+    ip / task_type / priority / dependency_id 对整批生效；没给 task_type 时按 <type>_task.zip 文件名推断。
+    """
+    try:
+        ip = request.form['ip']
+        task_type = request.form.get('task_type', '').strip()
+        dependency_id = request.form.get('dependency_id', '').strip()
+        priority = _parse_priority(request.form.get("priority"))
+        task_files = request.files.getlist('task_files')
+        params_list = json.loads(request.form['params']) if request.form.get('params') else None
+
+        if params_list is not None:
+            task_file = request.files.get('task_file')
+            if task_file is None or not isinstance(params_list, list) or not params_list:
+                return jsonify({'status': 'error', 'message': 'params requires one task_file and a non-empty JSON list'}), 400
+            if len(params_list) > MAX_BATCH_TASKS:
+                return jsonify({'status': 'error', 'message': f'At most {MAX_BATCH_TASKS} tasks per batch'}), 400
+            task_ids = _new_task_ids(len(params_list))
+            names = [f"{task_id}_task.zip" for task_id in task_ids]
+            digest, size = artifact_store.adopt(names[0], task_file.stream)
+            artifact_store.link(names[1:], digest, size)
+            task_config = _read_task_config(artifact_store.blob_path(digest))
+            type_ = task_type or _task_type_from_filename(task_file.filename)
+            tasks = [_make_task(task_id, ip, type_, priority, digest, size, task_config, dependency_id, params)
+                     for task_id, params in zip(task_ids, params_list)]
+        else:
+            if not task_files:
+                return jsonify({'status': 'error', 'message': 'No task_files uploaded'}), 400
+            if len(task_files) > MAX_BATCH_TASKS:
+                return jsonify({'status': 'error', 'message': f'At most {MAX_BATCH_TASKS} tasks per batch'}), 400
+            task_ids = _new_task_ids(len(task_files))
+            tasks = []
+            for task_id, task_file in zip(task_ids, task_files):
+                digest, size = artifact_store.adopt(f"{task_id}_task.zip", task_file.stream)
+                task_config = _read_task_config(artifact_store.blob_path(digest))
+                type_ = task_type or _task_type_from_filename(task_file.filename)
+                tasks.append(_make_task(task_id, ip, type_, priority, digest, size, task_config, dependency_id))
+
+        _submit_tasks(tasks)
+        logger.info(f"Batch submitted {len(tasks)} tasks: {task_ids[0]} .. {task_ids[-1]}")
+        return jsonify({'status': 'success',
+                        'message': f'{len(tasks)} tasks queued',
+                        'task_ids': task_ids})
+
+    except Exception as e:
+        logger.exception("Failed to start batch tasks")
+        return jsonify({'status': 'error', 'message': str(e)})
+
+def _task_type_from_filename(filename):
+    name = secure_filename(filename or "")
+    return name[:-len("_task.zip")] if name.endswith("_task.zip") else "Unknown"
+
+@app.route(API_BASE + '/start_mapreduce', methods=['POST'])
+def start_mapreduce():
+    """map-reduce 提交：task_file 为自定义任务包（main.py + input/，可选 reduce.py），
+    shards 为分片数，split_by 为 count（按文件个数，默认）或 bytes（按字节数）。
+
+    返回的 task_id 是作业本身的任务 ID，查状态、看事件、下载结果都用它；map_task_ids 为各分片的任务。
+    """
+    try:
+        ip = request.form['ip']
+        task_file = request.files['task_file']
+        task_type = request.form.get('task_type', '').strip() or _task_type_from_filename(task_file.filename)
+        dependency_id = request.form.get('dependency_id', '').strip()
+        priority = _parse_priority(request.form.get("priority"))
+        split_by = request.form.get('split_by', 'count')
+        shards = request.form.get('shards', type=int)
+        if not shards or not 1 <= shards <= MAPREDUCE_MAX_SHARDS:
+            return jsonify({'status': 'error', 'message': f'shards must be between 1 and {MAPREDUCE_MAX_SHARDS}'}), 400
+        if split_by not in mapreduce.SPLIT_MODES:
+            return jsonify({'status': 'error', 'message': f'split_by must be one of {", ".join(mapreduce.SPLIT_MODES)}'}), 400
+
+        job_id = _new_task_ids(1)[0]
+        package_name = f"{job_id}_task.zip"
+        package_digest, _ = artifact_store.adopt(package_name, task_file.stream)
+        with tempfile.TemporaryDirectory(dir=artifact_store.tmp_dir) as tmp:
+            try:
+                code_path, shard_paths, has_reduce = mapreduce.split_package(
+                    artifact_store.blob_path(package_digest), shards, split_by, tmp)
+            except (ValueError, zipfile.BadZipFile) as e:
+                artifact_store.delete(package_name)
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+
+            # 原始任务包（含全部输入）换成只有代码的包：作业自己留一份给 reduce 用，各 map 任务共用同一个 blob
+            map_ids = _new_task_ids(len(shard_paths))
+            artifact_store.delete(package_name)
+            code_digest, code_size = artifact_store.put_file(package_name, code_path)
+            artifact_store.link([f"{task_id}_task.zip" for task_id in map_ids], code_digest, code_size)
+            shard_artifacts = [artifact_store.put_file(f"{task_id}_shard.zip", path)
+                               for task_id, path in zip(map_ids, shard_paths)]
+        task_config = _read_task_config(artifact_store.blob_path(code_digest))
+
+        tasks = []
+        for n, (task_id, (shard_digest, _)) in enumerate(zip(map_ids, shard_artifacts)):
+            task = _make_task(task_id, ip, f"{task_type}:map", priority, code_digest, code_size, task_config,
+                              dependency_id, params={"job_id": job_id, "shard": n, "shards": len(map_ids)})
+            task["message"]["inputs"] = [{"name": f"{task_id}_shard.zip", "digest": shard_digest}]
+            tasks.append(task)
+
+        mapreduce_jobs.create(job_id, map_ids, split_by, has_reduce)
+        _publish_events(
+            task_store.create_task(job_id, ip, task_type, priority, dependency_id or None,
+                                   task_config.get("use_docker", True)),
+            task_store.update_status(job_id, status="running", phase="mapping", progress=0,
+                                     message=f"0/{len(map_ids)} shards done"),
+        )
+        _submit_tasks(tasks)
+        logger.info(f"Map-reduce job {job_id}: {len(map_ids)} shards by {split_by}, "
+                    f"{'reduce.py' if has_reduce else 'merge on master'}")
+        return jsonify({'status': 'success',
+                        'message': f'Map-reduce job queued with {len(map_ids)} shards',
+                        'task_id': job_id,
+                        'map_task_ids': map_ids})
+
+    except Exception as e:
+        logger.exception("Failed to start map-reduce job")
+        return jsonify({'status': 'error', 'message': str(e)})
+
+@app.route(API_BASE + '/mapreduce/<job_id>')
+def mapreduce_status(job_id):
+    """作业和各分片的状态。顺便推进一次作业，分片被回收线程直接放进死信队列时也能及时标记失败。"""
+    _advance_mapreduce(job_id)
+    job = mapreduce_jobs.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Map-reduce job not found'}), 404
+    shards = []
+    for n, task_id in enumerate(job.pop("map_task_ids")):
+        task = task_store.get_task(task_id) or {}
+        shards.append({"shard": n, "task_id": task_id, "status": task.get("status"), "phase": task.get("phase"),
+                       "has_result": task.get("has_result", False)})
+    job["shards_detail"] = shards
+    job["result"] = f"/download_result/{job_id}_result.zip" if job["status"] == "done" else None
+    return jsonify(job)
+
+def _publish_events(*events):
+    for event in events:
+        if event:
+            event_hub.publish(event)
+
+def _final_failure(task):
+    return task["status"] == "failed" and task["phase"] in FINAL_PHASES
+
+def _on_mapreduce_task(task_id):
+    """map / reduce 任务有了结果或最终失败时调用；普通任务直接返回。"""
+    link = mapreduce_jobs.job_of(task_id)
+    if link is not None:
+        _advance_mapreduce(link[0])
+
+def _advance_mapreduce(job_id):
+    """按各分片的当前状态推进作业。状态迁移是条件更新，多个进程同时调用也只有一个会去归约/收尾。"""
+    job = mapreduce_jobs.get(job_id)
+    if job is None:
+        return
+    if job["status"] == "mapping":
+        tasks = [task_store.get_task(task_id) for task_id in job["map_task_ids"]]
+        failed = next((t for t in tasks if t and _final_failure(t)), None)
+        if failed is not None:
+            message = f"Shard task {failed['task_id']} failed: {failed['message']}"
+            if mapreduce_jobs.transition(job_id, "mapping", "failed", message):
+                _finish_mapreduce(job_id, False, message)
+            return
+        done = sum(1 for t in tasks if t and t["has_result"])
+        if done < len(tasks):
+            _publish_events(task_store.update_status(job_id, status="running", phase="mapping",
+                                                     progress=80 * done // len(tasks),
+                                                     message=f"{done}/{len(tasks)} shards done"))
+        elif mapreduce_jobs.transition(job_id, "mapping", "reducing", reducer=process_owner()):
+            _start_reduce(job)
+    elif job["status"] == "reducing" and not job["reduce_task_id"]:
+        # 负责归约的进程在提交 reduce 任务/合并完之前退出了（重启、gunicorn 回收 worker），接手重做
+        if mapreduce_jobs.reclaim_reduce(job, process_owner()):
+            logger.warning(f"Map-reduce job {job_id}: reducer {job['reducer']} is gone, restarting reduce")
+            _start_reduce(job)
+    elif job["status"] == "reducing":
+        reduce_task = task_store.get_task(job["reduce_task_id"])
+        result = artifact_store.lookup(f"{job['reduce_task_id']}_result.zip")
+        if reduce_task and reduce_task["has_result"] and result:
+            if mapreduce_jobs.transition(job_id, "reducing", "done"):
+                artifact_store.link([f"{job_id}_result.zip"], result["digest"], result["size"])
+                _finish_mapreduce(job_id, True, "Reduce task finished")
+        elif reduce_task is None or _final_failure(reduce_task):
+            message = f"Reduce task {job['reduce_task_id']} failed"
+            if mapreduce_jobs.transition(job_id, "reducing", "failed", message):
+                _finish_mapreduce(job_id, False, message)
+
+def _start_reduce(job):
+    threading.Thread(target=_reduce_mapreduce, args=(job,), name=f"reduce-{job['job_id']}", daemon=True).start()
+
+def _reduce_mapreduce(job):
+    """所有分片都有结果后在后台线程里执行：有 reduce.py 就提交 reduce 任务，否则在 master 上合并各分片的 output/。"""
+    job_id = job["job_id"]
+    try:
+        results = [artifact_store.lookup(f"{task_id}_result.zip") for task_id in job["map_task_ids"]]
+        if any(r is None for r in results):
+            raise FileNotFoundError("Some shard results are missing")
+        code = artifact_store.lookup(f"{job_id}_task.zip")
+        if code is None:
+            raise FileNotFoundError("Job code package is missing")
+
+        if job["has_reduce"]:
+            _publish_events(task_store.update_status(job_id, status="running", phase="reducing", progress=85,
+                                                     message="Submitting reduce task"))
+            job_task = task_store.get_task(job_id)
+            reduce_id = _new_task_ids(1)[0]
+            with tempfile.TemporaryDirectory(dir=artifact_store.tmp_dir) as tmp:
+                path = os.path.join(tmp, "reduce.zip")
+                mapreduce.make_reduce_package(code["path"], path)
+                digest, size = artifact_store.put_file(f"{reduce_id}_task.zip", path)
+            task = _make_task(reduce_id, job_task["client_ip"], f"{job_task['task_type']}:reduce",
+                              job_task["priority"], digest, size, _read_task_config(code["path"]),
+                              params={"job_id": job_id, "shards": job["shards"]})
+            task["message"]["inputs"] = [
+                {"name": f"{task_id}_result.zip", "digest": r["digest"], "dest": f"input/{mapreduce.shard_dir(n)}"}
+                for n, (task_id, r) in enumerate(zip(job["map_task_ids"], results))]
+            # 先入队再登记：登记之后 reduce_task_id 就指向一个一定存在的任务；
+            # 两步之间进程退出的话作业仍没有 reduce 任务，会被接手重新提交
+            _submit_tasks([task])
+            mapreduce_jobs.add_reduce_task(job_id, reduce_id)
+            logger.info(f"Map-reduce job {job_id}: submitted reduce task {reduce_id}")
+        else:
+            _publish_events(task_store.update_status(job_id, status="running", phase="reducing", progress=85,
+                                                     message=f"Merging {len(results)} shard results"))
+            with tempfile.TemporaryDirectory(dir=artifact_store.tmp_dir) as tmp:
+                path = os.path.join(tmp, "merged.zip")
+                mapreduce.merge_results([r["path"] for r in results], path)
+                artifact_store.put_file(f"{job_id}_result.zip", path)
+            if mapreduce_jobs.transition(job_id, "reducing", "done"):
+                _finish_mapreduce(job_id, True, f"Merged {len(results)} shard results")
+    except Exception as e:
+        logger.exception(f"Map-reduce job {job_id} failed to reduce")
+        if mapreduce_jobs.transition(job_id, "reducing", "failed", str(e)):
+            _finish_mapreduce(job_id, False, f"Reduce failed: {e}")
+
+def _finish_mapreduce(job_id, ok, message):
+    """作业结束：和 worker 一样发 completed_* + cleanup 两条事件，前端和 SSE 按普通任务的结束处理。"""
+    if ok:
+        _publish_events(task_store.mark_result(job_id),
+                        task_store.update_status(job_id, status="success", phase="completed_success",
+                                                 progress=100, message=message))
+    else:
+        _publish_events(task_store.update_status(job_id, status="failed", phase="completed_failed", message=message))
+    _publish_events(task_store.update_status(job_id, phase="cleanup", message="Map-reduce job finished"))
+    artifact_store.delete(f"{job_id}_task.zip")
+    logger.info(f"Map-reduce job {job_id} {'finished' if ok else 'failed'}: {message}")
+
+def _recover_mapreduce_jobs():
+    """启动时把停在 reducing 的作业都推进一遍：归约进程已经不在的由本进程接手。"""
+    for job_id in mapreduce_jobs.reducing_job_ids():
+        try:
+            _advance_mapreduce(job_id)
+        except Exception:
+            logger.exception(f"Failed to recover map-reduce job {job_id}")
+
+threading.Thread(target=_recover_mapreduce_jobs, name="mapreduce-recover", daemon=True).start()
+
 # 这个函数暂时保留但不用了
 # def distribute_task(ip, task_path, remote_name):
 #     try:
@@ -320,90 +751,303 @@ def start_task():
 
 @app.route(API_BASE + '/task_status/<task_id>')
 def task_status(task_id):
-    status_file = os.path.join(TASK_DIR, f"{task_id}_status.txt")
-    result_zip = os.path.join(TASK_DIR, f"{task_id}_result.zip")
-
-    if not os.path.exists(status_file):
+    task = task_store.get_task(task_id)
+    if task is None:
         return jsonify({'status': 'error', 'message': 'Task not found'})
 
-    with open(status_file, 'r') as f:
-        content = f.read()
+    result_url = f"/download_result/{task_id}_result.zip" if task["has_result"] else None
 
-    result_url = f"/download_result/{task_id}_result.zip" if os.path.exists(result_zip) else None
+    return jsonify({'status': task['status'],
+                    'phase': task['phase'],
+                    'progress': task['progress'],
+                    'log': format_status_log(task),
+                    'result': result_url,
+                    'metrics': task_store.get_metrics(task_id)})
 
-    return jsonify({'status': 'completed', 'log': content, 'result': result_url})
+def _apply_status(task_id, data):
+    """写入一条 worker 上报的状态并推送事件，返回 (响应体, 状态码)。"""
+    status = data.get("status")
+    phase = data.get("phase")
+
+    if status is not None and status not in ("running", "success", "failed"):
+        return {"error": "Invalid status"}, 400
+
+    event = task_store.update_status(task_id, status=status, phase=phase,
+                                     progress=data.get("progress"), message=data.get("msg"))
+    if event is None:
+        return {"error": "Task not found"}, 404
+    if isinstance(data.get("metrics"), dict):
+        task_store.record_metrics(task_id, data["metrics"])
+    event_hub.publish(event)
+    if event["status"] == "failed" and phase in FINAL_PHASES:
+        _on_mapreduce_task(task_id)
+    app.logger.info(f"[STATUS] Task {task_id} reported phase={phase} status={status}")
+    return {"message": "Status updated"}, 200
 
 @app.route(API_BASE + "/report_status/<task_id>", methods=["POST"])
 def report_status(task_id):
-    data = request.get_json()
-    status = data.get("status")
-
-    if status not in ("running", "success", "failed"):
-        return jsonify({"error": "Invalid status"}), 400
-
-    with status_lock:
-        task_status_map[task_id] = status
-    app.logger.info(f"[STATUS] Task {task_id} reported status: {status}")
-    return jsonify({"message": "Status updated"}), 200
+    body, code = _apply_status(task_id, request.get_json() or {})
+    return jsonify(body), code
+
+@app.route(API_BASE + "/report_status_batch", methods=["POST"])
+def report_status_batch():
+    """worker 的异步上报线程一次发多条：{"updates": [{"task_id": ..., "phase": ..., ...}, ...]}，按顺序应用。"""
+    data = request.get_json(silent=True) or {}
+    updates = data.get("updates")
+    if not isinstance(updates, list):
+        return jsonify({"error": "Expected a list of updates"}), 400
+    results = []
+    for update in updates:
+        if not isinstance(update, dict) or not update.get("task_id"):
+            results.append({"code": 400, "error": "Missing task_id"})
+            continue
+        body, code = _apply_status(update["task_id"], update)
+        results.append(dict(body, task_id=update["task_id"], code=code))
+    return jsonify({"results": results}), 200
+
+@app.route(API_BASE + "/task_log/<task_id>", methods=["POST"])
+def append_task_log(task_id):
+    """worker 上传一批输出：{"lines": [{"stream": "stdout", "line": "..."}], "dropped": 0}。"""
+    data = request.get_json(silent=True) or {}
+    lines = data.get("lines")
+    if not isinstance(lines, list):
+        return jsonify({"error": "Expected a list of lines"}), 400
+    if task_store.get_task(task_id) is None:
+        return jsonify({"error": "Task not found"}), 404
+    offset, text, truncated = task_logs.append(task_id, lines, dropped=int(data.get("dropped") or 0))
+    if text:
+        event_hub.publish({"type": "log", "task_id": task_id, "offset": offset, "text": text})
+    return jsonify({"offset": offset, "truncated": truncated}), 200
+
+@app.route(API_BASE + "/task_log/<task_id>", methods=["GET"])
+def get_task_log(task_id):
+    """增量读取任务输出：?offset= 为上次返回的 next_offset。"""
+    chunk = task_logs.read(task_id, request.args.get("offset", 0, type=int))
+    if chunk is None:
+        if task_store.get_task(task_id) is None:
+            return jsonify({"error": "Task not found"}), 404
+        chunk = {"offset": 0, "next_offset": 0, "size": 0, "truncated": False, "text": ""}
+    return jsonify(chunk)
+
+@app.route(API_BASE + "/traces/<task_id>", methods=["POST"])
+def collect_spans(task_id):
+    """worker 任务结束后上传它记录的 span：{"spans": [...]}。"""
+    spans = (request.get_json(silent=True) or {}).get("spans")
+    if not isinstance(spans, list):
+        return jsonify({"error": "Expected a list of spans"}), 400
+    if trace_store.path(task_id) is None:
+        return jsonify({"error": "Invalid task id"}), 400
+    trace_store.record(task_id, [s for s in spans if isinstance(s, dict) and s.get("traceId") and s.get("spanId")])
+    return jsonify({"accepted": len(spans)}), 200
+
+@app.route(API_BASE + "/trace/<task_id>")
+def task_trace(task_id):
+    """任务的时间线：所有 span 按开始时间排序，带相对偏移和耗时。"""
+    timeline = trace_store.timeline(task_id)
+    if timeline is None:
+        return jsonify({"error": "No trace recorded for this task"}), 404
+    return jsonify(timeline)
+
+@app.route(API_BASE + "/trace/<task_id>/view")
+def task_trace_view(task_id):
+    return render_template("trace.html", task_id=task_id, api_base=API_BASE)
+
+def _sse_response(stream):
+    resp = Response(stream_with_context(stream), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # 关闭 nginx 缓冲，事件才能及时推到浏览器
+    return resp
+
+@app.route(API_BASE + "/events")
+def task_events_all():
+    """看板用：所有任务的状态事件流。断线重连后由前端用 /tasks?updated_since 补齐。"""
+    return _sse_response(event_hub.stream())
+
+@app.route(API_BASE + "/events/<task_id>")
+def task_events(task_id):
+    """单个任务的事件流：先补发 Last-Event-ID 之后的历史事件，任务结束后关闭。"""
+    task = task_store.get_task(task_id)
+    if task is None:
+        return jsonify({'status': 'error', 'message': 'Task not found'}), 404
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or 0
+    try:
+        last_id = int(last_id)
+    except ValueError:
+        last_id = 0
+
+    # 已经结束的任务（包括迁移过来、没有事件记录的旧任务）只补发历史，没有历史就发一条当前快照
+    finished = task["status"] in TERMINAL_STATUSES and task["phase"] in FINAL_PHASES
+
+    def backlog():
+        events = task_store.list_events(task_id, after_id=last_id)
+        if finished and not events:
+            events = [{"id": last_id, "task_id": task_id, "ts": task["updated_at"], "phase": task["phase"],
+                       "status": task["status"], "progress": task["progress"], "message": task["message"],
+                       "has_result": task["has_result"]}]
+        return events
+
+    stream = event_hub.stream(
+        task_id,
+        backlog=backlog,
+        until=lambda e: e.get("status") in TERMINAL_STATUSES and e.get("phase") in FINAL_PHASES,
+        live=not finished,
+    )
+    return _sse_response(stream)
+
+def _read_task_config(zip_path):
+    """只读 zip 的中央目录和 task_config.json 这一个成员；没有或解析失败时返回空 dict。"""
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            if "task_config.json" in zip_ref.namelist():
+                with zip_ref.open("task_config.json") as f:
+                    return json.load(f)
+    except Exception as e:
+        logger.warning(f"Failed to read task_config.json from {zip_path}: {e}")
+    return {}
 
 @app.route(API_BASE + '/upload_result/<filename>', methods=['POST'])
 def upload_result(filename):
-    file = request.files['file']
-    save_path = os.path.join(TASK_DIR, filename)
-    file.save(save_path)
+    filename = secure_filename(filename)
+    if not filename.endswith("_result.zip"):
+        return jsonify({'status': 'error', 'message': 'Invalid result filename'}), 400
 
-    task_id = filename.replace("_result.zip", "")
-    status_file = os.path.join(TASK_DIR, f"{task_id}_status.txt")
+    # 支持两种上传方式：multipart 的 file 字段，或者请求体直接就是 zip（流式写入，不解析表单）
+    if request.mimetype == "multipart/form-data":
+        digest, size = artifact_store.adopt(filename, request.files['file'].stream)
+    else:
+        digest, size = artifact_store.put_stream(filename, request.stream)
 
-    # === 从 result.zip 里提取 use_docker 信息 ===
+    # 只读中央目录校验 zip 完整性，不再解压整个结果包
     try:
-        import zipfile
-        import json
-        with zipfile.ZipFile(save_path, 'r') as zip_ref:
-            zip_ref.extractall(f"/tmp/{task_id}_result")  # 临时解压
-
-        # 尝试读取原任务包中的 config 文件
-        task_zip_path = os.path.join(TASK_DIR, f"{task_id}_task.zip")
-        if os.path.exists(task_zip_path):
-            with zipfile.ZipFile(task_zip_path, 'r') as zip_ref:
-                if "task_config.json" in zip_ref.namelist():
-                    with zip_ref.open("task_config.json") as f:
-                        config = json.load(f)
-                        use_docker = config.get("use_docker", True)
-                else:
-                    use_docker = True
-        else:
-            use_docker = True
-    except Exception as e:
-        logger.warning(f"Failed to parse use_docker config: {e}")
-        use_docker = True
+        with zipfile.ZipFile(artifact_store.blob_path(digest), 'r') as zip_ref:
+            member_count = len(zip_ref.infolist())
+    except zipfile.BadZipFile:
+        artifact_store.delete(filename)
+        return jsonify({'status': 'error', 'message': 'Result is not a valid zip file'}), 400
+
+    task_id = filename.replace("_result.zip", "")
 
-    if os.path.exists(status_file):
-        with open(status_file, 'a') as f:
-            f.write(f"Completed at: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"Use Docker: {use_docker}\n")
+    # use_docker 在提交时已从任务包的 task_config.json 记下；旧任务才回头读一次任务包
+    use_docker = None
+    task = task_store.get_task(task_id)
+    if task is None or task["use_docker"] is None:
+        task_artifact = artifact_store.lookup(f"{task_id}_task.zip")
+        config = _read_task_config(task_artifact["path"]) if task_artifact else {}
+        use_docker = config.get("use_docker", True)
 
-    # 结果上传成功后，删除原始任务包 {_task.zip}
+    event = task_store.mark_result(task_id, use_docker)
+    if event:
+        event_hub.publish(event)
+
+    # 结果上传成功后，删除原始任务包 {_task.zip} 的引用（内容相同的其他任务包不受影响）
+    task_zip_name = f"{task_id}_task.zip"
     try:
-        task_zip_path = os.path.join(TASK_DIR, f"{task_id}_task.zip")
-        if os.path.exists(task_zip_path):
-            os.remove(task_zip_path)
-            logger.info(f"Deleted task package: {task_zip_path}")
+        if artifact_store.delete(task_zip_name):
+            logger.info(f"Deleted task package: {task_zip_name}")
         else:
-            logger.info(f"Task package not found for cleanup: {task_zip_path}")
+            logger.info(f"Task package not found for cleanup: {task_zip_name}")
     except Exception as e:
-        logger.warning(f"Failed to delete task package {task_zip_path}: {e}")
+        logger.warning(f"Failed to delete task package {task_zip_name}: {e}")
+    artifact_store.delete(f"{task_id}_shard.zip")   # map 任务的输入分片也用完了
 
-    logger.info(f"Received result: {filename}")
+    logger.info(f"Received result: {filename} (sha256={digest}, {size} bytes, {member_count} members)")
+    _on_mapreduce_task(task_id)
     return jsonify({'status': 'success', 'message': 'Result uploaded successfully'})
 
+def _send_artifact(filename):
+    """从内容寻址存储发送文件：ETag 为 SHA-256，支持 If-None-Match 和 Range（断点续传）。"""
+    artifact = artifact_store.lookup(secure_filename(filename))
+    if artifact is None:
+        return send_from_directory(TASK_DIR, filename)  # 兼容尚未导入存储的旧文件
+    artifact_store.touch(artifact["name"])
+    resp = send_file(artifact["path"], mimetype="application/zip", as_attachment=True,
+                     download_name=artifact["name"], etag=artifact["digest"], conditional=True)
+    resp.headers["X-Content-SHA256"] = artifact["digest"]
+    return resp
+
+@app.route(API_BASE + '/pypi/simple/')
+def pypi_index():
+    return Response(wheelhouse.render_root(), mimetype="text/html")
+
+@app.route(API_BASE + '/pypi/simple/<project>/')
+def pypi_project(project):
+    normalized = normalize_name(project)
+    if normalized != project:
+        return redirect(f"{API_BASE}/pypi/simple/{normalized}/", code=301)
+    page = wheelhouse.render_project(project)
+    if page is None:
+        return Response("Not Found", status=404, mimetype="text/plain")
+    return Response(page, mimetype="text/html")
+
+@app.route(API_BASE + '/pypi/files/<filename>')
+def pypi_file(filename):
+    path = wheelhouse.fetch(filename)
+    if path is None:
+        return Response("Not Found", status=404, mimetype="text/plain")
+    return send_file(path, mimetype="application/octet-stream", as_attachment=True, download_name=filename,
+                     conditional=True)
+
 @app.route(API_BASE + '/download_result/<filename>')
 def download_result(filename):
-    return send_from_directory(TASK_DIR, filename)
+    return _send_artifact(filename)
 
 @app.route(API_BASE + '/download_task/<filename>')
 def download_task(filename):
-    return send_from_directory(TASK_DIR, filename)
+    return _send_artifact(filename)
+
+@app.route(API_BASE + '/datasets', methods=['POST'])
+def register_dataset():
+    """登记数据集：dataset 为 zip 文件（解压后整体出现在任务的 input/<名字>/ 下），name 为可选的说明。
+
+    相同内容重复上传只存一份；返回的 digest 写进任务包 task_config.json 的 datasets 里。
+    """
+    upload = request.files.get('dataset')
+    if upload is None:
+        return jsonify({'status': 'error', 'message': 'No dataset uploaded'}), 400
+    spool = upload.stream   # ArtifactRequest 落盘时已经算好了 sha256
+    spool.flush()
+    try:
+        files, unpacked_bytes = inspect_dataset_zip(spool.path)
+    except ValueError as e:
+        spool.close()
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    digest = spool.digest
+    name = dataset_artifact_name(digest)
+    if artifact_store.exists(name):
+        size = spool.size
+        spool.close()
+    else:
+        digest, size = artifact_store.adopt(name, spool)
+    dataset = dataset_store.register(digest, size, unpacked_bytes, files, request.form.get('name', '').strip())
+    logger.info(f"Dataset registered: {digest} ({files} files, {size} bytes)")
+    return jsonify(dict(dataset, status='success'))
+
+@app.route(API_BASE + '/datasets')
+def list_datasets():
+    return jsonify({"datasets": dataset_store.list()})
+
+@app.route(API_BASE + '/datasets/<digest>', methods=['GET', 'DELETE'])
+def dataset_detail(digest):
+    dataset = dataset_store.get(digest)
+    if dataset is None:
+        return jsonify({'status': 'error', 'message': 'Dataset not found'}), 404
+    if request.method == 'DELETE':
+        # 已经在排队的任务会下载失败；worker 本地缓存里的副本按 LRU 自然淘汰
+        dataset_store.delete(digest)
+        artifact_store.delete(dataset_artifact_name(digest))
+        logger.info(f"Dataset deleted: {digest}")
+        return jsonify({'status': 'success', 'message': 'Dataset deleted'})
+    return jsonify(dataset)
+
+@app.route(API_BASE + '/download_dataset/<filename>')
+def download_dataset(filename):
+    return _send_artifact(filename)
+
+@app.route(API_BASE + '/download_input/<filename>')
+def download_input(filename):
+    """任务消息 inputs 里引用的额外输入（map 分片、reduce 要汇总的各分片结果）。"""
+    return _send_artifact(filename)
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
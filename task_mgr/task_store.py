@@ -0,0 +1,443 @@
+# task_store.py - 任务元数据索引（SQLite），替代每次扫描 *_status.txt
+
+import base64
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+TIME_FMT = "%Y-%m-%d %H:%M:%S"
+
+# worker 随任务结束上报的资源用量字段（阶段耗时单独存成 JSON）
+METRIC_COLUMNS = ("node", "total_sec", "cpu_user_sec", "cpu_sys_sec", "max_rss_bytes",
+                  "read_bytes", "write_bytes", "resource_source")
+
+# worker 上报的 phase -> 任务状态；不在表里的 phase（如 cleanup）不改变状态
+PHASE_STATUS = {
+    "queued": "running",
+    "image_build": "running",
+    "image_built": "running",
+    "container_started": "running",
+    "running": "running",
+    "completed_success": "success",
+    "completed_failed": "failed",
+    "requeued": "queued",      # worker 丢失后由回收线程放回队列
+    "dead_letter": "failed",   # 重试次数用完，进了死信队列
+}
+
+TASK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id       TEXT PRIMARY KEY,
+    client_ip     TEXT NOT NULL DEFAULT 'Unknown',
+    task_type     TEXT NOT NULL DEFAULT 'Unknown',
+    priority      TEXT NOT NULL DEFAULT 'normal',
+    dependency_id TEXT,
+    status        TEXT NOT NULL DEFAULT 'queued',
+    phase         TEXT,
+    progress      INTEGER,
+    message       TEXT,
+    use_docker    INTEGER,
+    has_result    INTEGER NOT NULL DEFAULT 0,
+    submitted_at  REAL NOT NULL,
+    finished_at   REAL,
+    updated_at    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_submitted ON tasks(submitted_at, task_id);
+CREATE INDEX IF NOT EXISTS idx_tasks_ip ON tasks(client_ip, submitted_at);
+CREATE INDEX IF NOT EXISTS idx_tasks_result ON tasks(has_result, submitted_at);
+CREATE INDEX IF NOT EXISTS idx_tasks_updated ON tasks(updated_at, task_id);
+CREATE TABLE IF NOT EXISTS task_events (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id   TEXT NOT NULL,
+    ts        REAL NOT NULL,
+    phase     TEXT,
+    status    TEXT,
+    progress  INTEGER,
+    message   TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_events_task ON task_events(task_id, id);
+CREATE TABLE IF NOT EXISTS task_metrics (
+    task_id         TEXT PRIMARY KEY,
+    node            TEXT,
+    total_sec       REAL,
+    phases          TEXT,
+    cpu_user_sec    REAL,
+    cpu_sys_sec     REAL,
+    max_rss_bytes   INTEGER,
+    read_bytes      INTEGER,
+    write_bytes     INTEGER,
+    resource_source TEXT,
+    recorded_at     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_metrics_recorded ON task_metrics(recorded_at);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def format_ts(ts):
+    return time.strftime(TIME_FMT, time.localtime(ts)) if ts else None
+
+
+def parse_ts(text):
+    try:
+        return time.mktime(time.strptime(text, TIME_FMT))
+    except (TypeError, ValueError):
+        return None
+
+
+def process_owner():
+    """当前进程的标识 host:pid，记在“由哪个进程负责”的字段里（进程内线程池执行的构建、归约等）。"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def owner_gone(owner):
+    """owner 对应的进程已经不在了。只能判断本机的进程，其他机器上的一律当作还在；没有 owner 的旧数据算不在。"""
+    if not owner:
+        return True
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+class SQLiteStore:
+    """SQLite 存储基类。每个线程一个连接，WAL 模式下多个 gunicorn worker 可以同时读写。"""
+
+    SCHEMA = ""
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+
+class TaskStore(SQLiteStore):
+    """任务元数据存储。"""
+
+    SCHEMA = TASK_SCHEMA
+
+    # ---------- 写入 ----------
+    # 以下写入方法都会在同一个事务里追加一条 task_events 记录并返回它，供调用方广播
+    def create_task(self, task_id, client_ip, task_type, priority="normal", dependency_id=None, use_docker=None):
+        return self.create_tasks([{
+            "task_id": task_id, "client_ip": client_ip, "task_type": task_type,
+            "priority": priority, "dependency_id": dependency_id, "use_docker": use_docker,
+        }])[0]
+
+    def create_tasks(self, tasks):
+        """批量登记任务（同一个事务），返回对应的事件列表。tasks 为 dict 列表，字段同 create_task 参数。"""
+        now = time.time()
+        events = []
+        with self._conn() as conn:
+            for t in tasks:
+                use_docker = t.get("use_docker")
+                conn.execute(
+                    "INSERT OR REPLACE INTO tasks (task_id, client_ip, task_type, priority, dependency_id,"
+                    " use_docker, status, submitted_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                    (t["task_id"], t["client_ip"], t["task_type"], t.get("priority", "normal"),
+                     t.get("dependency_id") or None, None if use_docker is None else int(bool(use_docker)),
+                     now, now),
+                )
+                events.append(self._add_event(conn, t["task_id"], now, phase="submitted", message="Task queued"))
+        return events
+
+    def update_status(self, task_id, status=None, phase=None, progress=None, message=None):
+        """按 worker 上报更新状态；status 为空时按 phase 推导。任务不存在时返回 None。"""
+        if status is None and phase is not None:
+            status = PHASE_STATUS.get(phase)
+        now = time.time()
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE tasks SET status = COALESCE(?, status), phase = COALESCE(?, phase),"
+                " progress = COALESCE(?, progress), message = COALESCE(?, message), updated_at = ?"
+                " WHERE task_id = ?",
+                (status, phase, progress, message, now, task_id),
+            )
+            if cur.rowcount == 0:
+                return None
+            return self._add_event(conn, task_id, now, phase=phase, progress=progress, message=message)
+
+    def mark_result(self, task_id, use_docker=None):
+        now = time.time()
+        use_docker = None if use_docker is None else int(bool(use_docker))
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE tasks SET has_result = 1, use_docker = COALESCE(?, use_docker), finished_at = ?,"
+                " updated_at = ? WHERE task_id = ?",
+                (use_docker, now, now, task_id),
+            )
+            if cur.rowcount == 0:
+                return None
+            return self._add_event(conn, task_id, now, phase="result_uploaded", message="Result uploaded")
+
+    def clear_result(self, task_id):
+        """结果被保留策略清理后调用。"""
+        now = time.time()
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE tasks SET has_result = 0, updated_at = ? WHERE task_id = ? AND has_result = 1",
+                (now, task_id),
+            )
+            if cur.rowcount == 0:
+                return None
+            return self._add_event(conn, task_id, now, phase="result_evicted", message="Result removed by retention")
+
+    def record_metrics(self, task_id, metrics):
+        """保存一次执行的阶段耗时和资源用量；任务被重新执行时覆盖上一次的。"""
+        values = [metrics.get(c) for c in METRIC_COLUMNS]
+        phases = metrics.get("phases") or {}
+        with self._conn() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO task_metrics (task_id, phases, recorded_at, {', '.join(METRIC_COLUMNS)})"
+                f" VALUES (?, ?, ?, {', '.join('?' for _ in METRIC_COLUMNS)})",
+                (task_id, json.dumps(phases), time.time(), *values),
+            )
+
+    def _add_event(self, conn, task_id, ts, phase=None, progress=None, message=None):
+        row = conn.execute("SELECT status, has_result FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        cur = conn.execute(
+            "INSERT INTO task_events (task_id, ts, phase, status, progress, message) VALUES (?, ?, ?, ?, ?, ?)",
+            (task_id, ts, phase, row["status"], progress, message),
+        )
+        return {"id": cur.lastrowid, "task_id": task_id, "ts": ts, "phase": phase, "status": row["status"],
+                "progress": progress, "message": message, "has_result": bool(row["has_result"])}
+
+    # ---------- 读取 ----------
+    def get_task(self, task_id):
+        row = self._conn().execute("SELECT * FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def page_tasks(self, page=1, per_page=50):
+        """按提交时间倒序分页，返回 (tasks, total)。"""
+        page = max(page, 1)
+        conn = self._conn()
+        total = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+        rows = conn.execute(
+            "SELECT * FROM tasks ORDER BY submitted_at DESC, task_id DESC LIMIT ? OFFSET ?",
+            (per_page, (page - 1) * per_page),
+        ).fetchall()
+        return [self._to_dict(r) for r in rows], total
+
+    def list_result_task_ids(self, limit=200):
+        rows = self._conn().execute(
+            "SELECT task_id FROM tasks WHERE has_result = 1 ORDER BY submitted_at DESC, task_id DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+        return [r["task_id"] for r in rows]
+
+    def query_tasks(self, client_ip=None, task_type=None, status=None, submitted_after=None,
+                    submitted_before=None, updated_since=None, cursor=None, limit=50):
+        """带过滤条件的游标分页，返回 (tasks, next_cursor)。
+
+        默认按提交时间倒序；给出 updated_since 时改为按更新时间正序，
+        只返回该时间点之后有变化的任务，供看板增量刷新。
+        """
+        where, args = [], []
+        for column, value in (("client_ip", client_ip), ("task_type", task_type), ("status", status)):
+            if value:
+                where.append(f"{column} = ?")
+                args.append(value)
+        if submitted_after is not None:
+            where.append("submitted_at >= ?")
+            args.append(submitted_after)
+        if submitted_before is not None:
+            where.append("submitted_at < ?")
+            args.append(submitted_before)
+
+        if updated_since is not None:
+            key, order, cmp = "updated_at", "ASC", ">"
+            where.append("updated_at >= ?")
+            args.append(updated_since)
+        else:
+            key, order, cmp = "submitted_at", "DESC", "<"
+        if cursor:
+            last_ts, last_id = decode_cursor(cursor)
+            where.append(f"({key}, task_id) {cmp} (?, ?)")
+            args.extend([last_ts, last_id])
+
+        sql = "SELECT * FROM tasks"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {key} {order}, task_id {order} LIMIT ?"
+        rows = self._conn().execute(sql, args + [limit + 1]).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][key], rows[-1]["task_id"])
+        return [self._to_dict(r) for r in rows], next_cursor
+
+    def active_task_ids(self):
+        """还没结束的任务（queued / running）。"""
+        rows = self._conn().execute("SELECT task_id FROM tasks WHERE status IN ('queued', 'running')").fetchall()
+        return {r["task_id"] for r in rows}
+
+    def pending_dependencies(self):
+        """还没结束的任务所依赖的上游任务 ID，这些任务的结果不能被清理。"""
+        rows = self._conn().execute(
+            "SELECT DISTINCT dependency_id FROM tasks"
+            " WHERE dependency_id IS NOT NULL AND status IN ('queued', 'running')"
+        ).fetchall()
+        return {r["dependency_id"] for r in rows}
+
+    def list_events(self, task_id, after_id=0, limit=500):
+        rows = self._conn().execute(
+            "SELECT e.*, t.has_result FROM task_events e JOIN tasks t ON t.task_id = e.task_id"
+            " WHERE e.task_id = ? AND e.id > ? ORDER BY e.id LIMIT ?",
+            (task_id, after_id, limit),
+        ).fetchall()
+        return [dict(r, has_result=bool(r["has_result"])) for r in rows]
+
+    def get_metrics(self, task_id):
+        row = self._conn().execute("SELECT * FROM task_metrics WHERE task_id = ?", (task_id,)).fetchone()
+        return self._metrics_dict(row) if row else None
+
+    def metric_rows(self, since=None, task_type=None, node=None):
+        """带任务类型的统计记录，供 /metrics 聚合。"""
+        where, args = [], []
+        for column, value in (("m.recorded_at >= ", since), ("t.task_type = ", task_type), ("m.node = ", node)):
+            if value is not None and value != "":
+                where.append(f"{column}?")
+                args.append(value)
+        sql = "SELECT m.*, t.task_type FROM task_metrics m JOIN tasks t ON t.task_id = m.task_id"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return [self._metrics_dict(r) for r in self._conn().execute(sql, args).fetchall()]
+
+    @staticmethod
+    def _metrics_dict(row):
+        metrics = dict(row)
+        metrics["phases"] = json.loads(metrics["phases"] or "{}")
+        return metrics
+
+    @staticmethod
+    def _to_dict(row):
+        task = dict(row)
+        task["id"] = task["task_id"]
+        task["has_result"] = bool(task["has_result"])
+        task["use_docker"] = None if task["use_docker"] is None else bool(task["use_docker"])
+        task["submit_time"] = format_ts(task["submitted_at"])
+        task["finish_time"] = format_ts(task["finished_at"])
+        return task
+
+    # ---------- 旧数据迁移 ----------
+    def migrate_status_files(self, task_dir):
+        """把旧的 {task_id}_status.txt 一次性导入数据库，已迁移过则直接返回导入条数 0。"""
+        task_dir = Path(task_dir)
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            done = conn.execute("SELECT value FROM meta WHERE key = 'status_files_migrated'").fetchone()
+            if done:
+                return 0
+            count = 0
+            for f in task_dir.glob("*_status.txt"):
+                record = _parse_status_file(f)
+                record["task_id"] = f.name.replace("_status.txt", "")
+                record["has_result"] = int((task_dir / f"{record['task_id']}_result.zip").exists())
+                if record["has_result"]:
+                    record["status"] = "success"
+                record["submitted_at"] = record["submitted_at"] or f.stat().st_mtime
+                record["updated_at"] = record["finished_at"] or record["submitted_at"]
+                cols = ", ".join(record)
+                marks = ", ".join("?" for _ in record)
+                conn.execute(f"INSERT OR IGNORE INTO tasks ({cols}) VALUES ({marks})", tuple(record.values()))
+                count += 1
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('status_files_migrated', ?)",
+                (format_ts(time.time()),),
+            )
+        return count
+
+
+def _parse_status_file(path):
+    record = {
+        "client_ip": "Unknown",
+        "task_type": "Unknown",
+        "priority": "normal",
+        "dependency_id": None,
+        "status": "queued",
+        "use_docker": None,
+        "submitted_at": None,
+        "finished_at": None,
+    }
+    with open(path, "r") as sf:
+        for line in sf:
+            if ":" not in line:
+                continue
+            key, value = (s.strip() for s in line.split(":", 1))
+            if key == "Submitted at":
+                record["submitted_at"] = parse_ts(value)
+            elif key == "Completed at":
+                record["finished_at"] = parse_ts(value)
+            elif key == "Client IP":
+                record["client_ip"] = value
+            elif key == "Task type":
+                record["task_type"] = value
+            elif key == "Priority":
+                record["priority"] = value
+            elif key == "Depends on":
+                record["dependency_id"] = value
+            elif key == "Current status":
+                record["status"] = value
+            elif key == "Use Docker":
+                record["use_docker"] = int(value.lower() == "true")
+    return record
+
+
+def encode_cursor(ts, task_id):
+    return base64.urlsafe_b64encode(json.dumps([ts, task_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """解析游标，格式不对时抛 ValueError。"""
+    try:
+        ts, task_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(ts), str(task_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def format_status_log(task):
+    """按旧 status 文件的格式渲染任务记录，供 task_status 接口的 log 字段使用。"""
+    lines = [
+        f"Task {task['task_id']} submitted.",
+        f"Submitted at: {task['submit_time']}",
+        f"Client IP: {task['client_ip']}",
+        f"Task type: {task['task_type']}",
+        f"Priority: {task['priority']}",
+    ]
+    if task["dependency_id"]:
+        lines.append(f"Depends on: {task['dependency_id']}")
+    lines.append(f"Current status: {task['status']}")
+    if task["phase"]:
+        progress = f" ({task['progress']}%)" if task["progress"] is not None else ""
+        lines.append(f"Phase: {task['phase']}{progress} {task['message'] or ''}".rstrip())
+    if task["finish_time"]:
+        lines.append(f"Completed at: {task['finish_time']}")
+    if task["use_docker"] is not None:
+        lines.append(f"Use Docker: {task['use_docker']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,110 @@
+# 测试直接 import task_mgr 下的模块（和 master / worker 的运行方式一样，模块之间按文件名互相引用）
+import hashlib
+import json
+import logging
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from task_store import TaskStore  # noqa: E402
+
+
+class RecordingHub:
+    """代替 EventHub：只记下发布过的事件。"""
+
+    def __init__(self):
+        self.events = []
+
+    def publish(self, event):
+        self.events.append(event)
+
+    def publish_many(self, events):
+        self.events.extend(events)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return tmp_path / "tasks.db"
+
+
+@pytest.fixture
+def task_store(db_path):
+    return TaskStore(db_path)
+
+
+@pytest.fixture
+def hub():
+    return RecordingHub()
+
+
+@pytest.fixture
+def rds():
+    fakeredis = pytest.importorskip("fakeredis")
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture(scope="session")
+def client():
+    """worker 的 client.py。导入时它会在 /home/pi 下建目录、打开 client.log，测试里跳过这两步。"""
+    with mock.patch("os.makedirs"), mock.patch("logging.FileHandler", lambda *a, **kw: logging.NullHandler()):
+        import client
+    return client
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    """GET 发 server.files 里的内容（支持 Range / If-Range），POST 记下 JSON 请求体。"""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers)))
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        digest = hashlib.sha256(data).hexdigest()
+        start = 0
+        if_range = self.headers.get("If-Range")
+        if self.headers.get("Range") and (if_range is None or if_range == f'"{digest}"'):
+            start = int(self.headers["Range"].split("=", 1)[1].rstrip("-"))
+            if start >= len(data):
+                self.send_error(416)
+                return
+        body = data[start:]
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Content-SHA256", digest)
+        self.end_headers()
+        if server.cut_after is not None:
+            # 模拟传到一半断线
+            body, server.cut_after = body[:server.cut_after], None
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.posts.append((self.path, json.loads(body or b"null")))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FileHandler)
+    server.files, server.requests, server.posts, server.cut_after = {}, [], [], None
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
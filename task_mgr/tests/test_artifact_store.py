@@ -0,0 +1,141 @@
+import hashlib
+import io
+import threading
+
+import pytest
+
+from artifact_store import ArtifactStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ArtifactStore(tmp_path / "tasks", tmp_path / "tasks.db")
+
+
+def _src(store, data, name="src.bin"):
+    path = store.root / name
+    path.write_bytes(data)
+    return path
+
+
+def _blobs(store):
+    return sorted(p for p in store.blob_dir.rglob("*") if p.is_file())
+
+
+def test_put_file_dedups_identical_content(store):
+    d1, size = store.put_file("a_task.zip", _src(store, b"payload"))
+    d2, _ = store.put_file("b_task.zip", _src(store, b"payload"))
+
+    assert d1 == d2 == hashlib.sha256(b"payload").hexdigest()
+    assert size == len(b"payload")
+    assert _blobs(store) == [store.blob_path(d1)]
+    assert store.usage() == (len(b"payload"), 1, 2)
+    assert not (store.root / "src.bin").exists()
+
+
+def test_blob_removed_with_last_reference(store):
+    digest, size = store.put_file("a_task.zip", _src(store, b"payload"))
+    store.link(["b_task.zip", "c_task.zip"], digest, size)
+
+    assert store.delete("a_task.zip")
+    assert store.delete("b_task.zip")
+    assert store.lookup("c_task.zip")["path"].read_bytes() == b"payload"
+
+    assert store.delete("c_task.zip")
+    assert not store.delete("c_task.zip")
+    assert _blobs(store) == []
+
+
+def test_replacing_a_name_drops_the_old_blob(store):
+    old, _ = store.put_file("a_result.zip", _src(store, b"first"))
+    new, _ = store.put_file("a_result.zip", _src(store, b"second"))
+
+    assert old != new
+    assert not store.blob_path(old).exists()
+    assert store.lookup("a_result.zip")["digest"] == new
+
+
+def test_link_to_missing_blob_is_refused(store):
+    digest, size = store.put_file("a_task.zip", _src(store, b"payload"))
+    store.delete("a_task.zip")
+
+    with pytest.raises(FileNotFoundError):
+        store.link(["b_task.zip"], digest, size)
+    assert store.lookup("b_task.zip") is None
+
+
+def test_put_stream_and_adopt(store):
+    digest, size = store.put_stream("a_task.zip", io.BytesIO(b"x" * 3_000_000))
+    assert size == 3_000_000
+    assert store.lookup("a_task.zip")["path"].stat().st_size == size
+
+    spool = store.open_spool()
+    spool.write(b"x" * 3_000_000)
+    assert store.adopt("b_task.zip", spool) == (digest, size)
+    assert list(store.tmp_dir.iterdir()) == []
+
+
+def test_cross_filesystem_copy_never_exposes_partial_blob(store, monkeypatch):
+    import artifact_store as module
+
+    real_replace = module.os.replace
+
+    def replace(src, dst):
+        # 源文件在别的文件系统上：第一次挪动失败，退化为拷贝
+        if str(src).endswith("src.bin"):
+            raise OSError(18, "Invalid cross-device link")
+        return real_replace(src, dst)
+
+    def broken_copy(src, dst):
+        with open(dst, "wb") as f:
+            f.write(b"par")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(module.os, "replace", replace)
+    monkeypatch.setattr(module.shutil, "copyfile", broken_copy)
+    with pytest.raises(OSError, match="disk full"):
+        store.put_file("a_task.zip", _src(store, b"payload"))
+    assert _blobs(store) == []
+
+    monkeypatch.undo()
+    monkeypatch.setattr(module.os, "replace", replace)
+    digest, _ = store.put_file("a_task.zip", _src(store, b"payload"))
+    assert store.blob_path(digest).read_bytes() == b"payload"
+    assert _blobs(store) == [store.blob_path(digest)]
+
+
+def test_concurrent_put_and_delete_never_orphan_a_reference(store):
+    """同一份内容反复登记/删除：任何时刻登记着的引用都必须能找到 blob。"""
+    errors = []
+
+    def worker(n):
+        try:
+            for i in range(40):
+                name = f"w{n}-{i}_task.zip"
+                store.put_file(name, _src(store, b"shared package", f"src-{n}-{i}"))
+                if store.lookup(name) is None:
+                    errors.append(f"{name} lost its blob")
+                store.delete(name)
+        except Exception as e:   # pragma: no cover - 失败时把异常带回主线程
+            errors.append(repr(e))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert list(store.iter_lru()) == []
+    assert _blobs(store) == []
+
+
+def test_import_legacy_files(store, tmp_path):
+    legacy = tmp_path / "tasks"
+    (legacy / "1_task.zip").write_bytes(b"task")
+    (legacy / "1_result.zip").write_bytes(b"result")
+    (legacy / "1_status.txt").write_text("Task 1 submitted.")
+
+    assert store.import_legacy_files(legacy) == 2
+    assert store.lookup("1_result.zip")["path"].read_bytes() == b"result"
+    assert (legacy / "1_status.txt").exists()
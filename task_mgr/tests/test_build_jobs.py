@@ -0,0 +1,72 @@
+import socket
+import time
+
+from build_jobs import INTERRUPTED_MESSAGE, BuildJobs
+
+DEAD_OWNER = f"{socket.gethostname()}:999999999"
+
+
+def _wait(jobs, job_id, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = jobs.get(job_id)
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"build job {job_id} did not finish")
+
+
+def test_build_runs_in_pool_and_cleans_intermediate_files(tmp_path, db_path):
+    jobs = BuildJobs(db_path, tmp_path / "builds")
+    job_id = jobs.create("custom", "demo")
+    (jobs.job_dir(job_id) / "code.zip").write_bytes(b"upload")
+
+    def build(job_dir, output_path, progress):
+        progress(50, "Packaging")
+        output_path.write_bytes(b"zip")
+
+    jobs.submit(job_id, "demo_user_task.zip", build)
+    job = _wait(jobs, job_id)
+
+    assert job["status"] == "done" and job["progress"] == 100
+    assert jobs.output_path(job).read_bytes() == b"zip"
+    assert [p.name for p in jobs.job_dir(job_id).iterdir()] == ["demo_user_task.zip"]
+
+
+def test_failed_build_reports_error(tmp_path, db_path):
+    jobs = BuildJobs(db_path, tmp_path / "builds")
+    job_id = jobs.create("custom", "demo")
+
+    def build(job_dir, output_path, progress):
+        raise ValueError("main.py missing")
+
+    jobs.submit(job_id, "demo_user_task.zip", build)
+    job = _wait(jobs, job_id)
+    assert job["status"] == "failed" and job["message"] == "main.py missing"
+    assert jobs.output_path(job) is None
+
+
+def test_jobs_of_dead_processes_are_failed_as_interrupted(tmp_path, db_path):
+    jobs = BuildJobs(db_path, tmp_path / "builds")
+    orphan = jobs.create("example", "sha256")
+    mine = jobs.create("example", "sha256")
+    remote = jobs.create("example", "sha256")
+    with jobs._conn() as conn:
+        conn.execute("UPDATE build_jobs SET owner = ?, status = 'running' WHERE job_id = ?", (DEAD_OWNER, orphan))
+        conn.execute("UPDATE build_jobs SET owner = 'other-host:1' WHERE job_id = ?", (remote,))
+
+    # 新进程启动时的检查
+    restarted = BuildJobs(db_path, tmp_path / "builds")
+    assert restarted.get(orphan)["status"] == "failed"
+    assert restarted.get(orphan)["message"] == INTERRUPTED_MESSAGE
+    assert restarted.get(mine)["status"] == "queued"
+    assert restarted.get(remote)["status"] == "queued"
+
+
+def test_orphan_detected_on_query(tmp_path, db_path):
+    jobs = BuildJobs(db_path, tmp_path / "builds")
+    job_id = jobs.create("example", "sha256")
+    with jobs._conn() as conn:
+        conn.execute("UPDATE build_jobs SET owner = ? WHERE job_id = ?", (DEAD_OWNER, job_id))
+
+    assert jobs.get(job_id)["message"] == INTERRUPTED_MESSAGE
@@ -0,0 +1,344 @@
+import hashlib
+import json
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from queue_reaper import MAX_TASK_ATTEMPTS
+
+DATA = bytes(range(256)) * 4096   # 1 MiB
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+@pytest.fixture
+def master(client, http_server, monkeypatch):
+    """client 上报/下载都发给本地的假 master。"""
+    monkeypatch.setattr(client, "SERVER_URL", http_server.url)
+    return http_server
+
+
+@pytest.fixture
+def worker(client, master, tmp_path, monkeypatch):
+    """下载缓存放在 tmp_path，重试不等待。"""
+    monkeypatch.setattr(client, "DOWNLOAD_CACHE_DIR", str(tmp_path / "downloads"))
+    monkeypatch.setattr(client, "DOWNLOAD_CHUNK_SIZE", 100_000)
+    monkeypatch.setattr(client.time, "sleep", lambda sec: None)
+    (tmp_path / "downloads").mkdir()
+    (tmp_path / "zips").mkdir()
+    return client
+
+
+# ---------- 槽位 ----------
+@pytest.mark.parametrize("cpus, mem_mb, expected", [
+    (4, 8192, 4),      # 内存充足：每核一个
+    (4, 1024, 1),      # (1024 - 256) // 512
+    (4, 256, 1),       # 内存不够也至少一个
+    (4, None, 4),      # 读不到 /proc/meminfo
+    (None, 8192, 1),
+])
+def test_default_slot_count(client, monkeypatch, cpus, mem_mb, expected):
+    monkeypatch.setattr(client.os, "cpu_count", lambda: cpus)
+    monkeypatch.setattr(client, "_total_memory_mb", lambda: mem_mb)
+    assert client.default_slot_count() == expected
+
+
+def test_prefetch_stops_at_the_credit_limit(client, rds, monkeypatch):
+    monkeypatch.setattr(client, "download_task_inputs", lambda msg, zip_dir: (f"{msg['task_id']}.zip", None, []))
+    for n in range(3):
+        rds.rpush(client.TASK_QUEUE_NORMAL, json.dumps({"task_id": f"t{n}", "task_zip": f"t{n}_task.zip"}))
+    ready, credits, stop = queue.Queue(), threading.BoundedSemaphore(2), threading.Event()
+    prefetcher = threading.Thread(target=client._prefetch_loop, daemon=True,
+                                  args=(rds, "processing", "zips", ready, credits, stop.is_set))
+    prefetcher.start()
+
+    assert [ready.get(timeout=5)[0]["task_id"] for _ in range(2)] == ["t0", "t1"]
+    with pytest.raises(queue.Empty):
+        ready.get(timeout=0.3)
+    assert rds.llen(client.TASK_QUEUE_NORMAL) == 1 and rds.llen("processing") == 2
+
+    credits.release()   # 执行完一个任务，才会再取下一个
+    assert ready.get(timeout=5)[0]["task_id"] == "t2"
+    stop.set()
+    prefetcher.join(10)
+    assert ready.get(timeout=5) is None
+
+
+def test_download_failure_on_the_last_attempt_goes_to_dead_letter(client, master, rds, monkeypatch):
+    reports = []
+    monkeypatch.setattr(client, "report", lambda task_id, **kw: reports.append(kw))
+    monkeypatch.setattr(client.time, "sleep", lambda sec: None)
+
+    def fail(msg, zip_dir):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(client, "download_task_inputs", fail)
+    rds.rpush(client.TASK_QUEUE_NORMAL, json.dumps({"task_id": "t1", "task_zip": "t1_task.zip"}))
+    ready, credits, stop = queue.Queue(), threading.BoundedSemaphore(2), threading.Event()
+    prefetcher = threading.Thread(target=client._prefetch_loop, daemon=True,
+                                  args=(rds, "processing", "zips", ready, credits, stop.is_set))
+    prefetcher.start()
+
+    deadline = time.monotonic() + 10
+    while not rds.llen(client.TASK_DEAD_LETTER) and time.monotonic() < deadline:
+        stop.wait(0.01)
+    stop.set()
+    prefetcher.join(10)
+
+    assert [json.loads(m) for m in rds.lrange(client.TASK_DEAD_LETTER, 0, -1)] == [
+        {"task_id": "t1", "task_zip": "t1_task.zip", "attempts": MAX_TASK_ATTEMPTS}]
+    assert rds.llen(client.TASK_QUEUE_NORMAL) == 0 and rds.llen("processing") == 0
+    assert [r["phase"] for r in reports] == ["requeued"] * (MAX_TASK_ATTEMPTS - 1) + ["dead_letter"]
+    assert reports[0]["msg"] == "Download failed: disk full; requeued after attempt 1"
+    assert reports[-1]["msg"] == f"Download failed: disk full; giving up after {MAX_TASK_ATTEMPTS} attempts"
+
+
+# ---------- 缓存键 ----------
+def test_env_hash_covers_dockerfile_requirements_and_base_image(client, tmp_path):
+    task = tmp_path / "task"
+    task.mkdir()
+    (task / "Dockerfile").write_text("FROM base\n")
+    key = client._env_hash(str(task), "sha256:base1")
+
+    assert client._env_hash(str(task), "sha256:base1") == key and len(key) == 16
+    assert client._env_hash(str(task), "sha256:base2") != key
+    (task / "requirements.txt").write_text("numpy\n")
+    with_requirements = client._env_hash(str(task), "sha256:base1")
+    assert with_requirements != key
+    (task / "main.py").write_text("print(1)")
+    assert client._env_hash(str(task), "sha256:base1") == with_requirements   # 代码不影响环境
+
+
+def test_venv_key_ignores_order_and_comments(client):
+    a = client._normalize_requirements("requests==2.31\n# pinned\nnumpy  # math\n\nrequests==2.31\n")
+    b = client._normalize_requirements("numpy\nrequests==2.31")
+
+    assert a == b == "numpy\nrequests==2.31\n"
+    assert client._venv_key(a) == client._venv_key(b)
+    assert client._venv_key(a) != client._venv_key("numpy\n")
+
+
+def test_venv_key_depends_on_the_interpreter(client, monkeypatch):
+    key = client._venv_key("numpy\n")
+    monkeypatch.setattr(sys, "version", sys.version + " (other build)")
+    assert client._venv_key("numpy\n") != key
+
+
+
+# ---------- 常驻容器 ----------
+@pytest.fixture
+def docker(client, monkeypatch):
+    """假的 docker 命令行：记下调用，image inspect 返回 docker.config。"""
+    calls = []
+    docker = type("FakeDocker", (), {"calls": calls, "config": {}})()
+
+    def run(argv, **kwargs):
+        calls.append(argv)
+        stdout = ""
+        if argv[1:3] == ["image", "inspect"]:
+            stdout = json.dumps(docker.config)
+        elif argv[1:3] == ["run", "-d"]:
+            stdout = "c0ffee\n"
+        return subprocess.CompletedProcess(argv, 0, stdout, "")
+
+    def run_streaming(task_id, cmd, **kwargs):
+        calls.append(cmd)
+        return subprocess.CompletedProcess(cmd, 0, "", "")
+
+    monkeypatch.setattr(client.subprocess, "run", run)
+    monkeypatch.setattr(client, "run_streaming", run_streaming)
+    monkeypatch.setattr(client, "report", lambda *a, **kw: None)
+    monkeypatch.setattr(client, "_ContainerSampler", lambda *a, **kw: type("S", (), {"stop": lambda self: {}})())
+    monkeypatch.setattr(client, "_pool", {})
+    return docker
+
+
+@pytest.mark.parametrize("config, argv", [
+    ({"Entrypoint": ["python3", "-u"], "Cmd": ["main.py"]}, ["python3", "-u", "main.py"]),
+    ({"Entrypoint": ["/entry.sh"], "Cmd": None}, ["/entry.sh"]),
+    ({"Entrypoint": None, "Cmd": ["python3", "main.py", "--fast"]}, ["python3", "main.py", "--fast"]),
+    ({"Entrypoint": None, "Cmd": None}, ["python3", "main.py"]),
+])
+def test_pooled_exec_runs_the_same_argv_as_docker_run(client, docker, tmp_path, config, argv):
+    docker.config = config
+    task_dir = str(tmp_path / "slot" / "t1")
+
+    client._run_in_container("docker", "t1", task_dir, "task:latest")
+    client._run_in_container("docker", "t1", task_dir, "task:latest", poolable=False)
+
+    pooled = next(c for c in docker.calls if c[1] == "exec")
+    cold = next(c for c in docker.calls if c[1] == "run" and "--rm" in c)
+    assert pooled[pooled.index(task_dir, pooled.index("-c")):] == [task_dir, *argv]
+    assert cold[-1] == "task:latest"   # 冷启动不带命令，docker 按镜像的 Entrypoint + Cmd 执行
+
+# ---------- 下载 ----------
+def test_interrupted_download_resumes_with_range(worker, master, tmp_path):
+    master.files["/pi_task/download_task/t1_task.zip"] = DATA
+    master.cut_after = 300_000
+
+    path = worker.download_task_zip("t1_task.zip", str(tmp_path / "zips"), DIGEST)
+
+    assert open(path, "rb").read() == DATA
+    (_, first), (_, second) = master.requests
+    assert "Range" not in first
+    assert second["Range"] == "bytes=300000-" and second["If-Range"] == f'"{DIGEST}"'
+
+
+def test_cached_download_is_reused(worker, master, tmp_path):
+    master.files["/pi_task/download_task/t1_task.zip"] = DATA
+    worker.download_task_zip("t1_task.zip", str(tmp_path / "zips"), DIGEST)
+    master.files["/pi_task/download_task/t2_task.zip"] = DATA
+
+    path = worker.download_task_zip("t2_task.zip", str(tmp_path / "zips"), DIGEST)
+
+    assert open(path, "rb").read() == DATA
+    assert len(master.requests) == 1
+
+
+def test_corrupt_partial_download_is_discarded(worker, master, tmp_path):
+    (tmp_path / "downloads" / f"{DIGEST}.part").write_bytes(b"x" * 1000)   # 上次下了一半、内容已经不对
+    master.files["/pi_task/download_task/t1_task.zip"] = DATA
+
+    path = worker.download_task_zip("t1_task.zip", str(tmp_path / "zips"), DIGEST)
+
+    assert open(path, "rb").read() == DATA
+    (_, resumed), (_, restarted) = master.requests
+    assert resumed["Range"] == "bytes=1000-"
+    assert "Range" not in restarted   # 校验失败后整个重下
+
+
+def test_digest_mismatch_with_the_server_is_never_cached(worker, master, tmp_path):
+    master.files["/pi_task/download_task/t1_task.zip"] = b"other package"
+
+    with pytest.raises(ValueError, match="does not match task message"):
+        worker.download_task_zip("t1_task.zip", str(tmp_path / "zips"), DIGEST)
+    assert not (tmp_path / "downloads" / DIGEST).exists()
+    assert not (tmp_path / "zips" / "t1_task.zip").exists()
+
+
+def test_download_without_digest_still_resumes(worker, master, tmp_path):
+    master.files["/pi_task/download_result/t0_result.zip"] = DATA
+    master.cut_after = 200_000
+
+    path = worker.download_dependency_zip("t0_result.zip", str(tmp_path / "zips"))
+
+    assert open(path, "rb").read() == DATA
+    assert master.requests[1][1]["Range"] == "bytes=200000-"
+    assert "If-Range" not in master.requests[1][1]
+
+
+# ---------- 状态上报 ----------
+def test_coalesce_merges_adjacent_updates_of_the_same_phase(client):
+    updates = [
+        {"task_id": "t1", "phase": "running", "progress": 10},
+        {"task_id": "t1", "phase": "running", "progress": 20, "msg": "half"},
+        {"task_id": "t2", "phase": "running", "progress": 5},
+        {"task_id": "t1", "phase": "running", "progress": 30},
+        {"task_id": "t1", "phase": "completed_success", "status": "success"},
+    ]
+
+    assert client._coalesce(updates) == [
+        {"task_id": "t1", "phase": "running", "progress": 20, "msg": "half"},
+        {"task_id": "t2", "phase": "running", "progress": 5},
+        {"task_id": "t1", "phase": "running", "progress": 30},
+        {"task_id": "t1", "phase": "completed_success", "status": "success"},
+    ]
+    assert updates[0] == {"task_id": "t1", "phase": "running", "progress": 10}
+
+
+# ---------- 任务输出 ----------
+def _shipped(master, task_id):
+    return [body for path, body in master.posts if path == f"/pi_task/task_log/{task_id}"]
+
+
+def test_log_buffer_keeps_the_newest_lines(client, master, monkeypatch):
+    monkeypatch.setattr(client, "TASK_LOG_BUFFER_LINES", 5)
+    monkeypatch.setattr(client, "TASK_LOG_FLUSH_SEC", 60)
+    shipper = client._LogShipper("t1")
+
+    for n in range(8):
+        shipper.add("stdout", f"line {n}")
+    assert [e["line"] for e in shipper.buffer] == [f"line {n}" for n in range(3, 8)]
+
+    shipper.close()
+    assert _shipped(master, "t1") == [
+        {"lines": [{"stream": "stdout", "line": f"line {n}"} for n in range(3, 8)], "dropped": 3}]
+
+
+def test_full_batches_are_sent_without_waiting(client, master, monkeypatch):
+    monkeypatch.setattr(client, "TASK_LOG_BATCH_LINES", 2)
+    monkeypatch.setattr(client, "TASK_LOG_FLUSH_SEC", 60)
+    shipper = client._LogShipper("t1")
+
+    shipper.add("stdout", "a")
+    shipper.add("stderr", "b")
+    deadline = time.time() + 5
+    while not _shipped(master, "t1") and time.time() < deadline:
+        time.sleep(0.01)
+    shipper.close()
+
+    assert _shipped(master, "t1")[0]["lines"] == [{"stream": "stdout", "line": "a"}, {"stream": "stderr", "line": "b"}]
+
+
+def test_run_streaming_ships_everything_but_keeps_a_short_tail(client, master, monkeypatch):
+    monkeypatch.setattr(client, "OUTPUT_TAIL_LINES", 3)
+    script = "import sys\nfor i in range(10):\n    print(i)\nprint('bad', file=sys.stderr)\nsys.exit(3)"
+
+    result = client.run_streaming("t1", [sys.executable, "-c", script])
+
+    assert result.returncode == 3
+    assert result.stdout == "7\n8\n9" and result.stderr == "bad"
+    shipped = [e["line"] for body in _shipped(master, "t1") for e in body["lines"] if e["stream"] == "stdout"]
+    assert shipped == [str(i) for i in range(10)]
+
+
+
+
+def test_run_streaming_kills_the_task_on_timeout(client, master):
+    script = "import time\nprint('started', flush=True)\ntime.sleep(30)"
+    t0 = time.monotonic()
+
+    with pytest.raises(subprocess.TimeoutExpired) as info:
+        client.run_streaming("t1", [sys.executable, "-c", script], timeout=0.5)
+
+    assert time.monotonic() - t0 < 10
+    assert info.value.output == "started"
+    assert [e["line"] for body in _shipped(master, "t1") for e in body["lines"]] == ["started"]
+
+# ---------- 链路追踪 ----------
+def test_worker_spans_join_the_master_trace(client, master):
+    trace_id, parent = "0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331"
+    client.start_trace({"task_id": "t1", "traceparent": f"00-{trace_id}-{parent}-01", "enqueued_at": time.time() - 1})
+    with client.trace_span("t1", "run"):
+        headers = client.trace_headers()
+    client.finish_trace("t1")
+
+    (path, body), = [p for p in master.posts if p[0].startswith("/pi_task/traces/")]
+    spans = {s["name"]: s for s in body["spans"]}
+    assert path == "/pi_task/traces/t1" and set(spans) == {"queue_wait", "run", "worker.task"}
+    assert {s["traceId"] for s in spans.values()} == {trace_id}
+    assert spans["worker.task"]["parentSpanId"] == parent == spans["queue_wait"]["parentSpanId"]
+    assert spans["run"]["parentSpanId"] == spans["worker.task"]["spanId"]
+    assert headers["traceparent"] == f"00-{trace_id}-{spans['run']['spanId']}-01"
+    assert {s["resource"]["service.name"] for s in spans.values()} == {"pi-task-worker"}
+
+# ---------- 阶段计时 ----------
+def test_timed_phase_accumulates_and_collect_pops(client):
+    with client.timed_phase("timed", "run"):
+        time.sleep(0.01)
+    with client.timed_phase("timed", "run"):
+        pass
+    with pytest.raises(RuntimeError):
+        with client.timed_phase("timed", "upload"):
+            raise RuntimeError("boom")
+    client.add_metrics("timed", cpu_user_sec=1.5, max_rss_bytes=None)
+
+    metrics = client.collect_metrics("timed")
+
+    assert set(metrics["phases"]) == {"run", "upload"} and metrics["phases"]["run"] >= 0.01
+    assert metrics["total_sec"] == round(sum(metrics["phases"].values()), 3)
+    assert metrics["cpu_user_sec"] == 1.5 and "max_rss_bytes" not in metrics
+    assert client.collect_metrics("timed") is None
@@ -0,0 +1,79 @@
+import zipfile
+
+import pytest
+
+from dataset_store import DatasetStore, dataset_artifact_name, inspect_dataset_zip, parse_dataset_refs
+
+DIGEST_A = "a" * 64
+DIGEST_B = "0123456789abcdef" * 4
+
+
+def test_parse_refs_sorted_by_mount_name():
+    config = {"datasets": {"weights": DIGEST_B, "images": DIGEST_A}}
+    assert parse_dataset_refs(config) == [("images", DIGEST_A), ("weights", DIGEST_B)]
+
+
+@pytest.mark.parametrize("config", [{}, {"datasets": None}, {"datasets": {}}])
+def test_parse_refs_without_datasets(config):
+    assert parse_dataset_refs(config) == []
+
+
+@pytest.mark.parametrize("datasets, message", [
+    ([DIGEST_A], "must map mount names"),
+    ({"../etc": DIGEST_A}, "Invalid dataset mount name"),
+    ({".hidden": DIGEST_A}, "Invalid dataset mount name"),
+    ({"a/b": DIGEST_A}, "Invalid dataset mount name"),
+    ({"images": "A" * 64}, "sha256 digest"),
+    ({"images": DIGEST_A[:-1]}, "sha256 digest"),
+    ({"images": 42}, "sha256 digest"),
+])
+def test_parse_refs_rejects_bad_entries(datasets, message):
+    with pytest.raises(ValueError, match=message):
+        parse_dataset_refs({"datasets": datasets})
+
+
+def test_inspect_dataset_zip(tmp_path):
+    path = tmp_path / "data.zip"
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("sub/", "")
+        zf.writestr("sub/a.bin", b"x" * 10)
+        zf.writestr("b.bin", b"y" * 5)
+    assert inspect_dataset_zip(path) == (2, 15)
+
+
+def test_inspect_rejects_empty_and_non_zip(tmp_path):
+    empty = tmp_path / "empty.zip"
+    with zipfile.ZipFile(empty, "w") as zf:
+        zf.writestr("only_dir/", "")
+    with pytest.raises(ValueError, match="no files"):
+        inspect_dataset_zip(empty)
+
+    junk = tmp_path / "junk.zip"
+    junk.write_bytes(b"not a zip")
+    with pytest.raises(ValueError, match="not a valid zip"):
+        inspect_dataset_zip(junk)
+
+
+def test_register_is_idempotent_and_keeps_name(db_path):
+    store = DatasetStore(db_path)
+
+    first = store.register(DIGEST_A, 100, 400, 3, name="images")
+    again = store.register(DIGEST_A, 100, 400, 3)
+
+    assert again == first and again["name"] == "images"
+    assert store.register(DIGEST_A, 100, 400, 3, name="renamed")["name"] == "renamed"
+    assert [d["digest"] for d in store.list()] == [DIGEST_A]
+    assert dataset_artifact_name(DIGEST_A) == f"{DIGEST_A}_dataset.zip"
+
+
+def test_mark_used_and_delete(db_path):
+    store = DatasetStore(db_path)
+    store.register(DIGEST_A, 1, 1, 1)
+    assert store.get(DIGEST_A)["last_used"] is None
+
+    store.mark_used([DIGEST_A, DIGEST_B])
+    assert store.get(DIGEST_A)["last_used"] is not None
+
+    assert store.delete(DIGEST_A)
+    assert not store.delete(DIGEST_A)
+    assert store.get(DIGEST_A) is None
@@ -0,0 +1,107 @@
+import queue
+import time
+
+import pytest
+
+import event_hub
+from event_hub import EventHub, format_sse
+
+CHANNEL = "pi_task_events"
+
+
+@pytest.fixture
+def events(rds):
+    return EventHub(rds, CHANNEL)
+
+
+def _wait_subscribed(rds):
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        if rds.pubsub_numsub(CHANNEL)[0][1]:
+            return
+        time.sleep(0.01)
+    raise AssertionError("event hub listener did not subscribe")
+
+
+def _drain(q, count):
+    return [q.get(timeout=5) for _ in range(count)]
+
+
+def test_format_sse():
+    assert format_sse({"id": 3, "task_id": "t1"}) == 'id: 3\nevent: status\ndata: {"id": 3, "task_id": "t1"}\n\n'
+    assert format_sse({}, name="resync") == "event: resync\ndata: {}\n\n"
+
+
+def test_published_events_reach_matching_subscribers(events, rds):
+    everything = events.subscribe()
+    only_t1 = events.subscribe("t1")
+    _wait_subscribed(rds)
+
+    events.publish({"id": 1, "task_id": "t1", "status": "running"})
+    events.publish({"id": 2, "task_id": "t2", "status": "queued"})
+
+    assert [e["id"] for e in _drain(everything, 2)] == [1, 2]
+    assert only_t1.get(timeout=5)["id"] == 1
+    with pytest.raises(queue.Empty):
+        only_t1.get(timeout=0.2)
+
+    events.unsubscribe(everything)
+    events.publish({"id": 3, "task_id": "t1"})
+    assert only_t1.get(timeout=5)["id"] == 3
+    assert everything.empty()
+
+
+def test_slow_subscriber_is_told_to_resync(events, monkeypatch):
+    monkeypatch.setattr(event_hub, "SUBSCRIBER_QUEUE_SIZE", 2)
+    q = events.subscribe()
+
+    for i in range(3):
+        events._dispatch({"id": i, "task_id": "t1"})
+
+    assert list(q.queue) == [{"type": "resync"}]
+
+
+def test_stream_replays_backlog_and_stops(events):
+    backlog = [{"id": 1, "task_id": "t1", "status": "running"}, {"id": 2, "task_id": "t1", "status": "done"}]
+
+    frames = list(events.stream("t1", backlog=lambda: backlog, live=False))
+    assert frames == [format_sse(e) for e in backlog]
+
+    frames = list(events.stream("t1", backlog=lambda: backlog, until=lambda e: e["status"] == "running"))
+    assert frames == [format_sse(backlog[0])]
+
+
+def test_live_stream_skips_events_already_sent(events):
+    backlog = [{"id": 1, "task_id": "t1", "status": "queued"}]
+    stream = events.stream("t1", backlog=lambda: backlog, until=lambda e: e["status"] == "done")
+
+    assert next(stream) == format_sse(backlog[0])
+    events._dispatch(backlog[0])
+    events._dispatch({"id": 2, "task_id": "t1", "status": "done"})
+
+    assert next(stream) == format_sse({"id": 2, "task_id": "t1", "status": "done"})
+    with pytest.raises(StopIteration):
+        next(stream)
+    assert not events._subscribers
+
+
+def test_publish_many_reaches_subscribers(events, rds):
+    q = events.subscribe()
+    _wait_subscribed(rds)
+
+    events.publish_many([{"id": i, "task_id": "t1"} for i in range(1, 4)])
+
+    assert [e["id"] for e in _drain(q, 3)] == [1, 2, 3]
+
+
+def test_log_events_only_reach_subscribers_of_that_task(events):
+    everything = events.subscribe()
+    log_event = {"type": "log", "task_id": "t1", "offset": 0, "text": "hello\n"}
+    stream = events.stream("t1", backlog=lambda: [{"id": 1, "task_id": "t1"}])
+    next(stream)
+
+    events._dispatch(log_event)
+
+    assert everything.empty()
+    assert next(stream) == format_sse(log_event, name="log")
+    stream.close()
@@ -0,0 +1,171 @@
+import socket
+import zipfile
+
+import pytest
+
+import mapreduce
+from mapreduce import MapReduceJobs, make_reduce_package, merge_results, plan_shards, split_package
+from task_store import process_owner
+
+DEAD_OWNER = f"{socket.gethostname()}:999999999"
+
+
+def _infos(sizes):
+    infos = []
+    for name, size in sizes.items():
+        info = zipfile.ZipInfo(f"input/{name}")
+        info.file_size = size
+        infos.append(info)
+    return infos
+
+
+def _plan_names(plan):
+    return [[i.filename[len("input/"):] for i in shard] for shard in plan]
+
+
+def _write_zip(path, members):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return path
+
+
+def _read_zip(path):
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        return {i.filename: zf.read(i) for i in zf.infolist()}
+
+
+# ---------- 分片 ----------
+def test_plan_by_count_is_contiguous_and_balanced():
+    plan = plan_shards(_infos({f"f{n}": 1 for n in range(7)}), 3, "count")
+    assert _plan_names(plan) == [["f0", "f1", "f2"], ["f3", "f4"], ["f5", "f6"]]
+
+
+def test_plan_by_bytes_balances_totals():
+    sizes = {"a": 60, "b": 50, "c": 40, "d": 30, "e": 20, "f": 10}
+    plan = plan_shards(_infos(sizes), 3, "bytes")
+    assert [sum(i.file_size for i in shard) for shard in plan] == [70, 70, 70]
+    assert _plan_names(plan) == [["a", "f"], ["b", "e"], ["c", "d"]]
+    assert sorted(n for shard in _plan_names(plan) for n in shard) == sorted(sizes)
+
+
+def test_plan_never_returns_empty_shards():
+    assert len(plan_shards(_infos({"a": 1, "b": 1}), 8, "count")) == 2
+    assert len(plan_shards(_infos({"a": 1, "b": 1}), 8, "bytes")) == 2
+    assert len(plan_shards(_infos({"a": 1}), 0, "count")) == 1
+
+
+def test_plan_rejects_unknown_mode():
+    with pytest.raises(ValueError):
+        plan_shards(_infos({"a": 1}), 2, "lines")
+
+
+# ---------- 拆包 / 合并 ----------
+def test_split_package(tmp_path):
+    src = _write_zip(tmp_path / "task.zip", {
+        "main.py": "print('map')", "reduce.py": "print('reduce')", "task_config.json": "{}",
+        "input/a.txt": "a", "input/b.txt": "bb", "input/c.txt": "ccc",
+    })
+
+    code, shards, has_reduce = split_package(src, 2, "count", tmp_path)
+
+    assert has_reduce
+    assert set(_read_zip(code)) == {"main.py", "reduce.py", "task_config.json"}
+    assert [_read_zip(p) for p in shards] == [
+        {"input/a.txt": b"a", "input/b.txt": b"bb"},
+        {"input/c.txt": b"ccc"},
+    ]
+
+
+def test_split_package_copies_compressed_bytes_unchanged(tmp_path):
+    src = _write_zip(tmp_path / "task.zip", {"main.py": "print('map')\n" * 100, "input/a.txt": "a" * 10_000})
+
+    code, shards, _ = split_package(src, 1, "count", tmp_path)
+
+    with zipfile.ZipFile(src) as a, zipfile.ZipFile(code) as c, zipfile.ZipFile(shards[0]) as s:
+        assert c.testzip() is None and s.testzip() is None
+        for out, name in ((c, "main.py"), (s, "input/a.txt")):
+            old, new = a.getinfo(name), out.getinfo(name)
+            assert (new.CRC, new.compress_type, new.compress_size) == (old.CRC, old.compress_type, old.compress_size)
+
+
+@pytest.mark.parametrize("members, message", [
+    ({"input/a.txt": "a"}, "main.py"),
+    ({"main.py": "", "input/": ""}, "no files under input/"),
+])
+def test_split_package_rejects_bad_packages(tmp_path, members, message):
+    src = _write_zip(tmp_path / "task.zip", members)
+    with pytest.raises(ValueError, match=message):
+        split_package(src, 2, "count", tmp_path)
+
+
+def test_make_reduce_package_swaps_in_reduce_py(tmp_path):
+    code = _write_zip(tmp_path / "code.zip", {"main.py": "map", "reduce.py": "reduce", "lib/util.py": "u"})
+    make_reduce_package(code, tmp_path / "reduce.zip")
+    assert _read_zip(tmp_path / "reduce.zip") == {"main.py": b"reduce", "lib/util.py": b"u"}
+
+
+def test_merge_results_prefixes_each_shard(tmp_path):
+    r0 = _write_zip(tmp_path / "r0.zip", {"output/": "", "output/part.txt": "zero"})
+    r1 = _write_zip(tmp_path / "r1.zip", {"output/part.txt": "one", "output/sub/x.bin": "x", "log.txt": "l"})
+
+    merge_results([r0, r1], tmp_path / "merged.zip")
+
+    assert _read_zip(tmp_path / "merged.zip") == {
+        "output/": b"",
+        "output/shard_0000/part.txt": b"zero",
+        "output/shard_0001/part.txt": b"one",
+        "output/shard_0001/sub/x.bin": b"x",
+        "output/shard_0001/log.txt": b"l",
+    }
+
+
+# ---------- 作业登记 ----------
+@pytest.fixture
+def jobs(db_path):
+    return MapReduceJobs(db_path)
+
+
+def test_job_lifecycle(jobs):
+    jobs.create("job", ["m0", "m1"], "bytes", has_reduce=True)
+
+    assert jobs.job_of("m1") == ("job", 1)
+    assert jobs.job_of("other") is None
+    assert jobs.pinned_task_ids() == {"m0", "m1"}
+
+    owner = process_owner()
+    assert jobs.transition("job", "mapping", "reducing", reducer=owner)
+    assert not jobs.transition("job", "mapping", "reducing")   # 只有一个进程能完成迁移
+    jobs.add_reduce_task("job", "r")
+    assert jobs.job_of("r") == ("job", mapreduce.REDUCE_SHARD)
+
+    job = jobs.get("job")
+    assert job["status"] == "reducing" and job["reducer"] == owner and job["reduce_task_id"] == "r"
+    assert job["map_task_ids"] == ["m0", "m1"]
+    assert jobs.pinned_task_ids() == {"m0", "m1"}
+    assert jobs.reducing_job_ids() == ["job"]
+
+    assert jobs.transition("job", "reducing", "done", "Reduce task finished")
+    assert jobs.pinned_task_ids() == set()
+    assert jobs.get("job")["message"] == "Reduce task finished"
+
+
+def test_reclaim_only_when_reducer_is_gone(jobs):
+    jobs.create("job", ["m0"], "count", has_reduce=False)
+    jobs.transition("job", "mapping", "reducing", reducer=process_owner())
+    assert not jobs.reclaim_reduce(jobs.get("job"), "me:1")
+
+    with jobs._conn() as conn:
+        conn.execute("UPDATE mapreduce_jobs SET reducer = ? WHERE job_id = 'job'", (DEAD_OWNER,))
+    stale = jobs.get("job")
+    assert jobs.reclaim_reduce(stale, process_owner())
+    assert not jobs.reclaim_reduce(stale, process_owner())   # 另一个进程拿着同一份旧记录来接手会失败
+    assert jobs.get("job")["reducer"] == process_owner()
+
+
+def test_reclaim_skips_jobs_with_a_reduce_task(jobs):
+    jobs.create("job", ["m0"], "count", has_reduce=True)
+    jobs.transition("job", "mapping", "reducing", reducer=DEAD_OWNER)
+    jobs.add_reduce_task("job", "r")
+    assert not jobs.reclaim_reduce(jobs.get("job"), process_owner())
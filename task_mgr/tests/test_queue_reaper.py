@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from queue_reaper import HEARTBEAT_PREFIX, MAX_TASK_ATTEMPTS, PROCESSING_PREFIX, QueueReaper
+
+QUEUES = {"high": "pi_task_high", "normal": "pi_task_normal"}
+DEAD = "pi_task_dead"
+
+
+@pytest.fixture
+def reaper(rds, task_store, hub):
+    return QueueReaper(rds, task_store, hub, QUEUES, DEAD)
+
+
+def _claim(rds, task_store, worker_id, task_id, priority="normal", attempts=None, alive=False):
+    """模拟 worker 已经把消息挪进自己的处理中列表。"""
+    task_store.create_task(task_id, "ip", "sha256", priority=priority)
+    task_store.update_status(task_id, phase="running")
+    msg = {"task_id": task_id, "priority": priority}
+    if attempts is not None:
+        msg["attempts"] = attempts
+    raw = json.dumps(msg)
+    rds.rpush(PROCESSING_PREFIX + worker_id, raw)
+    if alive:
+        rds.set(HEARTBEAT_PREFIX + worker_id, "{}", ex=60)
+    return raw
+
+
+def _queue(rds, name):
+    return [json.loads(raw) for raw in rds.lrange(name, 0, -1)]
+
+
+def test_lost_worker_messages_go_back_to_the_head_of_their_queue(reaper, rds, task_store, hub):
+    rds.rpush("pi_task_high", json.dumps({"task_id": "waiting", "priority": "high"}))
+    _claim(rds, task_store, "pi1:slot0", "t1", priority="high")
+    _claim(rds, task_store, "pi1:slot0", "t2")
+
+    assert reaper.reap_once() == (2, 0)
+
+    assert _queue(rds, "pi_task_high") == [{"task_id": "t1", "priority": "high", "attempts": 1},
+                                           {"task_id": "waiting", "priority": "high"}]
+    assert _queue(rds, "pi_task_normal") == [{"task_id": "t2", "priority": "normal", "attempts": 1}]
+    assert rds.llen(PROCESSING_PREFIX + "pi1:slot0") == 0
+    assert task_store.get_task("t1")["status"] == "queued"
+    assert {e["phase"] for e in hub.events} == {"requeued"}
+
+
+def test_live_workers_are_left_alone(reaper, rds, task_store):
+    _claim(rds, task_store, "pi2:slot0", "t1", alive=True)
+
+    assert reaper.reap_once() == (0, 0)
+    assert rds.llen(PROCESSING_PREFIX + "pi2:slot0") == 1
+
+
+def test_too_many_attempts_go_to_dead_letter(reaper, rds, task_store):
+    _claim(rds, task_store, "pi1:slot0", "t1", attempts=MAX_TASK_ATTEMPTS - 1)
+
+    assert reaper.reap_once() == (0, 1)
+
+    assert _queue(rds, DEAD) == [{"task_id": "t1", "priority": "normal", "attempts": MAX_TASK_ATTEMPTS}]
+    assert rds.llen("pi_task_normal") == 0
+    task = task_store.get_task("t1")
+    assert task["status"] == "failed" and task["phase"] == "dead_letter"
+    assert task["message"] == f"Worker pi1:slot0 lost; giving up after {MAX_TASK_ATTEMPTS} attempts"
+
+
+def test_unparsable_messages_are_dropped(reaper, rds):
+    rds.rpush(PROCESSING_PREFIX + "pi1:slot0", b"not json")
+
+    assert reaper.reap_once() == (0, 0)
+    assert rds.llen(PROCESSING_PREFIX + "pi1:slot0") == 0
+
+
+def test_move_is_a_noop_when_worker_already_finished(reaper, rds):
+    # raw 和 reap_once 里一样，是 LRANGE 读出来的 bytes
+    src = PROCESSING_PREFIX + "pi1:slot0"
+    rds.rpush(src, "other")
+
+    assert reaper._move(src, b"gone", "pi_task_normal", "new") is False
+    assert rds.llen("pi_task_normal") == 0
+    assert reaper._move(src, b"other", "pi_task_normal", "moved") is True
+    assert rds.lrange("pi_task_normal", 0, -1) == [b"moved"]
+    assert rds.llen(src) == 0
+
+
+def test_stats(reaper, rds, task_store):
+    _claim(rds, task_store, "pi1:slot0", "t1")
+    _claim(rds, task_store, "pi2:slot0", "t2", alive=True)
+    rds.rpush("pi_task_high", "x")
+
+    stats = reaper.stats()
+
+    assert stats["queues"] == {"pi_task_high": 1, "pi_task_normal": 0}
+    assert stats["workers"]["pi1:slot0"] == {"info": None, "alive": False, "in_flight": 1}
+    assert stats["workers"]["pi2:slot0"]["alive"] is True
@@ -0,0 +1,151 @@
+import os
+import time
+
+import pytest
+
+from artifact_store import ArtifactStore
+from dataset_store import dataset_artifact_name
+from mapreduce import MapReduceJobs
+from retention import STALE_SPOOL_SEC, RetentionManager
+
+SIZE = 100
+DAY = 24 * 3600
+
+
+@pytest.fixture
+def artifacts(tmp_path, db_path):
+    return ArtifactStore(tmp_path / "tasks", db_path)
+
+
+@pytest.fixture
+def mapreduce_jobs(db_path):
+    return MapReduceJobs(db_path)
+
+
+@pytest.fixture
+def make_manager(tmp_path, task_store, artifacts, hub, rds, mapreduce_jobs):
+    def make(byte_budget=10 * SIZE, max_age=30 * DAY):
+        return RetentionManager(task_store, artifacts, hub, rds, artifacts.root, tmp_path / "builds",
+                                byte_budget=byte_budget, max_age=max_age, mapreduce_jobs=mapreduce_jobs)
+    return make
+
+
+def _put(artifacts, name, last_access, fill=None):
+    src = artifacts.root / "src.bin"
+    src.write_bytes((fill or name).encode().ljust(SIZE, b"."))
+    artifacts.put_file(name, src)
+    with artifacts._conn() as conn:
+        conn.execute("UPDATE artifacts SET last_access = ? WHERE name = ?", (last_access, name))
+
+
+def _finished(task_store, artifacts, task_id, last_access):
+    task_store.create_task(task_id, "ip", "sha256")
+    task_store.update_status(task_id, phase="completed_success")
+    task_store.mark_result(task_id)
+    _put(artifacts, f"{task_id}_result.zip", last_access)
+
+
+def _names(artifacts):
+    return {row["name"] for row in artifacts.iter_lru()}
+
+
+def test_evicts_least_recently_used_until_under_budget(make_manager, task_store, artifacts, hub):
+    now = time.time()
+    for n in range(4):
+        _finished(task_store, artifacts, f"t{n}", now - 100 + n)
+
+    stats = make_manager(byte_budget=2 * SIZE).run_once()
+
+    assert _names(artifacts) == {"t2_result.zip", "t3_result.zip"}
+    assert stats["evicted"] == stats["results_evicted"] == 2
+    assert stats["freed_bytes"] == 2 * SIZE
+    assert task_store.get_task("t0")["has_result"] is False
+    assert [e["phase"] for e in hub.events] == ["result_evicted", "result_evicted"]
+
+
+def test_shared_blob_counts_once_and_is_freed_with_last_reference(make_manager, task_store, artifacts):
+    now = time.time()
+    _put(artifacts, "a_task.zip", now - 50, fill="same")
+    _put(artifacts, "b_task.zip", now - 40, fill="same")
+    _put(artifacts, "c_task.zip", now - 30)
+
+    stats = make_manager(byte_budget=SIZE).run_once()
+
+    assert _names(artifacts) == {"c_task.zip"}
+    assert stats["evicted"] == 2
+    assert stats["freed_bytes"] == SIZE
+
+
+def test_active_tasks_and_pending_dependencies_are_pinned(make_manager, task_store, artifacts):
+    old = time.time() - 365 * DAY
+    _finished(task_store, artifacts, "upstream", old)
+    task_store.create_task("running", "ip", "aes_dec", dependency_id="upstream")
+    _put(artifacts, "running_task.zip", old)
+    _put(artifacts, "running_shard.zip", old)
+    _finished(task_store, artifacts, "unrelated", old)
+
+    make_manager(byte_budget=0).run_once()
+
+    assert _names(artifacts) == {"upstream_result.zip", "running_task.zip", "running_shard.zip"}
+
+    task_store.update_status("running", phase="completed_success")
+    make_manager(byte_budget=0).run_once()
+    assert _names(artifacts) == set()
+
+
+def test_unfinished_mapreduce_jobs_pin_their_map_results(make_manager, task_store, artifacts, mapreduce_jobs):
+    old = time.time() - 365 * DAY
+    for task_id in ("m0", "m1"):
+        _finished(task_store, artifacts, task_id, old)
+    mapreduce_jobs.create("job", ["m0", "m1"], "count", has_reduce=False)
+
+    make_manager(byte_budget=0).run_once()
+    assert _names(artifacts) == {"m0_result.zip", "m1_result.zip"}
+
+    mapreduce_jobs.transition("job", "mapping", "reducing")
+    make_manager(byte_budget=0).run_once()
+    assert _names(artifacts) == {"m0_result.zip", "m1_result.zip"}
+
+    mapreduce_jobs.transition("job", "reducing", "done")
+    make_manager(byte_budget=0).run_once()
+    assert _names(artifacts) == set()
+
+
+def test_datasets_are_never_evicted_nor_counted(make_manager, task_store, artifacts):
+    now = time.time()
+    dataset = dataset_artifact_name("ab" * 32)
+    _put(artifacts, dataset, now - 365 * DAY)
+    _finished(task_store, artifacts, "t0", now)
+
+    stats = make_manager(byte_budget=SIZE).run_once()
+
+    assert _names(artifacts) == {dataset, "t0_result.zip"}
+    assert stats["evicted"] == 0
+
+
+def test_expired_artifacts_go_even_under_budget(make_manager, task_store, artifacts):
+    now = time.time()
+    _finished(task_store, artifacts, "stale", now - 31 * DAY)
+    _finished(task_store, artifacts, "fresh", now - DAY)
+
+    make_manager().run_once()
+
+    assert _names(artifacts) == {"fresh_result.zip"}
+
+
+def test_sweeps_stale_spools_but_keeps_status_files(make_manager, task_store, artifacts):
+    task_store.migrate_status_files(artifacts.root)
+    status = artifacts.root / "legacy_status.txt"
+    status.write_text("Task legacy submitted.")
+    stale = artifacts.tmp_dir / "old.part"
+    stale.write_bytes(b"x")
+    fresh = artifacts.tmp_dir / "new.part"
+    fresh.write_bytes(b"x")
+    past = time.time() - STALE_SPOOL_SEC - 60
+    os.utime(stale, (past, past))
+
+    stats = make_manager().run_once()
+
+    assert stats["spools_removed"] == 1
+    assert not stale.exists() and fresh.exists()
+    assert status.exists()
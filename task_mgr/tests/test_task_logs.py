@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from task_logs import TRUNCATED_MARK, TaskLogStore
+
+
+def _lines(*texts, stream="stdout"):
+    return [{"stream": stream, "line": t} for t in texts]
+
+
+def test_append_and_read_incrementally(tmp_path):
+    logs = TaskLogStore(tmp_path)
+
+    assert logs.read("t1") is None
+    assert logs.append("t1", _lines("one")) == (0, "one\n", False)
+    offset, text, truncated = logs.append("t1", _lines("oops", stream="stderr"), dropped=2)
+    assert (offset, truncated) == (4, False)
+    assert text == "[... 2 lines dropped on worker ...]\n[stderr] oops\n"
+
+    chunk = logs.read("t1", offset=4)
+    assert chunk["text"] == text and chunk["next_offset"] == chunk["size"] and not chunk["truncated"]
+
+
+def test_read_stops_at_a_line_boundary(tmp_path):
+    logs = TaskLogStore(tmp_path)
+    logs.append("t1", _lines("aaaa", "bbbb", "cccc"))
+
+    chunk = logs.read("t1", limit=7)
+    assert chunk["text"] == "aaaa\n" and chunk["next_offset"] == 5
+    assert logs.read("t1", offset=chunk["next_offset"])["text"] == "bbbb\ncccc\n"
+
+
+def test_log_size_is_capped(tmp_path):
+    logs = TaskLogStore(tmp_path, max_bytes=32)
+
+    assert not logs.append("t1", _lines("x" * 10))[2]
+    offset, text, truncated = logs.append("t1", _lines("y" * 10, "z" * 10, "w" * 10))
+    assert truncated and offset == 11
+    assert text == "y" * 10 + "\n" + TRUNCATED_MARK   # 只保留放得下的完整行
+
+    # 达到上限之后的输出直接丢弃
+    size = logs.path("t1").stat().st_size
+    assert logs.append("t1", _lines("late")) == (size, "", True)
+    assert logs.path("t1").stat().st_size == size
+    assert logs.read("t1")["truncated"]
+
+
+def test_invalid_task_ids_are_rejected(tmp_path):
+    logs = TaskLogStore(tmp_path)
+    for task_id in ("../escape", ".hidden", "a/b", ""):
+        assert logs.path(task_id) is None
+        with pytest.raises(ValueError):
+            logs.append(task_id, _lines("x"))
+
+
+def test_sweep_and_usage(tmp_path):
+    logs = TaskLogStore(tmp_path)
+    logs.append("old", _lines("x"))
+    logs.append("new", _lines("yy"))
+    os.utime(logs.path("old"), (1000, 1000))
+
+    assert logs.usage() == 5
+    assert logs.sweep(max_age=3600) == 1
+    assert logs.read("old") is None and logs.read("new") is not None
@@ -0,0 +1,98 @@
+import pytest
+
+from task_store import decode_cursor, encode_cursor, format_ts
+
+
+def _add(task_store, task_id, submitted_at, **fields):
+    task_store.create_task(task_id, fields.pop("client_ip", "10.0.0.1"), fields.pop("task_type", "sha256"))
+    with task_store._conn() as conn:
+        conn.execute("UPDATE tasks SET submitted_at = ?, updated_at = ? WHERE task_id = ?",
+                     (submitted_at, fields.pop("updated_at", submitted_at), task_id))
+    if fields:
+        task_store.update_status(task_id, **fields)
+
+
+def _walk(task_store, limit, **filters):
+    """按游标一页页取完，返回所有 task_id（按返回顺序）。"""
+    ids, cursor = [], None
+    while True:
+        tasks, cursor = task_store.query_tasks(cursor=cursor, limit=limit, **filters)
+        ids += [t["task_id"] for t in tasks]
+        if cursor is None:
+            return ids
+
+
+def test_status_files_are_imported_once(task_store, tmp_path):
+    (tmp_path / "1_status.txt").write_text(
+        "Task 1 submitted.\nSubmitted at: 2024-01-02 03:04:05\nClient IP: 10.0.0.9\nTask type: sha256\n"
+        "Current status: running\n")
+    (tmp_path / "2_status.txt").write_text("Submitted at: 2024-01-02 03:04:06\nCurrent status: running\n")
+    (tmp_path / "2_result.zip").write_bytes(b"zip")
+
+    assert task_store.migrate_status_files(tmp_path) == 2
+    assert task_store.migrate_status_files(tmp_path) == 0
+
+    first, second = task_store.get_task("1"), task_store.get_task("2")
+    assert (first["client_ip"], first["task_type"], first["status"]) == ("10.0.0.9", "sha256", "running")
+    assert format_ts(first["submitted_at"]) == "2024-01-02 03:04:05"
+    assert second["status"] == "success" and second["has_result"] is True
+
+
+def test_update_status(task_store):
+    task_store.create_task("t1", "10.0.0.1", "aes_enc", priority="high")
+    task_store.update_status("t1", status="running", phase="running", progress=40, message="Running")
+
+    task = task_store.get_task("t1")
+    assert (task["status"], task["phase"], task["progress"], task["message"]) == ("running", "running", 40, "Running")
+    assert task["priority"] == "high" and task["has_result"] is False
+    assert task_store.get_task("missing") is None
+
+
+def test_cursor_roundtrip():
+    assert decode_cursor(encode_cursor(1700000000.5, "1700000000-0000000042")) == (1700000000.5, "1700000000-0000000042")
+    with pytest.raises(ValueError):
+        decode_cursor("not-a-cursor")
+
+
+def test_pagination_is_newest_first_and_complete(task_store):
+    # 批量提交：同一个 submitted_at，靠补零后的序号排序
+    batch = [f"100-{seq:010d}" for seq in range(1, 13)]
+    for task_id in batch:
+        _add(task_store, task_id, 100.0)
+    _add(task_store, "050-0000000099", 50.0)
+    _add(task_store, "200-0000000100", 200.0)
+
+    expected = ["200-0000000100", *reversed(batch), "050-0000000099"]
+    for limit in (1, 5, 13, 50):
+        assert _walk(task_store, limit) == expected
+
+
+def test_pagination_with_filters(task_store):
+    for n in range(6):
+        _add(task_store, f"t{n}", float(n), client_ip="10.0.0.1" if n % 2 else "10.0.0.2",
+             status="success" if n < 3 else None)
+
+    assert _walk(task_store, 2, client_ip="10.0.0.1") == ["t5", "t3", "t1"]
+    assert _walk(task_store, 2, status="success") == ["t2", "t1", "t0"]
+    assert _walk(task_store, 2, submitted_after=2.0, submitted_before=5.0) == ["t4", "t3", "t2"]
+
+
+def test_updated_since_is_ascending_by_update(task_store):
+    _add(task_store, "a", 1.0, updated_at=30.0)
+    _add(task_store, "b", 2.0, updated_at=10.0)
+    _add(task_store, "c", 3.0, updated_at=20.0)
+    _add(task_store, "d", 4.0, updated_at=5.0)
+
+    assert _walk(task_store, 1, updated_since=10.0) == ["b", "c", "a"]
+
+
+def test_pending_dependencies_and_active(task_store):
+    task_store.create_task("up", "ip", "aes_enc")
+    task_store.create_task("down", "ip", "aes_dec", dependency_id="up")
+    task_store.update_status("up", phase="completed_success")
+
+    assert task_store.active_task_ids() == {"down"}
+    assert task_store.pending_dependencies() == {"up"}
+
+    task_store.update_status("down", phase="completed_failed")
+    assert task_store.pending_dependencies() == set()
@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+
+import tracing
+from tracing import TraceStore, format_traceparent, make_span, parse_baggage, parse_traceparent, to_otlp
+
+TRACE_ID = "0af7651916cd43dd8448eb211c80319c"
+
+
+def _span(name, start, end, parent=None, span_id=None, **kwargs):
+    return make_span(name, TRACE_ID, parent, start, end, span_id=span_id, **kwargs)
+
+
+def test_traceparent_roundtrip():
+    header = format_traceparent(TRACE_ID, "b7ad6b7169203331")
+    assert header == f"00-{TRACE_ID}-b7ad6b7169203331-01"
+    assert parse_traceparent(header.upper()) == (TRACE_ID, "b7ad6b7169203331")
+    assert parse_traceparent("00-short-b7ad6b7169203331-01") is None
+    assert parse_traceparent(None) is None
+
+
+def test_parse_baggage():
+    assert parse_baggage("task.id=t1;prop=x, user = me") == {"task.id": "t1", "user": "me"}
+    assert parse_baggage("") == {}
+
+
+def test_make_span_uses_otlp_field_names():
+    span = _span("run", 1.5, 2.0, parent="b7ad6b7169203331", ok=False, attributes={"task.id": "t1"})
+
+    assert span["startTimeUnixNano"] == "1500000000" and span["endTimeUnixNano"] == "2000000000"
+    assert span["parentSpanId"] == "b7ad6b7169203331" and len(span["spanId"]) == 16
+    assert span["status"] == {"code": "STATUS_CODE_ERROR"}
+    assert span["resource"]["service.name"] == "pi-task-master"
+
+
+def test_to_otlp_groups_spans_by_resource():
+    master = _span("submit", 1, 2, attributes={"attempt": 1, "ok": True, "ratio": 0.5, "name": "x"})
+    worker = _span("run", 2, 3, service="pi-task-worker")
+
+    payload = to_otlp([master, worker, _span("upload", 3, 4, service="pi-task-worker")])
+
+    assert len(payload["resourceSpans"]) == 2
+    by_service = {next(a["value"]["stringValue"] for a in rs["resource"]["attributes"] if a["key"] == "service.name"):
+                  rs["scopeSpans"][0]["spans"] for rs in payload["resourceSpans"]}
+    assert [s["name"] for s in by_service["pi-task-worker"]] == ["run", "upload"]
+    assert by_service["pi-task-master"][0]["attributes"] == [
+        {"key": "attempt", "value": {"intValue": "1"}},
+        {"key": "ok", "value": {"boolValue": True}},
+        {"key": "ratio", "value": {"doubleValue": 0.5}},
+        {"key": "name", "value": {"stringValue": "x"}},
+    ]
+    assert "resource" not in by_service["pi-task-master"][0]
+
+
+def test_record_and_timeline(tmp_path):
+    store = TraceStore(tmp_path)
+    root = _span("submit", 10.0, 10.5, span_id="a" * 16)
+    store.record("t1", [root])
+    store.record("t1", [_span("run", 10.1, 10.3, parent="a" * 16, span_id="b" * 16)])
+    with open(store.path("t1"), "a") as f:
+        f.write("not json\n")
+
+    timeline = store.timeline("t1")
+
+    assert [(r["name"], r["offset_ms"], r["depth"]) for r in timeline["spans"]] == [("submit", 0.0, 0), ("run", 100.0, 1)]
+    assert timeline["duration_ms"] == 500.0 and timeline["trace_id"] == TRACE_ID
+    assert store.timeline("missing") is None
+
+
+def test_invalid_task_ids_are_ignored(tmp_path):
+    store = TraceStore(tmp_path)
+    for task_id in ("../escape", ".hidden", ""):
+        assert store.path(task_id) is None
+        store.record(task_id, [_span("x", 1, 2)])
+        assert store.spans(task_id) == []
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_sweep_removes_old_traces(tmp_path):
+    store = TraceStore(tmp_path)
+    store.record("old", [_span("x", 1, 2)])
+    store.record("new", [_span("x", 1, 2)])
+    os.utime(store.path("old"), (1000, 1000))
+
+    assert store.sweep(max_age=3600) == 1
+    assert store.spans("old") == [] and len(store.spans("new")) == 1
+
+
+def _exporters():
+    return sum(t.name == "otlp-export" for t in threading.enumerate())
+
+
+def _exported(server):
+    return [s for path, body in server.posts if path == "/v1/traces"
+            for rs in body["resourceSpans"] for s in rs["scopeSpans"][0]["spans"]]
+
+
+def test_spans_are_exported_in_batches_by_one_thread(tmp_path, http_server, monkeypatch):
+    monkeypatch.setattr(tracing, "OTLP_LINGER_SEC", 0.2)
+    store = TraceStore(tmp_path, otlp_endpoint=http_server.url + "/")
+    exporters = _exporters()
+
+    for n in range(20):
+        store.record("t1", [_span(f"s{n}", n, n + 1)])
+    assert _exporters() == exporters + 1
+
+    deadline = time.monotonic() + 5
+    while len(_exported(http_server)) < 20 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(s["name"] for s in _exported(http_server)) == sorted(f"s{n}" for n in range(20))
+    assert len(http_server.posts) < 20
+
+
+def test_export_queue_drops_spans_when_full(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, "OTLP_LINGER_SEC", 0)
+    exporting, release, exported = threading.Event(), threading.Event(), []
+
+    def export(self, spans):
+        exporting.set()
+        release.wait(5)
+        exported.extend(s["name"] for s in spans)
+
+    monkeypatch.setattr(TraceStore, "_export", export)
+    store = TraceStore(tmp_path, otlp_endpoint="http://collector", export_queue_size=3)
+
+    store.record("t1", [_span("first", 1, 2)])
+    assert exporting.wait(5)   # 导出线程卡在 collector 上
+    store.record("t1", [_span(f"s{n}", 1, 2) for n in range(5)])
+    assert store.dropped == 2
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while len(exported) < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert exported == ["first", "s0", "s1", "s2"]
+    assert len(store.spans("t1")) == 6   # 本地文件不受影响
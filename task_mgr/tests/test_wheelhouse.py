@@ -0,0 +1,105 @@
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from wheelhouse import Wheelhouse, normalize_name, project_of
+
+WHEEL = "Requests_Toolbelt-1.0.0-py2.py3-none-any.whl"
+
+
+@pytest.fixture
+def upstream(http_server):
+    http_server.files["/simple/numpy/"] = (
+        b'<a href="../../packages/numpy-2.0.0-cp311-cp311-manylinux2014_aarch64.whl#sha256=abc" '
+        b'data-requires-python="&gt;=3.9">numpy-2.0.0-cp311-cp311-manylinux2014_aarch64.whl</a>'
+    )
+    return http_server
+
+
+@pytest.fixture
+def wheelhouse(tmp_path, upstream):
+    return Wheelhouse(tmp_path / "wheelhouse", f"{upstream.url}/simple")
+
+
+def test_project_names_are_normalized():
+    assert normalize_name("Zope.Interface") == "zope-interface"
+    assert project_of(WHEEL) == "requests-toolbelt"
+    assert project_of("PyYAML-6.0.1.tar.gz") == "pyyaml"
+    assert project_of("notes.txt") is None
+
+
+def test_root_page_lists_local_projects(wheelhouse):
+    (wheelhouse.root / WHEEL).write_bytes(b"wheel")
+    (wheelhouse.root / "PyYAML-6.0.1.tar.gz").write_bytes(b"sdist")
+
+    page = wheelhouse.render_root()
+
+    assert '<a href="pyyaml/">pyyaml</a>' in page
+    assert '<a href="requests-toolbelt/">requests-toolbelt</a>' in page
+    assert ".index" not in page
+
+
+def test_project_page_merges_local_and_upstream_files(wheelhouse, upstream):
+    (wheelhouse.root / "numpy-1.26.4-cp311-cp311-linux_armv7l.whl").write_bytes(b"local build")
+
+    page = wheelhouse.render_project("numpy")
+
+    assert '<a href="../../files/numpy-1.26.4-cp311-cp311-linux_armv7l.whl">' in page
+    assert ('<a href="../../files/numpy-2.0.0-cp311-cp311-manylinux2014_aarch64.whl#sha256=abc" '
+            'data-requires-python="&gt;=3.9">') in page
+    assert wheelhouse.render_project("no-such-project") is None
+
+    # 上游列表缓存 index_ttl 秒，之后上游不通也照样能列出来
+    upstream.files.clear()
+    assert wheelhouse.render_project("numpy") == page
+
+
+@pytest.mark.parametrize("filename", ["../secret.whl", "sub/x.whl", ".index", "..", "/etc/passwd"])
+def test_fetch_rejects_paths_outside_the_wheelhouse(wheelhouse, upstream, filename):
+    assert wheelhouse.fetch(filename) is None
+    assert upstream.requests == []
+
+
+def test_fetch_downloads_once_and_checks_sha256(wheelhouse, upstream):
+    data = b"wheel contents"
+    name = "tiny-1.0-py3-none-any.whl"
+    upstream.files["/simple/tiny/"] = (
+        f'<a href="/files/{name}#sha256={hashlib.sha256(data).hexdigest()}">{name}</a>'.encode())
+    upstream.files[f"/files/{name}"] = data
+
+    path = wheelhouse.fetch(name)
+    assert path == wheelhouse.root / name and path.read_bytes() == data
+
+    requests_made = len(upstream.requests)
+    assert wheelhouse.fetch(name) == path
+    assert len(upstream.requests) == requests_made
+
+
+def test_concurrent_misses_download_once(wheelhouse, upstream):
+    data = b"wheel contents"
+    name = "tiny-1.0-py3-none-any.whl"
+    upstream.files["/simple/tiny/"] = (
+        f'<a href="/files/{name}#sha256={hashlib.sha256(data).hexdigest()}">{name}</a>'.encode())
+    upstream.files[f"/files/{name}"] = data
+    start = threading.Barrier(8)
+
+    def fetch():
+        start.wait()
+        return wheelhouse.fetch(name)
+
+    with ThreadPoolExecutor(8) as pool:
+        paths = list(pool.map(lambda _: fetch(), range(8)))
+
+    assert paths == [wheelhouse.root / name] * 8
+    assert [path for path, _ in upstream.requests].count(f"/files/{name}") == 1
+
+
+def test_fetch_discards_files_with_a_wrong_hash(wheelhouse, upstream):
+    name = "tiny-1.0-py3-none-any.whl"
+    upstream.files["/simple/tiny/"] = f'<a href="/files/{name}#sha256={"0" * 64}">{name}</a>'.encode()
+    upstream.files[f"/files/{name}"] = b"tampered"
+
+    assert wheelhouse.fetch(name) is None
+    assert sorted(p.name for p in wheelhouse.root.iterdir()) == [".index"]
@@ -0,0 +1,100 @@
+import io
+import json
+import os
+import zipfile
+
+import pytest
+
+import build_task
+import zip_copy
+from zip_copy import copy_member
+
+
+def _make(path):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("main.py", "print('hi')\n" * 500)
+        zf.writestr("input/", "")
+        zf.writestr("task_config.json", json.dumps({"use_docker": True}))
+        script = zipfile.ZipInfo("run.sh")
+        script.external_attr = 0o755 << 16
+        zf.writestr(script, "#!/bin/sh\n", zipfile.ZIP_STORED)
+        zf.writestr("input/data.bin", os.urandom(200_000))
+    return path
+
+
+@pytest.mark.skipif(not zip_copy.RAW_COPY, reason="zipfile internals differ on this interpreter")
+def test_copy_member_keeps_compressed_bytes(tmp_path):
+    src = _make(tmp_path / "src.zip")
+    with zipfile.ZipFile(src) as zin, zipfile.ZipFile(tmp_path / "dst.zip", "w") as zout:
+        for info in zin.infolist():
+            copy_member(zin, info, zout, "renamed/" + info.filename)
+
+    with zipfile.ZipFile(src) as a, zipfile.ZipFile(tmp_path / "dst.zip") as b:
+        assert b.testzip() is None
+        for old in a.infolist():
+            new = b.getinfo("renamed/" + old.filename)
+            assert b.read(new) == a.read(old)
+            if old.is_dir():
+                continue
+            assert (new.CRC, new.compress_type, new.compress_size, new.external_attr) == \
+                   (old.CRC, old.compress_type, old.compress_size, old.external_attr)
+
+
+def test_streaming_fallback_without_raw_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(zip_copy, "RAW_COPY", False)
+    src = _make(tmp_path / "src.zip")
+    with zipfile.ZipFile(src) as zin, zipfile.ZipFile(tmp_path / "dst.zip", "w") as zout:
+        for info in zin.infolist():
+            copy_member(zin, info, zout)
+
+    with zipfile.ZipFile(src) as a, zipfile.ZipFile(tmp_path / "dst.zip") as b:
+        assert b.testzip() is None
+        assert [i.filename for i in b.infolist()] == [i.filename for i in a.infolist()]
+        for old in a.infolist():
+            new = b.getinfo(old.filename)
+            assert b.read(new) == a.read(old)
+            if old.is_dir():
+                continue
+            assert (new.compress_type, new.external_attr) == (old.compress_type, old.external_attr)
+
+
+def test_streaming_fallback_into_an_unseekable_stream(tmp_path):
+    class Unseekable(io.RawIOBase):
+        def __init__(self, f):
+            self.f = f
+
+        def writable(self):
+            return True
+
+        def write(self, b):
+            return self.f.write(b)
+
+    src = _make(tmp_path / "src.zip")
+    with open(tmp_path / "dst.zip", "wb") as f:
+        with zipfile.ZipFile(src) as zin, zipfile.ZipFile(Unseekable(f), "w") as zout:
+            for info in zin.infolist():
+                copy_member(zin, info, zout)
+
+    with zipfile.ZipFile(src) as a, zipfile.ZipFile(tmp_path / "dst.zip") as b:
+        assert b.testzip() is None
+        for old in a.infolist():
+            assert b.read(old.filename) == a.read(old)
+
+
+def test_update_task_config_only_rewrites_the_config(tmp_path):
+    path = _make(tmp_path / "task.zip")
+    with zipfile.ZipFile(path) as zf:
+        before = {i.filename: (i.CRC, i.compress_size) for i in zf.infolist() if not i.is_dir()}
+
+    build_task.update_task_config(str(path), image="registry/task@sha256:abc")
+
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        assert [i.filename for i in zf.infolist()] == ["main.py", "input/", "task_config.json", "run.sh",
+                                                      "input/data.bin"]
+        assert json.loads(zf.read("task_config.json")) == {"use_docker": True,
+                                                           "image": "registry/task@sha256:abc"}
+        for name in ("main.py", "run.sh", "input/data.bin"):
+            info = zf.getinfo(name)
+            assert (info.CRC, info.compress_size) == before[name]
+        assert zf.getinfo("run.sh").external_attr >> 16 == 0o755
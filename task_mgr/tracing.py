@@ -0,0 +1,243 @@
+# tracing.py - 任务全链路追踪（W3C traceparent + OpenTelemetry 风格的 span）
+#
+# 提交任务时为每个任务生成 trace_id 和根 span（submit），traceparent 放进 Redis 消息；
+# worker 取到任务后记录 queue_wait、各执行阶段的 span，下载/上传请求带上 traceparent 和
+# baggage: task.id=...，master 对这些请求再记一个 server span。worker 的 span 在任务结束后
+# POST 到 /pi_task/traces（充当 collector），和 master 自己的 span 一起按任务追加到 traces/<task_id>.jsonl。
+#
+# 每行一个 span，字段沿用 OTLP/JSON 的命名（traceId / spanId / startTimeUnixNano ...），
+# 配了 otlp_endpoint 时再转发给真正的 OpenTelemetry collector（/v1/traces）：span 放进有界队列，
+# 由一个后台线程攒批发送，collector 跟不上时队列满了就丢弃（本地的 jsonl 不受影响）。
+# 时间戳来自各自机器的时钟，跨机器的 span（比如 queue_wait）依赖 NTP 对时。
+
+import json
+import logging
+import os
+import queue
+import re
+import socket
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "pi-task-master"
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+_TASK_ID_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+OTLP_QUEUE_SIZE = 10000    # 等待导出的 span 上限
+OTLP_BATCH_SIZE = 512      # 一次 POST 最多带几个 span
+OTLP_LINGER_SEC = 1.0      # 攒批最多等多久
+
+
+def new_trace_id():
+    return os.urandom(16).hex()
+
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+
+def format_traceparent(trace_id, span_id):
+    return f"00-{trace_id}-{span_id}-01"
+
+
+def parse_traceparent(value):
+    """返回 (trace_id, span_id)，格式不对时返回 None。"""
+    match = _TRACEPARENT_RE.match((value or "").strip().lower())
+    return match.groups() if match else None
+
+
+def parse_baggage(value):
+    items = {}
+    for part in (value or "").split(","):
+        key, sep, val = part.strip().partition("=")
+        if sep:
+            items[key.strip()] = val.split(";", 1)[0].strip()
+    return items
+
+
+def make_span(name, trace_id, parent_id, start, end, attributes=None, kind="SPAN_KIND_INTERNAL",
+              ok=True, span_id=None, service=SERVICE_NAME):
+    """start / end 为 time.time() 秒数。"""
+    return {
+        "traceId": trace_id,
+        "spanId": span_id or new_span_id(),
+        "parentSpanId": parent_id or "",
+        "name": name,
+        "kind": kind,
+        "startTimeUnixNano": str(int(start * 1e9)),
+        "endTimeUnixNano": str(int(end * 1e9)),
+        "attributes": attributes or {},
+        "status": {"code": "STATUS_CODE_OK" if ok else "STATUS_CODE_ERROR"},
+        "resource": {"service.name": service, "host.name": socket.gethostname()},
+    }
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans):
+    """按 resource 分组转成 OTLP/JSON 的 ExportTraceServiceRequest。"""
+    by_resource = {}
+    for span in spans:
+        key = json.dumps(span.get("resource", {}), sort_keys=True)
+        otlp = {k: v for k, v in span.items() if k != "resource"}
+        otlp["attributes"] = [{"key": k, "value": _otlp_value(v)} for k, v in span.get("attributes", {}).items()]
+        by_resource.setdefault(key, []).append(otlp)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": k, "value": _otlp_value(v)} for k, v in json.loads(key).items()]},
+        "scopeSpans": [{"scope": {"name": "pi_task"}, "spans": items}],
+    } for key, items in by_resource.items()]}
+
+
+class TraceStore:
+    def __init__(self, root, otlp_endpoint="", export_queue_size=OTLP_QUEUE_SIZE):
+        self.root = Path(root)
+        self.otlp_endpoint = otlp_endpoint.rstrip("/")
+        self.export_queue_size = export_queue_size
+        self.dropped = 0   # 导出队列满了丢掉的 span 数
+        self._lock = threading.Lock()
+        self._exporter = {"pid": None, "queue": None}
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, task_id):
+        if not _TASK_ID_RE.match(task_id or "") or task_id.startswith("."):
+            return None
+        return self.root / f"{task_id}.jsonl"
+
+    # ---------- 写入 ----------
+    def record(self, task_id, spans):
+        path = self.path(task_id)
+        if path is None or not spans:
+            return
+        lines = "".join(json.dumps(span, ensure_ascii=False) + "\n" for span in spans)
+        with self._lock, open(path, "a") as f:
+            f.write(lines)
+        if self.otlp_endpoint:
+            self._enqueue_export(spans)
+
+    # ---------- 导出到 OTLP collector ----------
+    def _export_queue(self):
+        """每个进程一个导出队列和线程（gunicorn fork 出来的 worker 里第一次导出时再启动）。"""
+        if self._exporter["pid"] != os.getpid():
+            with self._lock:
+                if self._exporter["pid"] != os.getpid():
+                    q = queue.Queue(maxsize=self.export_queue_size)
+                    threading.Thread(target=self._export_loop, args=(q,), name="otlp-export", daemon=True).start()
+                    self._exporter["queue"], self._exporter["pid"] = q, os.getpid()
+        return self._exporter["queue"]
+
+    def _enqueue_export(self, spans):
+        q = self._export_queue()
+        dropped = 0
+        for span in spans:
+            try:
+                q.put_nowait(span)
+            except queue.Full:
+                dropped += 1
+        if dropped:
+            with self._lock:
+                self.dropped += dropped
+            logger.warning(f"OTLP export queue full, dropped {dropped} spans")
+
+    def _export_loop(self, q):
+        while True:
+            batch = [q.get()]
+            deadline = time.monotonic() + OTLP_LINGER_SEC
+            while len(batch) < OTLP_BATCH_SIZE:
+                try:
+                    batch.append(q.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self._export(batch)
+            except Exception as e:   # 线程不能死，否则之后的 span 全都堆在队列里
+                logger.warning(f"OTLP export failed: {e}")
+
+    def _export(self, spans):
+        try:
+            requests.post(f"{self.otlp_endpoint}/v1/traces", json=to_otlp(spans), timeout=5).raise_for_status()
+        except requests.RequestException as e:
+            logger.warning(f"Failed to export {len(spans)} spans to {self.otlp_endpoint}: {e}")
+
+    # ---------- 读取 ----------
+    def spans(self, task_id):
+        path = self.path(task_id)
+        if path is None or not path.exists():
+            return []
+        spans = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    continue
+        return spans
+
+    def timeline(self, task_id):
+        """按开始时间排序的 span 列表，带相对偏移（毫秒）、耗时和嵌套深度，供甘特图使用。"""
+        spans = self.spans(task_id)
+        if not spans:
+            return None
+        start = min(int(s["startTimeUnixNano"]) for s in spans)
+        end = max(int(s["endTimeUnixNano"]) for s in spans)
+        parents = {s["spanId"]: s.get("parentSpanId") for s in spans}
+
+        def depth(span_id):
+            d, seen = 0, set()
+            while parents.get(span_id) and parents[span_id] in parents and span_id not in seen:
+                seen.add(span_id)
+                span_id = parents[span_id]
+                d += 1
+            return d
+
+        rows = []
+        for s in sorted(spans, key=lambda s: (int(s["startTimeUnixNano"]), depth(s["spanId"]))):
+            s_start, s_end = int(s["startTimeUnixNano"]), int(s["endTimeUnixNano"])
+            rows.append({
+                "name": s["name"],
+                "span_id": s["spanId"],
+                "parent_id": s.get("parentSpanId") or None,
+                "service": s.get("resource", {}).get("service.name"),
+                "host": s.get("resource", {}).get("host.name"),
+                "offset_ms": round((s_start - start) / 1e6, 3),
+                "duration_ms": round((s_end - s_start) / 1e6, 3),
+                "depth": depth(s["spanId"]),
+                "ok": s.get("status", {}).get("code") != "STATUS_CODE_ERROR",
+                "attributes": s.get("attributes", {}),
+            })
+        totals = {}
+        for row in rows:
+            totals[row["name"]] = round(totals.get(row["name"], 0) + row["duration_ms"], 3)
+        return {
+            "task_id": task_id,
+            "trace_id": spans[0]["traceId"],
+            "start_unix_ms": start // 1_000_000,
+            "duration_ms": round((end - start) / 1e6, 3),
+            "totals_ms": totals,
+            "spans": rows,
+        }
+
+    # ---------- 清理 ----------
+    def sweep(self, max_age, now=None):
+        now = now or time.time()
+        count = 0
+        for f in self.root.glob("*.jsonl"):
+            try:
+                if now - f.stat().st_mtime > max_age:
+                    f.unlink()
+                    count += 1
+            except FileNotFoundError:
+                pass
+        return count
@@ -0,0 +1,234 @@
+# wheelhouse.py - master 上的局域网 PyPI 缓存（PEP 503 simple index）
+#
+# worker 的 pip（本地 venv 和 Docker 构建）都指向 /pi_task/pypi/simple/：
+#   - 项目页：本地 wheelhouse 里已有的文件 + 上游镜像的文件列表（缓存 index_ttl 秒，上游不通时只列本地文件）；
+#   - 文件：本地有就直接发，没有就从上游下载一次存进 wheelhouse，之后所有 Pi 都走局域网。
+# 离线实验室里提前在联网机器/树莓派上用本文件的命令行预先填充（pip download / pip wheel）。
+#
+#   python wheelhouse.py -r requirements.txt [--platform manylinux2014_aarch64 --python-version 3.11] [--build]
+
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import html
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from html.parser import HTMLParser
+from pathlib import Path
+from urllib.parse import urljoin, urldefrag
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+DIST_SUFFIXES = (".whl", ".tar.gz", ".zip", ".tar.bz2")
+JSON_ACCEPT = "application/vnd.pypi.simple.v1+json"
+
+
+def normalize_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def project_of(filename):
+    """从发行文件名解析项目名（已规范化）；不认识的文件返回 None。"""
+    if filename.endswith(".whl"):
+        return normalize_name(filename.split("-", 1)[0])
+    for suffix in DIST_SUFFIXES:
+        if filename.endswith(suffix):
+            stem = filename[:-len(suffix)]
+            if "-" in stem:
+                return normalize_name(stem.rsplit("-", 1)[0])
+    return None
+
+
+class _LinkParser(HTMLParser):
+    """解析 PEP 503 HTML 项目页里的 <a> 链接。"""
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            attrs = dict(attrs)
+            if attrs.get("href"):
+                self.links.append(attrs)
+
+
+class Wheelhouse:
+    def __init__(self, root, upstream, index_ttl=3600, timeout=15):
+        self.root = Path(root)
+        self.meta_dir = self.root / ".index"   # 每个项目的上游文件列表：文件名 -> url / sha256 / requires_python
+        self.lock_dir = self.meta_dir / "locks"
+        self.upstream = upstream.rstrip("/") + "/"
+        self.index_ttl = index_ttl
+        self.timeout = timeout
+        self._session = requests.Session()
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    # ---------- 上游文件列表 ----------
+    def _meta_path(self, project):
+        return self.meta_dir / f"{project}.json"
+
+    def _load_meta(self, project):
+        try:
+            with open(self._meta_path(project)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _fetch_upstream(self, project):
+        url = f"{self.upstream}{project}/"
+        resp = self._session.get(url, timeout=self.timeout, headers={"Accept": f"{JSON_ACCEPT}, text/html;q=0.1"})
+        if resp.status_code == 404:
+            return {}
+        resp.raise_for_status()
+        files = {}
+        if resp.headers.get("Content-Type", "").startswith(JSON_ACCEPT):
+            for entry in resp.json().get("files", []):
+                files[entry["filename"]] = {
+                    "url": urljoin(resp.url, entry["url"]),
+                    "sha256": entry.get("hashes", {}).get("sha256"),
+                    "requires_python": entry.get("requires-python"),
+                }
+        else:
+            parser = _LinkParser()
+            parser.feed(resp.text)
+            for attrs in parser.links:
+                href, fragment = urldefrag(urljoin(resp.url, attrs["href"]))
+                filename = href.rsplit("/", 1)[-1]
+                files[filename] = {
+                    "url": href,
+                    "sha256": fragment[len("sha256="):] if fragment.startswith("sha256=") else None,
+                    "requires_python": attrs.get("data-requires-python"),
+                }
+        return files
+
+    def project_files(self, project):
+        """上游文件列表，缓存 index_ttl 秒；上游不可用时用上一次的缓存（可能为空）。"""
+        meta = self._load_meta(project)
+        if meta is not None and time.time() - meta["fetched_at"] < self.index_ttl:
+            return meta["files"]
+        try:
+            files = self._fetch_upstream(project)
+        except requests.RequestException as e:
+            logger.warning(f"Upstream index unavailable for {project}: {e}")
+            return meta["files"] if meta else {}
+        fd, tmp = tempfile.mkstemp(dir=self.meta_dir, suffix=".tmp")   # 同一进程的多个线程也可能同时刷新
+        with os.fdopen(fd, "w") as f:
+            json.dump({"fetched_at": time.time(), "files": files}, f)
+        os.replace(tmp, self._meta_path(project))
+        return files
+
+    def local_files(self):
+        return sorted(p.name for p in self.root.iterdir() if p.is_file() and p.name.endswith(DIST_SUFFIXES))
+
+    # ---------- simple index 页面 ----------
+    def render_root(self):
+        projects = sorted({project_of(name) for name in self.local_files()} - {None})
+        links = "\n".join(f'<a href="{p}/">{p}</a><br/>' for p in projects)
+        return f"<!DOCTYPE html>\n<html><body>\n{links}\n</body></html>\n"
+
+    def render_project(self, project):
+        files = {name: {} for name in self.local_files() if project_of(name) == project}
+        files.update(self.project_files(project))
+        if not files:
+            return None
+        lines = []
+        for name in sorted(files):
+            info = files[name]
+            href = f"../../files/{name}"
+            if info.get("sha256"):
+                href += f"#sha256={info['sha256']}"
+            attrs = f' data-requires-python="{html.escape(info["requires_python"])}"' if info.get("requires_python") else ""
+            lines.append(f'<a href="{href}"{attrs}>{html.escape(name)}</a><br/>')
+        body = "\n".join(lines)
+        return f"<!DOCTYPE html>\n<html><body>\n<h1>Links for {html.escape(project)}</h1>\n{body}\n</body></html>\n"
+
+    # ---------- 文件 ----------
+    def fetch(self, filename):
+        """返回本地文件路径；本地没有时从上游下载进 wheelhouse。找不到返回 None。"""
+        if "/" in filename or filename.startswith("."):
+            return None
+        path = self.root / filename
+        if path.exists():
+            return path
+        project = project_of(filename)
+        info = self.project_files(project).get(filename) if project else None
+        if not info:
+            return None
+
+        with self._file_lock(filename):
+            if path.exists():   # 等锁期间别的请求已经下载好了
+                return path
+            fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".part")
+            h = hashlib.sha256()
+            try:
+                with os.fdopen(fd, "wb") as f, self._session.get(info["url"], stream=True, timeout=self.timeout) as resp:
+                    resp.raise_for_status()
+                    for chunk in resp.iter_content(1024 * 1024):
+                        h.update(chunk)
+                        f.write(chunk)
+                if info.get("sha256") and h.hexdigest() != info["sha256"]:
+                    raise ValueError(f"sha256 mismatch for {filename}")
+                os.replace(tmp, path)
+            except Exception as e:
+                logger.warning(f"Failed to fetch {filename} from upstream: {e}")
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                return None
+        logger.info(f"Cached {filename} in wheelhouse")
+        return path
+
+    @contextlib.contextmanager
+    def _file_lock(self, filename):
+        """跨 gunicorn worker 的文件锁（flock）：同一个文件同时没命中时只有一个请求去上游下载。"""
+        with open(self.lock_dir / f"{filename}.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# ===================== 命令行：预先填充 =====================
+def main():
+    default_dir = (Path("/home/pi") if os.path.exists("/home/pi") else Path.home()) / "task_manager" / "wheelhouse"
+    parser = argparse.ArgumentParser(description="Pre-populate the master's wheelhouse")
+    parser.add_argument("-r", "--requirement", action="append", required=True, help="requirements file (repeatable)")
+    parser.add_argument("-d", "--dest", default=str(default_dir), help=f"wheelhouse directory (default {default_dir})")
+    parser.add_argument("--platform", action="append", default=[],
+                        help="target platform tag for pip download, e.g. manylinux2014_aarch64 (repeatable)")
+    parser.add_argument("--python-version", default=None, help="target Python version, e.g. 3.11")
+    parser.add_argument("--build", action="store_true",
+                        help="run 'pip wheel' instead, compiling sdists for this machine's architecture")
+    parser.add_argument("-i", "--index-url", default=None, help="index to download from")
+    args = parser.parse_args()
+
+    os.makedirs(args.dest, exist_ok=True)
+    cmd = [sys.executable, "-m", "pip"]
+    cmd += ["wheel", "-w", args.dest] if args.build else ["download", "-d", args.dest]
+    for req in args.requirement:
+        cmd += ["-r", req]
+    if args.index_url:
+        cmd += ["-i", args.index_url]
+    if not args.build and (args.platform or args.python_version):
+        # 跨平台下载只能取现成的 wheel
+        cmd += ["--only-binary=:all:"]
+        for platform in args.platform:
+            cmd += ["--platform", platform]
+        if args.python_version:
+            cmd += ["--python-version", args.python_version]
+    print(" ".join(cmd))
+    sys.exit(subprocess.run(cmd).returncode)
+
+
+if __name__ == "__main__":
+    main()
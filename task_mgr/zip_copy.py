@@ -0,0 +1,98 @@
+# zip_copy.py - 在两个 zip 之间原样搬运成员，不解压也不重新压缩
+#
+# 改写 task_config.json、拆分/合并任务包时，其余成员的压缩数据直接按字节拷过去：
+# 几个 GB 的包也只是顺序读写一遍磁盘，内存占用固定，不花 CPU 在 deflate 上。
+#
+# 原样拷贝要直接写 ZipFile 的内部状态（公开 API 只能经过压缩器写入）。这些内部细节在
+# CPython 3.6 - 3.14 上没有变过；版本不在这个范围、或者检查时对不上，就退回解压再压缩的流式拷贝。
+
+import io
+import shutil
+import struct
+import sys
+import zipfile
+
+COPY_CHUNK = 1024 * 1024
+
+_MASK_ENCRYPTED = 0x01
+_MASK_COMPRESS_OPTIONS = 0x06   # deflate 压缩级别提示 / LZMA 的 EOS 标记，跟着压缩数据走
+
+_RAW_COPY_VERSIONS = ((3, 6), (3, 14))
+_ZIPFILE_NAMES = ("_FH_SIGNATURE", "_FH_FILENAME_LENGTH", "_FH_EXTRA_FIELD_LENGTH",
+                  "sizeFileHeader", "structFileHeader", "stringFileHeader", "ZIP64_LIMIT")
+_WRITER_ATTRS = ("fp", "filelist", "NameToInfo", "start_dir", "_lock", "_seekable", "_writing",
+                 "_didModify", "_writecheck")
+
+
+def _raw_copy_supported():
+    """当前解释器的 zipfile 是否还是原样拷贝依赖的那套内部实现。"""
+    low, high = _RAW_COPY_VERSIONS
+    if not low <= sys.version_info[:2] <= high:
+        return False
+    if not all(hasattr(zipfile, name) for name in _ZIPFILE_NAMES):
+        return False
+    if not hasattr(zipfile.ZipInfo, "FileHeader"):
+        return False
+    with zipfile.ZipFile(io.BytesIO(), "w") as probe:
+        return all(hasattr(probe, name) for name in _WRITER_ATTRS)
+
+
+RAW_COPY = _raw_copy_supported()
+
+
+def copy_member(zin, info, zout, arcname=None):
+    """把 zin 里的成员 info 写进 zout（可以改名为 arcname），保留压缩方式、CRC 和权限位。
+
+    zin 必须是按路径打开的；zout 写到不可 seek 的流、成员加了密或 RAW_COPY 为 False 时
+    退化为解压再压缩的流式拷贝。
+    """
+    target = zipfile.ZipInfo(arcname or info.filename, date_time=info.date_time)
+    target.create_system = info.create_system
+    target.external_attr = info.external_attr
+    if info.is_dir():
+        zout.writestr(target, b"")
+        return
+    target.compress_type = info.compress_type
+    target.file_size = info.file_size   # 让 zipfile 按原大小决定要不要用 zip64
+    if not RAW_COPY or zin.filename is None or info.flag_bits & _MASK_ENCRYPTED or not zout._seekable:
+        with zin.open(info) as src, zout.open(target, "w") as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK)
+        return
+
+    target.CRC = info.CRC
+    target.compress_size = info.compress_size
+    target.flag_bits = info.flag_bits & _MASK_COMPRESS_OPTIONS
+    zip64 = max(target.file_size, target.compress_size) > zipfile.ZIP64_LIMIT
+    with open(zin.filename, "rb") as src:
+        _seek_to_data(src, info)
+        # 以下步骤和 ZipFile._open_to_write / _ZipWriteFile.close 一致，只是数据不经过压缩器
+        with zout._lock:
+            if zout._writing:
+                raise ValueError("Can't copy into the ZIP file while another write handle is open")
+            zout.fp.seek(zout.start_dir)
+            target.header_offset = zout.fp.tell()
+            zout._writecheck(target)
+            zout._didModify = True
+            zout.fp.write(target.FileHeader(zip64))
+            remaining = info.compress_size
+            while remaining:
+                chunk = src.read(min(COPY_CHUNK, remaining))
+                if not chunk:
+                    raise zipfile.BadZipFile(f"Truncated data for member {info.filename!r}")
+                zout.fp.write(chunk)
+                remaining -= len(chunk)
+            zout.start_dir = zout.fp.tell()
+            zout.filelist.append(target)
+            zout.NameToInfo[target.filename] = target
+
+
+def _seek_to_data(f, info):
+    """跳过本地文件头，定位到成员压缩数据的开头。"""
+    f.seek(info.header_offset)
+    header = f.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipFile("Truncated file header")
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    if fields[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad magic number for member {info.filename!r}")
+    f.seek(fields[zipfile._FH_FILENAME_LENGTH] + fields[zipfile._FH_EXTRA_FIELD_LENGTH], 1)